@@ -0,0 +1,612 @@
+import asyncio
+import json
+import random
+import struct
+import sys
+
+import cryptography_utils.utils as crypto_utils
+from cryptography_utils.e2e import E2EIdentity, SEALED_FLAG
+from client import Client
+
+_CLOSED = object()
+
+
+class DeliveryError(Exception):
+    """O servidor não entregou a mensagem ('offline', 'send_failed' ou 'dropped')."""
+
+    def __init__(self, status):
+        super().__init__(f"Mensagem não entregue: {status}")
+        self.status = status
+
+
+class _Sealed:
+    """Item da fila de envio selado para o destino no momento da escrita (modo E2E)."""
+
+    __slots__ = ('payload',)
+
+    def __init__(self, payload):
+        self.payload = payload
+
+
+def _history_request(with_id, before, limit):
+    request = {'type': 'get_history', 'with_id': with_id, 'limit': limit}
+    if before is not None:
+        request['before'] = before
+    return request
+
+
+class AsyncClient(Client):
+    """
+    Cliente asyncio para bots e integrações, reutilizando o handshake do Client.
+
+    - `await client.send(target_id, msg)` retorna quando o frame foi escrito;
+      vários sends concorrentes são agrupados em lote (um drain por lote).
+    - `async for message in client` itera as mensagens recebidas (já decifradas).
+    - A conexão é refeita automaticamente com backoff exponencial + jitter; o
+      servidor atribui um novo client_id a cada sessão. Frames cuja escrita
+      falhou são reenviados na nova sessão (entrega at-least-once).
+    - `await client.send(target_id, msg, receipt=True)` espera também o recibo de
+      entrega do servidor (agrupado em intervalos de seq); levanta DeliveryError
+      se o destino estava offline ou o frame foi descartado, ou se o recibo não
+      chegou em `receipt_timeout` segundos.
+    - Com `e2e=True` as mensagens são seladas fim a fim (cryptography_utils/e2e.py):
+      o cliente publica prekeys, busca o bundle do destino no primeiro envio e o
+      servidor só repassa o frame. Os dois lados precisam usar E2E.
+    """
+
+    def __init__(self, name, host='localhost', port=5000, reconnect=True,
+                 backoff_initial=0.5, backoff_max=30.0, max_pending=10000, batch_size=256, transport=None,
+                 e2e=False, prekey_count=20, cipher_suites=None, receipt_timeout=30.0):
+        super().__init__(host, port, transport=transport, cipher_suites=cipher_suites)
+        self.client_name = name
+        self.reconnect = reconnect
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.batch_size = batch_size
+        self.receipt_timeout = receipt_timeout
+
+        self._outbox = asyncio.Queue(max_pending)
+        self._retry = []
+        self._incoming = asyncio.Queue()
+        self._ready = asyncio.Event()
+        self._reader = None
+        self._writer = None
+        self._tasks = []
+        self._closing = False
+        self._reconnect_delay = None
+        self._awaiting = {}  # seq do frame -> future do recibo (sessão atual)
+        self._requests = {}  # ref -> future da resposta (bundles E2E)
+        self._next_ref = 0
+        self.e2e = E2EIdentity() if e2e else None
+        self.prekey_count = prekey_count
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self._incoming.get()
+        if message is _CLOSED:
+            raise StopAsyncIteration
+        return message
+
+    async def connect(self):
+        """Primeira conexão (exceções propagam) e início das tasks de envio/recebimento."""
+        await self._open()
+        self._tasks = [
+            asyncio.create_task(self._run_receiver()),
+            asyncio.create_task(self._run_sender()),
+        ]
+
+    async def send(self, target_id, message, receipt=False):
+        """Envia uma mensagem de chat; retorna após a escrita no socket (ou após o recibo)."""
+        if self.e2e is not None:
+            if receipt:
+                raise ValueError("Recibos de entrega não se aplicam a frames E2E")
+            await self._send_sealed(target_id, message)
+            return
+        await self._submit({'type': 'send_message', 'target_id': target_id, 'message': message},
+                           target_id, receipt=receipt)
+
+    async def request_online_clients(self):
+        """Solicita a lista de usuários online (a resposta chega pelo iterador)."""
+        await self._submit({'type': 'get_online_clients'}, 0)
+
+    async def request_history(self, with_id, before=None, limit=50):
+        """Solicita uma página do histórico com `with_id` (resposta 'history' pelo iterador)."""
+        await self._submit(_history_request(with_id, before, limit), 0)
+
+    async def find_users(self, query, prefix=True, limit=20):
+        """
+        Busca clientes pelo nome (exato, ou pelo início com `prefix`); retorna a resposta
+        'users_found': {'clients': [{'id', 'name'}, ...], 'more': bool}.
+        """
+        response = await self._request({'type': 'find_users', 'query': query, 'prefix': prefix, 'limit': limit})
+        if response.get('type') != 'users_found':
+            raise ValueError(response.get('message', 'Busca recusada pelo servidor'))
+        return response
+
+    async def _send_sealed(self, target_id, message):
+        payload = json.dumps({'from_name': self.client_name, 'message': message}).encode('utf-8')
+        for _ in range(3):
+            if not self.e2e.knows(target_id):
+                bundle = await self._request({'type': 'get_prekey_bundle', 'client_id': target_id})
+                if bundle.get('type') != 'prekey_bundle':
+                    raise DeliveryError('e2e_unavailable')
+                try:
+                    self.e2e.add_peer(bundle)
+                except ValueError:
+                    raise DeliveryError('e2e_identity_changed') from None
+            try:
+                await self._submit(_Sealed(payload), target_id)
+                return
+            except DeliveryError as exc:
+                # Reconexão entre a busca do bundle e a escrita: busca de novo
+                if exc.status != 'e2e_session_reset':
+                    raise
+        raise DeliveryError('e2e_unavailable')
+
+    async def _request(self, data_dict):
+        """Envia um pedido com `ref` e aguarda a resposta correspondente."""
+        self._next_ref += 1
+        ref = data_dict['ref'] = self._next_ref
+        future = self._requests[ref] = asyncio.get_running_loop().create_future()
+        try:
+            await self._submit(data_dict, 0)
+            return await future
+        finally:
+            self._requests.pop(ref, None)
+
+    async def _submit(self, data_dict, target_id, sender=None, receipt=False):
+        if self._closing:
+            raise ConnectionError("Cliente encerrado")
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        receipt_future = None
+        if receipt:
+            data_dict['receipt'] = True
+            receipt_future = loop.create_future()
+        await self._outbox.put((data_dict, target_id, future, sender, receipt_future))
+        await future
+        if receipt_future is not None:
+            try:
+                await asyncio.wait_for(receipt_future, self.receipt_timeout)
+            except asyncio.TimeoutError:
+                # Recibo perdido (ex.: servidor antigo): o seq não fica pendente para sempre
+                for seq, awaiting in list(self._awaiting.items()):
+                    if awaiting is receipt_future:
+                        del self._awaiting[seq]
+                raise DeliveryError('receipt_timeout') from None
+
+    async def close(self):
+        self._closing = True
+        self._ready.clear()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._close_transport()
+        self._fail_pending(ConnectionError("Cliente encerrado"))
+        self._fail_receipts(ConnectionError("Cliente encerrado"))
+        self._fail_requests(ConnectionError("Cliente encerrado"))
+        self._incoming.put_nowait(_CLOSED)
+
+    # --- Conexão ---
+
+    async def _open(self):
+        reader, writer = await self.transport.open_connection()
+        try:
+            sk_C, pk_C_bytes, hello_payload = self._build_hello()
+            writer.write(struct.pack('!I', len(hello_payload)) + hello_payload)
+            await writer.drain()
+
+            response_data = await self._read_frame(reader)
+            if not self._finish_handshake(sk_C, pk_C_bytes, response_data):
+                raise ConnectionError("Assinatura do servidor INVÁLIDA! Possível ataque MitM.")
+            if self.e2e is not None:
+                # Novo client_id: sessões E2E recomeçam e o bundle é publicado de novo
+                self.e2e.reset_sessions(self.server_epoch)
+                writer.write(self._encode(self.e2e.prekey_bundle(self.prekey_count), self.client_id, 0))
+                await writer.drain()
+        except BaseException:
+            writer.close()
+            raise
+
+        self._reader, self._writer = reader, writer
+        self.connected = True
+        self._ready.set()
+
+    def _close_transport(self):
+        self.connected = False
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+    async def _reconnect(self):
+        delay = self._reconnect_delay if self._reconnect_delay is not None else self.backoff_initial
+        self._reconnect_delay = None
+        backoff = self.backoff_initial
+        while not self._closing:
+            await asyncio.sleep(delay)
+            try:
+                await self._open()
+                return True
+            except (OSError, ConnectionError, asyncio.IncompleteReadError, KeyError, TypeError, ValueError):
+                # Inclui respostas de handshake malformadas (JSON inválido, campos ausentes):
+                # contam como tentativa falha, com o mesmo backoff
+                backoff = min(self.backoff_max, backoff * 2)
+                # Full jitter: evita que muitos clientes reconectem em sincronia
+                delay = random.uniform(0, backoff)
+        return False
+
+    @staticmethod
+    async def _read_frame(reader):
+        len_bytes = await reader.readexactly(4)
+        length = struct.unpack('!I', len_bytes)[0]
+        return await reader.readexactly(length)
+
+    # --- Recebimento ---
+
+    async def _run_receiver(self):
+        while True:
+            try:
+                await self._receive_loop()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # EOF, erro de socket ou frame inválido: a sessão é descartada
+                pass
+
+            self._ready.clear()
+            self._close_transport()
+            # Frames já escritos sem recibo: o resultado é desconhecido
+            self._fail_receipts(ConnectionError("Conexão perdida antes do recibo de entrega"))
+            self._fail_requests(ConnectionError("Conexão perdida"))
+            self._on_disconnected()
+            try:
+                reconnected = not self._closing and self.reconnect and await self._reconnect()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                reconnected = False  # Erro inesperado na reconexão: desiste como no close()
+            if not reconnected:
+                self._abandon()
+                return
+            self._on_reconnected()
+
+    def _abandon(self):
+        """Sem reconexão: os envios pendentes (e os futuros) falham em vez de esperar para sempre."""
+        self._closing = True
+        for task in self._tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+        exc = ConnectionError("Conexão encerrada")
+        self._fail_pending(exc)
+        self._fail_receipts(exc)
+        self._fail_requests(exc)
+        self._incoming.put_nowait(_CLOSED)
+
+    def _on_disconnected(self):
+        """Gancho para subclasses: sessão perdida."""
+
+    def _on_reconnected(self):
+        """Gancho para subclasses: nova sessão estabelecida (novo client_id)."""
+
+    async def _receive_loop(self):
+        while True:
+            length = struct.unpack('!I', await self._reader.readexactly(4))[0]
+            if length & SEALED_FLAG:
+                await self._open_sealed(await self._reader.readexactly(length & ~SEALED_FLAG))
+                continue
+            encrypted_frame = await self._reader.readexactly(length)
+            plaintext, sender_id, target_id, seq = crypto_utils.decrypt_message(self.cipher_s2c, encrypted_frame)
+
+            if seq <= self.seq_recv and self.seq_recv != 0:
+                continue  # Replay: descartado
+            self.seq_recv = seq
+
+            message = json.loads(plaintext.decode('utf-8'))
+            m_type = message.get('type')
+
+            if m_type == 'ping':
+                try:
+                    self._outbox.put_nowait(({'type': 'pong', 'ts': message.get('ts')}, 0, None, None, None))
+                except asyncio.QueueFull:
+                    pass  # Fila cheia já implica tráfego; o servidor não vai considerar a sessão ociosa
+            elif m_type == 'pong':
+                pass
+            elif m_type == 'receipt':
+                self._handle_receipt(message)
+            elif message.get('ref') in self._requests:
+                future = self._requests.pop(message['ref'])
+                if not future.done():
+                    future.set_result(message)
+            elif m_type == 'prekeys_low':
+                if self.e2e is not None:
+                    try:
+                        self._outbox.put_nowait((self.e2e.prekey_bundle(self.prekey_count), 0, None, None, None))
+                    except asyncio.QueueFull:
+                        pass  # Sem prekeys o remetente usa só a chave de identidade
+            elif m_type == 'server_draining':
+                # Reconecta após a dica do servidor (já com jitter)
+                self._reconnect_delay = message.get('reconnect_after', 0)
+                await self._incoming.put(message)
+                return
+            else:
+                await self._dispatch(message, target_id)
+
+    async def _dispatch(self, message, target_id):
+        """Entrega uma mensagem recebida; `target_id` vem do cabeçalho autenticado."""
+        await self._incoming.put(message)
+
+    async def _open_sealed(self, frame):
+        if self.e2e is None:
+            return
+        try:
+            sender_id, plaintext = self.e2e.open(frame, self.client_id)
+            body = json.loads(plaintext.decode('utf-8'))
+        except Exception:
+            return  # Adulterado, repetido, de sessão desconhecida ou com outra identidade: descartado
+        await self._dispatch({'type': 'message', 'from_id': sender_id, 'from_name': body.get('from_name'),
+                              'message': body.get('message'), 'e2e': True,
+                              'fingerprint': self.e2e.peer_fingerprint(sender_id)}, self.client_id)
+
+    def _handle_receipt(self, receipt):
+        awaiting = self._awaiting
+        for first, last in receipt.get('delivered', ()):
+            for seq in range(first, last + 1):
+                future = awaiting.pop(seq, None)
+                if future is not None and not future.done():
+                    future.set_result(None)
+        for seq, status in receipt.get('failed', ()):
+            future = awaiting.pop(seq, None)
+            if future is not None and not future.done():
+                future.set_exception(DeliveryError(status))
+        # Cumulativo: o que ficou pendente até `through` foi descartado pelo servidor.
+        # Os seqs são crescentes e o dict preserva a ordem de inserção.
+        through = receipt.get('through', 0)
+        while awaiting:
+            seq = next(iter(awaiting))
+            if seq > through:
+                break
+            future = awaiting.pop(seq)
+            if not future.done():
+                future.set_exception(DeliveryError('dropped'))
+
+    def _fail_requests(self, exc):
+        requests = self._requests
+        self._requests = {}
+        for future in requests.values():
+            if not future.done():
+                future.set_exception(exc)
+
+    def _fail_receipts(self, exc):
+        awaiting = self._awaiting
+        self._awaiting = {}
+        for future in awaiting.values():
+            if not future.done():
+                future.set_exception(exc)
+
+    # --- Envio (pipelining) ---
+
+    async def _run_sender(self):
+        while True:
+            if not self._retry:
+                self._retry = [await self._outbox.get()]
+            # O lote fica em _retry enquanto espera a sessão: _fail_pending o alcança
+            batch = self._retry
+            while len(batch) < self.batch_size and not self._outbox.empty():
+                batch.append(self._outbox.get_nowait())
+
+            await self._ready.wait()
+            writer = self._writer
+            if writer is None:
+                # Sessão caiu entre o sinal de pronto e a escrita: aguarda a próxima
+                self._ready.clear()
+                continue
+            self._retry = []
+            # Usuários lógicos ainda sem ID na sessão atual aguardam o re-registro
+            deferred = [item for item in batch if item[3] is not None and item[3].client_id is None]
+            if deferred:
+                batch = [item for item in batch if item[3] is None or item[3].client_id is not None]
+            written = []
+            try:
+                for data_dict, target_id, future, sender, receipt_future in batch:
+                    sender_id = sender.client_id if sender is not None else self.client_id
+                    if isinstance(data_dict, _Sealed):
+                        # Selado na escrita: o remetente (client_id) é o da sessão atual
+                        if not self.e2e.knows(target_id):
+                            # Bundle descartado na reconexão; _send_sealed busca outro
+                            future.set_exception(DeliveryError('e2e_session_reset'))
+                            continue
+                        frame = self.e2e.seal(sender_id, target_id, data_dict.payload)
+                        writer.write(struct.pack('!I', len(frame) | SEALED_FLAG) + frame)
+                        continue
+                    writer.write(self._encode(data_dict, sender_id, target_id))
+                    if receipt_future is not None:
+                        self._awaiting[self.seq_send] = receipt_future
+                        written.append(self.seq_send)
+                await writer.drain()
+            except OSError:
+                # Conexão caiu no meio do lote: reenvia tudo na próxima sessão
+                self._ready.clear()
+                for seq in written:
+                    self._awaiting.pop(seq, None)
+                self._retry = batch + deferred
+                continue
+
+            for _, _, future, _, _ in batch:
+                if future is not None and not future.done():
+                    future.set_result(None)
+            if deferred:
+                self._retry = deferred
+                if not batch:
+                    await asyncio.sleep(0.05)
+
+    def _encode(self, data_dict, sender_id, target_id):
+        """Frame cifrado (chave C2S) com prefixo de tamanho; consome um seq."""
+        json_bytes = json.dumps(data_dict).encode('utf-8')
+        self.seq_send += 1
+        encrypted_frame = crypto_utils.encrypt_message(
+            self.cipher_c2s, json_bytes, sender_id, target_id, self.seq_send
+        )
+        return struct.pack('!I', len(encrypted_frame)) + encrypted_frame
+
+    def _fail_pending(self, exc):
+        pending = self._retry
+        self._retry = []
+        while not self._outbox.empty():
+            pending.append(self._outbox.get_nowait())
+        for _, _, future, _, receipt_future in pending:
+            if future is not None and not future.done():
+                future.set_exception(exc)
+            if receipt_future is not None and not receipt_future.done():
+                receipt_future.set_exception(exc)
+
+
+class LogicalUser:
+    """Identidade lógica hospedada em um MultiplexClient."""
+
+    def __init__(self, mux, name):
+        self.mux = mux
+        self.name = name
+        self.client_id = None
+        self._registering = False
+        self._incoming = asyncio.Queue()
+
+    async def send(self, target_id, message, receipt=False):
+        await self.mux._submit({'type': 'send_message', 'target_id': target_id, 'message': message},
+                               target_id, self, receipt)
+
+    async def request_online_clients(self):
+        await self.mux._submit({'type': 'get_online_clients'}, 0, self)
+
+    async def request_history(self, with_id, before=None, limit=50):
+        await self.mux._submit(_history_request(with_id, before, limit), 0, self)
+
+    async def close(self):
+        """Remove a identidade do servidor (a conexão continua ativa)."""
+        self.mux._users.pop(self.client_id, None)
+        if self in self.mux._all_users:
+            self.mux._all_users.remove(self)
+        if self.client_id is not None:
+            await self.mux._submit({'type': 'unregister_user', 'client_id': self.client_id}, 0)
+        self._incoming.put_nowait(_CLOSED)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self._incoming.get()
+        if message is _CLOSED:
+            raise StopAsyncIteration
+        return message
+
+
+class MultiplexClient(AsyncClient):
+    """
+    Uma conexão autenticada transportando muitas identidades lógicas (gateways).
+    Cada usuário é registrado com `register_user` (sem novo handshake); o servidor
+    identifica o remetente pelo campo sender do cabeçalho e entrega as mensagens
+    com o ID lógico no campo target, usado aqui para demultiplexar.
+    Notificações de entrada chegam uma vez por conexão, no iterador do próprio cliente.
+    """
+
+    def __init__(self, name='gateway', host='localhost', port=5000, **kwargs):
+        super().__init__(name, host, port, **kwargs)
+        self._users = {}
+        self._all_users = []
+        self._pending = {}
+
+    async def register_user(self, name):
+        user = LogicalUser(self, name)
+        self._all_users.append(user)
+        await self._register(user)
+        return user
+
+    async def _register(self, user):
+        user._registering = True
+        try:
+            while True:
+                self._next_ref += 1
+                ref = self._next_ref
+                future = asyncio.get_running_loop().create_future()
+                self._pending[ref] = future
+                try:
+                    await self._submit({'type': 'register_user', 'name': user.name, 'ref': ref}, 0)
+                    response = await future
+                    break
+                except ConnectionError:
+                    # Sessão caiu antes da resposta: tenta de novo na próxima
+                    if self._closing or not self.reconnect:
+                        raise
+                    await self._ready.wait()
+                finally:
+                    self._pending.pop(ref, None)
+        finally:
+            user._registering = False
+        if response.get('type') == 'error':
+            raise ConnectionError(response.get('message'))
+        user.client_id = response['client_id']
+        self._users[user.client_id] = user
+
+    async def _dispatch(self, message, target_id):
+        ref = message.get('ref')
+        if ref is not None and message.get('type') in ('user_registered', 'error'):
+            if ref in self._pending:
+                self._pending[ref].set_result(message)
+            elif message.get('type') == 'user_registered':
+                # Resposta a um registro reenviado após reconexão e já refeito: descarta o órfão
+                self._outbox.put_nowait(({'type': 'unregister_user', 'client_id': message['client_id']}, 0, None, None, None))
+            return
+        user = self._users.get(target_id)
+        if user is not None:
+            await user._incoming.put(message)
+        else:
+            await self._incoming.put(message)
+
+    async def close(self):
+        await super().close()
+        self._close_users()
+
+    def _abandon(self):
+        super()._abandon()
+        self._close_users()
+
+    def _close_users(self):
+        """Encerra os iteradores dos usuários lógicos: a conexão que os transporta acabou."""
+        for user in self._all_users:
+            user._incoming.put_nowait(_CLOSED)
+
+    def _on_disconnected(self):
+        # IDs lógicos pertencem à sessão perdida
+        self._users.clear()
+        for user in self._all_users:
+            user.client_id = None
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Conexão perdida durante o registro"))
+
+    def _on_reconnected(self):
+        for user in self._all_users:
+            if not user._registering:
+                self._tasks.append(asyncio.create_task(self._register(user)))
+
+
+async def _demo(name, host, port):
+    async with AsyncClient(name, host, port) as client:
+        print(f"[ASYNC] Conectado como {name} (ID: {client.client_id})")
+        await client.request_online_clients()
+        async for message in client:
+            print(f"[ASYNC] {message}")
+
+
+if __name__ == "__main__":
+    host = sys.argv[2] if len(sys.argv) > 2 else 'localhost'
+    port = int(sys.argv[3]) if len(sys.argv) > 3 else 5000
+    asyncio.run(_demo(sys.argv[1] if len(sys.argv) > 1 else 'Bot', host, port))
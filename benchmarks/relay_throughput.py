@@ -0,0 +1,71 @@
+"""
+Vazão do relay (handshake + cifragem + roteamento) em cada transporte, com servidor e
+clientes no mesmo processo. socketpair isola o custo de cripto/relay da pilha de rede.
+
+    uv run python benchmarks/relay_throughput.py [N_MENSAGENS] [TAMANHO]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from async_client import AsyncClient
+from server import Server
+from server_utils.log import setup_logging
+from transport import SocketPairTransport, TcpTransport, UnixTransport
+
+
+async def run(transport, n, size):
+    payload = 'x' * size
+    async with AsyncClient('tx', transport=transport) as sender, \
+            AsyncClient('rx', transport=transport) as receiver:
+        start = time.perf_counter()
+        sends = asyncio.gather(*(sender.send(receiver.client_id, payload) for _ in range(n)))
+        received = 0
+        async for message in receiver:
+            if message.get('type') == 'message':
+                received += 1
+                if received == n:
+                    break
+        await sends
+        return time.perf_counter() - start
+
+
+def bench(transport, n, size):
+    server = Server(transport=transport, message_rate_per_client=0, message_rate_per_ip=0,
+                    connection_rate_per_ip=0, idle_timeout=0)
+    threading.Thread(target=server.start, daemon=True).start()
+    while not server.accepting:
+        time.sleep(0.01)
+    try:
+        return asyncio.run(run(transport, n, size))
+    finally:
+        server.close()
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    listener = setup_logging('ERROR')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        transports = [
+            ('tcp', TcpTransport('127.0.0.1', 5990)),
+            ('unix', UnixTransport(os.path.join(tmp, 'chat.sock'))),
+            ('socketpair', SocketPairTransport()),
+        ]
+        print(f"Mensagens: {n} x {size} B (cliente -> servidor -> cliente)")
+        print(f"{'transporte':12}{'tempo (s)':>12}{'msg/s':>12}{'µs/msg':>10}")
+        for name, transport in transports:
+            elapsed = bench(transport, n, size)
+            print(f"{name:12}{elapsed:>12.3f}{n / elapsed:>12.0f}{elapsed / n * 1e6:>10.1f}")
+
+    listener.stop()
+
+
+if __name__ == "__main__":
+    main()
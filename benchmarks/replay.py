@@ -0,0 +1,267 @@
+"""
+Replay determinístico de uma captura de tráfego (server.py --capture) para comparar
+versões do servidor com a mesma carga. Cada conexão capturada vira um AsyncClient que
+repete a sua linha do tempo (conexão, frames, desconexão) em 1x ou N vezes a
+velocidade original. As mensagens têm o tamanho das capturadas e levam o instante de
+envio, então o destino mede a latência de entrega.
+
+    uv run python benchmarks/replay.py trafego.jsonl [--speed N] [--output atual.json] [--compare base.json]
+
+Sem --server o replay sobe um servidor local no mesmo processo; com --server HOST:PORTA
+usa um servidor já em execução (ex.: outra versão do código). --speed 0 remove as pausas
+(vazão máxima; destinos ainda não conectados contam como offline).
+
+Só são repetidos os pedidos que não dependem de estado do cliente: send_message,
+get_online_clients, get_history e find_users. Frames E2E, de usuários lógicos e de
+keepalive aparecem em 'skipped'. Uma desconexão espera (até --settle) as mensagens já
+enviadas de e para a conexão chegarem: fechar o socket antes disso descarta frames que
+na captura foram entregues.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from async_client import AsyncClient
+from server import Server
+from server_utils.capture import FRAME_OVERHEAD, load
+from server_utils.log import setup_logging
+from transport import TcpTransport
+
+OFFLINE_TARGET = 0  # Destino fora da captura (ou ainda não conectado no replay)
+SEARCH_QUERY = 'replay'  # Todos os clientes do replay se chamam replay-<conn>
+COMPARED = ('frames_per_s', 'delivered_per_s', 'delivered', 'latency_p50_ms', 'latency_p90_ms',
+            'latency_p99_ms', 'latency_max_ms', 'lag_p99_ms')
+
+
+def quantile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Replay:
+    def __init__(self, events, speed, transport, settle):
+        self.speed = speed
+        self.transport = transport
+        self.settle = settle
+        self.timelines = collections.defaultdict(list)
+        for event in events:
+            self.timelines[event['conn']].append(event)
+        self.origin = events[0]['t'] if events else 0.0
+
+        self.ids = {}         # {client_id capturado: client_id no replay}
+        self.clients = []
+        self.receivers = []
+        self.frames = 0
+        self.messages = 0
+        self.expected = 0     # Mensagens para destinos conectados no replay
+        self.delivered = 0
+        self.outstanding = collections.Counter()  # {client_id no replay: mensagens a caminho, de ou para}
+        self.latencies = []
+        self.lags = []        # Atraso do driver em relação à linha do tempo
+        self.skipped = collections.Counter()
+        self.errors = 0
+        self.start = None
+        self.last_send = None
+        self.last_delivery = None
+
+    async def _wait(self, t):
+        due = self.start + (t - self.origin) / self.speed if self.speed else None
+        if due is not None and due > time.perf_counter():
+            await asyncio.sleep(due - time.perf_counter())
+        else:
+            await asyncio.sleep(0)
+        if due is not None:
+            self.lags.append(max(0.0, time.perf_counter() - due))
+
+    def _content(self, target, size):
+        stamp = f"{time.perf_counter():.9f}|"
+        skeleton = json.dumps({'type': 'send_message', 'target_id': target, 'message': stamp})
+        return stamp + 'x' * max(0, size - FRAME_OVERHEAD - len(skeleton))
+
+    async def _receive(self, client):
+        async for message in client:
+            if message.get('type') != 'message':
+                continue
+            stamp, _, _ = str(message.get('message')).partition('|')
+            try:
+                sent_at = float(stamp)
+            except ValueError:
+                continue
+            self.last_delivery = time.perf_counter()
+            self.latencies.append(self.last_delivery - sent_at)
+            self.delivered += 1
+            self.outstanding[message.get('from_id')] -= 1
+            self.outstanding[client.client_id] -= 1
+
+    async def _run_connection(self, conn, timeline):
+        await self._wait(timeline[0]['t'])
+        client = AsyncClient(f'replay-{conn}', transport=self.transport, reconnect=False)
+        try:
+            await client.connect()
+        except (OSError, ConnectionError):
+            self.errors += 1
+            return
+        self.ids[conn] = client.client_id
+        self.clients.append(client)
+        self.receivers.append(asyncio.create_task(self._receive(client)))
+
+        pending = []
+        for event in timeline:
+            if event['event'] == 'disconnect':
+                await self._wait(event['t'])
+                await asyncio.gather(*pending, return_exceptions=True)
+                await self._settle(lambda: self.outstanding[client.client_id] <= 0)
+                self.clients.remove(client)
+                await client.close()
+                return
+            if event['event'] != 'frame':
+                continue
+            if event['from'] != conn:
+                self.skipped['logical_user'] += 1
+                continue
+            await self._wait(event['t'])
+            # Destino resolvido na hora do envio: pode ter conectado durante o replay
+            request = self._request(client, event)
+            if request is None:
+                self.skipped[event['type']] += 1
+                continue
+            pending.append(asyncio.create_task(request()))
+            self.frames += 1
+            self.last_send = time.perf_counter()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    def _request(self, client, event):
+        """Função que repete o frame capturado, ou None se ele não é repetível."""
+        m_type = event['type']
+        target = self.ids.get(event['target'], OFFLINE_TARGET)
+        if m_type == 'send_message':
+            def send():
+                self.messages += 1
+                if target != OFFLINE_TARGET:
+                    self.expected += 1
+                    self.outstanding[client.client_id] += 1
+                    self.outstanding[target] += 1
+                return client.send(target, self._content(target, event['size']), receipt=event['receipt'])
+            return send
+        if m_type == 'get_online_clients':
+            return client.request_online_clients
+        if m_type == 'get_history':
+            return lambda: client.request_history(target)
+        if m_type == 'find_users':
+            return lambda: client.find_users(SEARCH_QUERY)
+        return None
+
+    async def _settle(self, done):
+        deadline = time.perf_counter() + self.settle
+        while not done() and time.perf_counter() < deadline:
+            await asyncio.sleep(0.005)
+
+    async def run(self):
+        self.start = time.perf_counter()
+        await asyncio.gather(*(self._run_connection(conn, timeline)
+                               for conn, timeline in self.timelines.items() if timeline))
+        # Espera as mensagens em trânsito chegarem (destinos que saíram antes não recebem)
+        await self._settle(lambda: self.delivered >= self.expected)
+        for client in self.clients:
+            await client.close()
+        for receiver in self.receivers:
+            receiver.cancel()
+        await asyncio.gather(*self.receivers, return_exceptions=True)
+
+    def report(self):
+        end = max(filter(None, (self.last_send, self.last_delivery)), default=self.start)
+        elapsed = max(end - self.start, 1e-9)
+        ms = lambda value: round(value * 1000, 3) if value is not None else None
+        return {
+            'speed': self.speed,
+            'connections': len(self.timelines),
+            'frames': self.frames,
+            'messages': self.messages,
+            'expected': self.expected,
+            'delivered': self.delivered,
+            'duration_s': round(elapsed, 3),
+            'frames_per_s': round(self.frames / elapsed, 1),
+            'delivered_per_s': round(self.delivered / elapsed, 1),
+            'latency_p50_ms': ms(quantile(self.latencies, 0.5)),
+            'latency_p90_ms': ms(quantile(self.latencies, 0.9)),
+            'latency_p99_ms': ms(quantile(self.latencies, 0.99)),
+            'latency_max_ms': ms(max(self.latencies, default=None)),
+            'lag_p99_ms': ms(quantile(self.lags, 0.99)),
+            'errors': self.errors,
+            'skipped': dict(self.skipped),
+        }
+
+
+def print_report(report, baseline=None):
+    if baseline is None:
+        for key, value in report.items():
+            print(f"{key:18}{value}")
+        return
+    print(f"{'métrica':18}{'base':>14}{'atual':>14}{'Δ':>10}")
+    for key in COMPARED:
+        old, new = baseline.get(key), report.get(key)
+        delta = f"{(new - old) / old * 100:+.1f}%" if old and new is not None else '-'
+        print(f"{key:18}{str(old):>14}{str(new):>14}{delta:>10}")
+    for key in ('frames', 'errors', 'skipped'):
+        print(f"{key:18}{report[key]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay de uma captura de tráfego do servidor")
+    parser.add_argument('capture', help="Arquivo gravado com server.py --capture")
+    parser.add_argument('--speed', type=float, default=1.0, help="Multiplicador da velocidade (0: sem pausas)")
+    parser.add_argument('--server', metavar='HOST:PORTA', help="Servidor já em execução (padrão: servidor local)")
+    parser.add_argument('--port', type=int, default=5992, help="Porta do servidor local")
+    parser.add_argument('--settle', type=float, default=5.0,
+                        help="Segundos de espera pelas mensagens em trânsito após o último envio")
+    parser.add_argument('--output', help="Grava o relatório em JSON (para --compare de execuções futuras)")
+    parser.add_argument('--compare', help="Relatório JSON de uma execução anterior")
+    args = parser.parse_args()
+
+    listener = setup_logging('ERROR')
+    _, events = load(args.capture)
+    server = None
+    if args.server:
+        host, _, port = args.server.rpartition(':')
+        transport = TcpTransport(host or 'localhost', int(port))
+    else:
+        transport = TcpTransport('127.0.0.1', args.port)
+        # Todas as conexões da captura vêm de 127.0.0.1: sem os limites por IP
+        server = Server(transport=transport, message_rate_per_client=0, message_rate_per_ip=0,
+                        connection_rate_per_ip=0, max_connections_per_ip=None, idle_timeout=0)
+        threading.Thread(target=server.start, daemon=True).start()
+        while not server.accepting:
+            time.sleep(0.01)
+
+    try:
+        replay = Replay(events, args.speed, transport, args.settle)
+        asyncio.run(replay.run())
+    finally:
+        if server is not None:
+            server.close()
+    report = replay.report()
+    report['capture'] = args.capture
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print(f"Captura: {args.capture} ({len(events)} eventos), velocidade {args.speed or 'máxima'}")
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    listener.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Memória por conexão e custo de acesso: dict por cliente (layout antigo) vs ClientSession (__slots__),
+e o custo de guardar os objetos de cifra na sessão (CachedCipherSession, --cache-ciphers).
+
+    uv run python benchmarks/session_memory.py [N]
+"""
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from server_utils.outbound import OutboundQueue
+from server_utils.session import ClientSession, CachedCipherSession
+
+
+def make_dict(i, key_c2s, key_s2c):
+    # O dict por cliente como era antes das sessões com __slots__
+    return {
+        'socket': None,
+        'name': f"user{i}",
+        'key_c2s': key_c2s,
+        'key_s2c': key_s2c,
+        'seq_recv': 0,
+        'seq_send': 0
+    }
+
+
+def make_session(i, key_c2s, key_s2c, session_class=ClientSession):
+    # Sessão como o servidor a guarda (com a fila de saída) depois de trafegar nos dois sentidos
+    session = session_class(i, None, None, f"user{i}", key_c2s, key_s2c)
+    session.outbound = OutboundQueue()
+    session.cipher_c2s, session.cipher_s2c
+    return session
+
+
+def make_cached_session(i, key_c2s, key_s2c):
+    # Com --cache-ciphers os dois objetos AESGCM ficam na sessão
+    return make_session(i, key_c2s, key_s2c, CachedCipherSession)
+
+
+def make_outbound(i, key_c2s, key_s2c):
+    return OutboundQueue()
+
+
+def rss_kb():
+    # /proc só existe no Linux; em outros sistemas a coluna RSS fica vazia
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def measure(factory, n):
+    keys = [(os.urandom(16), os.urandom(16)) for _ in range(n)]
+    rss_before = rss_kb()
+    tracemalloc.start()
+    sessions = {i: factory(i, *keys[i]) for i in range(n)}
+    traced, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_after = rss_kb()
+    rss = (rss_after - rss_before) * 1024 / n if rss_before is not None else None
+    return sessions, traced / n, rss
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+
+    dicts, dict_traced, dict_rss = measure(make_dict, n)
+    sessions, slot_traced, slot_rss = measure(make_session, n)
+    cached, cached_traced, cached_rss = measure(make_cached_session, n)
+    del cached
+    queues, queue_traced, _ = measure(make_outbound, n)
+    del queues
+
+    d, s = dicts[n // 2], sessions[n // 2]
+
+    def dict_access():
+        seq = d['seq_send'] + 1
+        d['seq_send'] = seq
+        return d['key_s2c'], d['socket']
+
+    def slot_access():
+        seq = s.seq_send + 1
+        s.seq_send = seq
+        return s.key_s2c, s.socket
+
+    loops = 1_000_000
+    t_dict = timeit.timeit(dict_access, number=loops) / loops * 1e9
+    t_slot = timeit.timeit(slot_access, number=loops) / loops * 1e9
+
+    key, nonce, payload = os.urandom(16), os.urandom(12), b'x' * 200
+    cipher = AESGCM(key)
+    t_new = timeit.timeit(lambda: AESGCM(key).encrypt(nonce, payload, b''), number=loops // 10) / (loops // 10) * 1e9
+    t_cached = timeit.timeit(lambda: cipher.encrypt(nonce, payload, b''), number=loops // 10) / (loops // 10) * 1e9
+
+    print(f"Sessões: {n}")
+    print(f"{'':26}{'dict':>10}{'slots':>10}{'slots+cache':>14}")
+    print(f"{'tracemalloc (B/sessão)':26}{dict_traced:>10.0f}{slot_traced:>10.0f}{cached_traced:>14.0f}")
+    if dict_rss is not None:
+        print(f"{'RSS (B/sessão)':26}{dict_rss:>10.0f}{slot_rss:>10.0f}{cached_rss:>14.0f}")
+    print(f"{'acesso hot path (ns)':26}{t_dict:>10.1f}{t_slot:>10.1f}")
+    print(f"{'cifrar 200B (ns)':26}{t_new:>10.1f}{t_new:>10.1f}{t_cached:>14.1f}")
+    print(f"{'OutboundQueue ociosa (B)':26}{'':>10}{queue_traced:>10.0f}")
+    print("dict = layout antigo (sem fila de saída); slots = ClientSession com a fila, cifra criada a cada frame;")
+    print("slots+cache = CachedCipherSession (--cache-ciphers), com os dois contextos AESGCM guardados.")
+
+
+if __name__ == "__main__":
+    main()
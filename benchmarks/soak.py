@@ -0,0 +1,212 @@
+"""
+Soak test: milhares de ciclos conexão -> handshake -> mensagens -> desconexão contra um
+Server local, com handshakes que falham no meio (EOF, hello inválido, suite sem
+correspondência). Após cada rodada mede RSS, threads, descritores abertos e o heap
+Python (tracemalloc), e confere que o servidor voltou ao estado vazio.
+
+    uv run python benchmarks/soak.py [--rounds 40] [--clients 50] [--messages 20]
+
+Sai com código 1 se algum recurso cresce de forma sustentada (mediana do último terço
+das rodadas acima da mediana do primeiro terço, descontado o aquecimento, além da
+tolerância), se sobra estado de sessões encerradas no servidor ou se um handshake
+recusado deixa o cliente esperando.
+"""
+import argparse
+import asyncio
+import gc
+import os
+import socket
+import statistics
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from async_client import AsyncClient
+from client import Client
+from server import Server
+from server_utils.log import setup_logging
+from transport import TcpTransport
+
+HOST, PORT = '127.0.0.1', 5993
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # Pico, não o atual
+
+
+def open_fds():
+    for path in ('/proc/self/fd', '/dev/fd'):
+        try:
+            return len(os.listdir(path))
+        except OSError:
+            continue
+    return 0
+
+
+def server_leftovers(server):
+    """Estado que deveria estar vazio sem clientes conectados."""
+    with server.admission_lock:
+        leftovers = {
+            'connections': server.active_connections,
+            'per_ip': len(server.connections_per_ip),
+            'threads': len(server.client_threads),
+        }
+    with server.client_lock:
+        leftovers['sessions'] = len(server.connected_clients)
+        leftovers['names'] = len(server.names)
+    return {key: value for key, value in leftovers.items() if value}
+
+
+# --- Carga ---
+
+async def chat_round(clients, messages):
+    peers = [AsyncClient(f'soak-{i}', transport=TcpTransport(HOST, PORT), reconnect=False) for i in range(clients)]
+    await asyncio.gather(*(peer.connect() for peer in peers))
+    await asyncio.sleep(0.05)  # Registro da sessão no servidor logo após o handshake_response
+    ids = [peer.client_id for peer in peers]
+
+    async def talk(i, peer):
+        target = ids[(i + 1) % len(ids)]
+        for n in range(messages):
+            # O último frame espera o recibo: o caminho completo do relay foi exercitado
+            await peer.send(target, f'soak {n}', receipt=n == messages - 1)
+        await peer.find_users('soak-1')
+
+    async def drain(peer):
+        async for _ in peer:
+            pass
+
+    readers = [asyncio.create_task(drain(peer)) for peer in peers]
+    await asyncio.gather(*(talk(i, peer) for i, peer in enumerate(peers)))
+    for peer in peers:
+        await peer.close()
+    await asyncio.gather(*readers, return_exceptions=True)
+
+
+def failed_handshake(kind, timeout):
+    """Handshake interrompido. Retorna False se o servidor não fechou a conexão a tempo."""
+    sock = socket.create_connection((HOST, PORT))
+    try:
+        if kind == 'eof':
+            return True
+        if kind == 'garbage':
+            payload = b'{not json'
+        else:
+            client = Client(HOST, PORT, cipher_suites=['SOAK_UNKNOWN_SUITE'])
+            client.client_name = 'soak'
+            payload = client._build_hello()[2]
+        sock.sendall(struct.pack('!I', len(payload)) + payload)
+        sock.settimeout(timeout)
+        try:
+            return sock.recv(1) == b''
+        except socket.timeout:
+            return False
+        except OSError:
+            return True  # RST também encerra
+    finally:
+        sock.close()
+
+
+def wait_idle(server, timeout):
+    deadline = time.monotonic() + timeout
+    while server_leftovers(server) and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+# --- Análise ---
+
+def sustained_growth(values, warmup):
+    """Mediana do último terço menos a do primeiro terço, após o aquecimento."""
+    values = values[warmup:]
+    third = max(1, len(values) // 3)
+    return statistics.median(values[-third:]) - statistics.median(values[:third])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Soak test do servidor com detecção de vazamentos")
+    parser.add_argument('--rounds', type=int, default=40)
+    parser.add_argument('--clients', type=int, default=50, help="Conexões completas por rodada")
+    parser.add_argument('--messages', type=int, default=20, help="Mensagens por conexão")
+    parser.add_argument('--failed', type=int, default=5, help="Handshakes interrompidos de cada tipo por rodada")
+    parser.add_argument('--warmup', type=int, default=3, help="Rodadas fora da análise (caches, pools)")
+    parser.add_argument('--rss-mb', type=float, default=16.0, help="Tolerância de crescimento do RSS")
+    parser.add_argument('--heap-mb', type=float, default=2.0, help="Tolerância de crescimento do heap (tracemalloc)")
+    parser.add_argument('--threads', type=int, default=2, help="Tolerância de crescimento de threads")
+    parser.add_argument('--fds', type=int, default=4, help="Tolerância de crescimento de descritores")
+    parser.add_argument('--no-tracemalloc', action='store_true', help="Desliga o tracemalloc (mais rápido)")
+    args = parser.parse_args()
+    if args.rounds < args.warmup + 3:
+        parser.error("--rounds precisa de pelo menos 3 rodadas além do aquecimento")
+
+    listener = setup_logging('CRITICAL')
+    if not args.no_tracemalloc:
+        tracemalloc.start(10)
+    server = Server(transport=TcpTransport(HOST, PORT), message_rate_per_client=0, message_rate_per_ip=0,
+                    connection_rate_per_ip=0, max_connections_per_ip=None, idle_timeout=0,
+                    handshake_timeout=5.0)
+    threading.Thread(target=server.start, daemon=True).start()
+    while not server.accepting:
+        time.sleep(0.01)
+
+    samples = {'rss': [], 'threads': [], 'fds': [], 'heap': []}
+    failures = []
+    first_snapshot = None
+    cycles = 0
+    print(f"{'rodada':>6}{'ciclos':>8}{'RSS MB':>9}{'threads':>9}{'fds':>6}{'heap MB':>9}{'s':>7}")
+    try:
+        for round_no in range(1, args.rounds + 1):
+            start = time.perf_counter()
+            asyncio.run(chat_round(args.clients, args.messages))
+            hung = sum(not failed_handshake(kind, server.handshake_timeout / 2)
+                       for kind in ('eof', 'garbage', 'suite') for _ in range(args.failed))
+            cycles += args.clients + 3 * args.failed
+            if hung:
+                failures.append(f"rodada {round_no}: {hung} handshakes recusados sem fechar a conexão")
+
+            wait_idle(server, 5.0)
+            leftovers = server_leftovers(server)
+            if leftovers:
+                failures.append(f"rodada {round_no}: estado de sessões encerradas no servidor: {leftovers}")
+            gc.collect()
+
+            samples['rss'].append(rss_bytes() / 2**20)
+            samples['threads'].append(threading.active_count())
+            samples['fds'].append(open_fds())
+            samples['heap'].append(tracemalloc.get_traced_memory()[0] / 2**20 if tracemalloc.is_tracing() else 0.0)
+            if round_no == args.warmup and tracemalloc.is_tracing():
+                first_snapshot = tracemalloc.take_snapshot()
+            print(f"{round_no:>6}{cycles:>8}{samples['rss'][-1]:>9.1f}{samples['threads'][-1]:>9}"
+                  f"{samples['fds'][-1]:>6}{samples['heap'][-1]:>9.2f}{time.perf_counter() - start:>7.2f}")
+    finally:
+        server.close()
+
+    limits = {'rss': args.rss_mb, 'threads': args.threads, 'fds': args.fds, 'heap': args.heap_mb}
+    for name, values in samples.items():
+        growth = sustained_growth(values, args.warmup)
+        if growth > limits[name]:
+            failures.append(f"{name}: crescimento sustentado de {growth:.2f} (tolerância {limits[name]})")
+
+    if failures and first_snapshot is not None:
+        print("\nMaiores crescimentos do heap desde o aquecimento:")
+        for stat in tracemalloc.take_snapshot().compare_to(first_snapshot, 'lineno')[:10]:
+            print(f"  {stat}")
+    listener.stop()
+    if failures:
+        print("\nFALHOU:")
+        for failure in failures:
+            print(f"  - {failure}")
+        sys.exit(1)
+    print(f"\nOK: {cycles} ciclos sem crescimento sustentado de memória, threads ou descritores")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,21 @@
-import socket
 import threading
+import time
 import sys
 import json
 import struct
 import base64
 import os
-from cryptography import x509
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.hazmat.primitives.asymmetric import padding
+import argparse
 
 import cryptography_utils.utils as crypto_utils
+from transport import TcpTransport, from_address
 
 class Client:
-    def __init__(self, host='localhost', port=5000):
+    def __init__(self, host='localhost', port=5000, cert_path=crypto_utils.DEFAULT_CERT_PATH, transport=None,
+                 cipher_suites=None):
         self.host = host
         self.port = port
+        self.transport = transport or TcpTransport(host, port)
         self.socket = None
         self.connected = False
         self.client_id = None
@@ -24,71 +24,45 @@ class Client:
         # Estados de Segurança
         self.key_c2s = None # Chave Cliente
         self.key_s2c = None # Chave Servidor
+        # Suites oferecidas no hello; por padrão todas, ordenadas por um benchmark local
+        self.cipher_suites = tuple(cipher_suites or crypto_utils.preferred_suites())
+        self.cipher_suite = None
+        self.cipher_c2s = None # Objetos AEAD da suite negociada
+        self.cipher_s2c = None
         self.seq_send = 0
         self.seq_recv = 0
+        # A thread de recebimento também envia (pong), então seq_send é protegido
+        self.send_lock = threading.Lock()
         
         try:
-            with open("cryptography_utils/server.crt", "rb") as f:
-                self.trusted_cert_bytes = f.read()
-                self.trusted_cert = x509.load_pem_x509_certificate(
-                    self.trusted_cert_bytes, default_backend()
-                )
-                self.server_rsa_public_key = self.trusted_cert.public_key()
+            # Certificado pinado: a chave pública pode ser RSA, ECDSA P-256 ou Ed25519
+            self.trusted_cert_bytes, self.server_public_key = crypto_utils.load_certificate(cert_path)
         except FileNotFoundError:
             print("[ERRO] Arquivo 'server.crt' não encontrado. É necessário para verificar a autenticidade do servidor.")
             sys.exit(1)
 
     def connect(self):
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((self.host, self.port))
+            self.socket = self.transport.connect()
             
             self.client_name = input("Digite seu nome: ").strip() or "Usuario"
             
             #HANDSHAKE SEGURO AGORA!
             print("[SEGURANÇA] Iniciando Handshake seguro...")
             
-            sk_C, pk_C_bytes = crypto_utils.generate_ecdh_pair()
-            
-            hello_payload = json.dumps({
-                "type": "hello", 
-                "name": self.client_name,
-                "public_key": pk_C_bytes.decode('utf-8')
-            }).encode('utf-8')
+            sk_C, pk_C_bytes, hello_payload = self._build_hello()
             self._send_raw_frame(hello_payload)
             
             response_data = self._recv_raw_frame()
             if not response_data:
                 raise Exception("Conexão fechada pelo servidor durante handshake")
             
-            response = json.loads(response_data.decode('utf-8'))
-            
-            # Extrair dados do handshake
-            self.client_id = response['client_id']
-            server_pk_pem = response['public_key'].encode()
-            salt = base64.b64decode(response['salt'])
-            signature = base64.b64decode(response['signature'])
-            
-            # O transcript aqui é simplificado apenas com pk_C para vincular a sessão
-            transcript = pk_C_bytes
-            data_to_verify = server_pk_pem + str(self.client_id).encode() + transcript + salt
-            
-            try:
-                self.server_rsa_public_key.verify(
-                    signature,
-                    data_to_verify,
-                    padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH),
-                    hashes.SHA256()
-                )
-                print("[SEGURANÇA] Assinatura do servidor VÁLIDA. Identidade confirmada.")
-            except Exception as e:
+            if not self._finish_handshake(sk_C, pk_C_bytes, response_data):
                 print(f"[ERRO FATAL] Assinatura do servidor INVÁLIDA! Possível ataque MitM.")
                 return
+            print("[SEGURANÇA] Assinatura do servidor VÁLIDA. Identidade confirmada.")
             
-            shared_secret = crypto_utils.compute_shared_secret(sk_C, server_pk_pem)
-            self.key_c2s, self.key_s2c = crypto_utils.derive_keys(shared_secret, salt)
-            
-            print(f"[CLIENTE] Conectado e Criptografado! Seu ID é {self.client_id}")
+            print(f"[CLIENTE] Conectado e Criptografado ({self.cipher_suite})! Seu ID é {self.client_id}")
             self.connected = True
             
             # Iniciar threads
@@ -104,6 +78,62 @@ class Client:
         finally:
             self.close()
 
+    def _build_hello(self):
+        """Gera o par ECDH efêmero e o payload do hello. Retorna (sk_C, pk_C_bytes, payload)."""
+        sk_C, pk_C_bytes = crypto_utils.generate_ecdh_pair()
+        
+        hello_payload = json.dumps({
+            "type": "hello", 
+            "name": self.client_name,
+            "public_key": pk_C_bytes.decode('utf-8'),
+            # Da mais rápida para a mais lenta nesta máquina; o servidor escolhe
+            "cipher_suites": list(self.cipher_suites)
+        }).encode('utf-8')
+        return sk_C, pk_C_bytes, hello_payload
+
+    def _finish_handshake(self, sk_C, pk_C_bytes, response_data):
+        """
+        Valida a resposta do servidor (assinatura sobre pk_S + client_id + transcript + salt + suites)
+        e deriva as chaves de sessão. Retorna False se a assinatura for inválida.
+        Independe do transporte, então é reutilizado pelo cliente assíncrono.
+        """
+        response = json.loads(response_data.decode('utf-8'))
+        
+        # Extrair dados do handshake
+        client_id = response['client_id']
+        server_pk_pem = response['public_key'].encode()
+        salt = base64.b64decode(response['salt'])
+        signature = base64.b64decode(response['signature'])
+        
+        # O transcript aqui é simplificado apenas com pk_C para vincular a sessão
+        transcript = pk_C_bytes
+        data_to_verify = server_pk_pem + str(client_id).encode() + transcript + salt
+        suite = response.get('cipher_suite')
+        if suite is None:
+            # Servidor sem negociação: AES-128-GCM, assinatura no formato antigo
+            suite = crypto_utils.DEFAULT_SUITE
+        elif suite in self.cipher_suites:
+            data_to_verify += ','.join(self.cipher_suites).encode() + b'|' + suite.encode()
+        else:
+            return False
+        
+        try:
+            crypto_utils.verify_handshake(self.server_public_key, signature, data_to_verify)
+        except Exception:
+            return False
+        
+        shared_secret = crypto_utils.compute_shared_secret(sk_C, server_pk_pem)
+        self.client_id = client_id
+        self.server_epoch = response.get('epoch')
+        self.key_c2s, self.key_s2c = crypto_utils.derive_keys(shared_secret, salt, crypto_utils.suite_key_size(suite))
+        self.cipher_suite = suite
+        self.cipher_c2s = crypto_utils.new_cipher(suite, self.key_c2s)
+        self.cipher_s2c = crypto_utils.new_cipher(suite, self.key_s2c)
+        # Sessão nova: contadores de sequência recomeçam
+        self.seq_send = 0
+        self.seq_recv = 0
+        return True
+
     def receive_messages(self):
         """Recebe e decifra mensagens do servidor."""
         try:
@@ -113,7 +143,7 @@ class Client:
                 
                 try:
                     plaintext, sender_id, target_id, seq = crypto_utils.decrypt_message(
-                        self.key_s2c, encrypted_frame
+                        self.cipher_s2c, encrypted_frame
                     )
                     
                     if seq <= self.seq_recv and self.seq_recv != 0:
@@ -122,6 +152,14 @@ class Client:
                     self.seq_recv = seq
                     
                     message_data = json.loads(plaintext.decode('utf-8'))
+                    
+                    # Keepalive do servidor: responde sem interromper o prompt
+                    if message_data.get('type') == 'ping':
+                        self._send_encrypted_json({'type': 'pong', 'ts': message_data.get('ts')}, 0)
+                        continue
+                    if message_data.get('type') == 'pong':
+                        continue
+                    
                     self._process_message(message_data)
                     
                     print(">> ", end='', flush=True)
@@ -142,8 +180,25 @@ class Client:
             print("\n[CLIENTES ONLINE]")
             for c in data.get('clients', []):
                 print(f"  ID: {c['id']} - Nome: {c['name']}")
+        elif m_type == 'users_found':
+            print(f"\n[BUSCA] '{data['query']}':")
+            for c in data.get('clients', []):
+                print(f"  ID: {c['id']} - Nome: {c['name']}")
+            if not data.get('clients'):
+                print("  Nenhum cliente encontrado.")
+            elif data.get('more'):
+                print("  ... há mais resultados; refine a busca.")
         elif m_type == 'client_joined':
             print(f"\n[NOTIFICAÇÃO] {data['client_name']} (ID: {data['client_id']}) conectou!")
+        elif m_type == 'history':
+            print(f"\n[HISTÓRICO] Conversa com ID {data['with_id']}:")
+            for m in data.get('messages', []):
+                when = time.strftime('%d/%m %H:%M:%S', time.localtime(m['ts']))
+                print(f"  [{when}] {m['from_name']} (ID: {m['from_id']}): {m['message']}")
+            if data.get('before') is not None:
+                print(f"  ... mais antigas: /historico {data['with_id']} {data['before']}")
+        elif m_type == 'server_draining':
+            print(f"\n[AVISO] Servidor reiniciando. Reconecte em {data.get('reconnect_after', 0)}s.")
         elif m_type == 'error':
             print(f"\n[ERRO SERVIDOR] {data.get('message')}")
 
@@ -151,7 +206,9 @@ class Client:
         print("\n" + "=" * 60)
         print("COMANDOS SEGUROS:")
         print("  /listar - Ver quem está online")
+        print("  /buscar <nome> - Buscar clientes pelo início do nome")
         print("  /enviar <ID> <msg> - Enviar mensagem cifrada")
+        print("  /historico <ID> - Ver mensagens anteriores com um cliente")
         print("  /sair - Desconectar")
         print("=" * 60)
         print(">> ", end='', flush=True)
@@ -187,6 +244,18 @@ class Client:
                     else:
                         print("Uso: /enviar <ID> <mensagem>")
                 
+                elif user_input.lower().startswith('/buscar '):
+                    payload = {"type": "find_users", "query": user_input.split(' ', 1)[1]}
+                
+                elif user_input.lower().startswith('/historico '):
+                    parts = user_input.split()
+                    try:
+                        payload = {"type": "get_history", "with_id": int(parts[1])}
+                        if len(parts) > 2:
+                            payload["before"] = int(parts[2])
+                    except ValueError:
+                        print("Uso: /historico <ID> [cursor]")
+                
                 if payload:
                     self._send_encrypted_json(payload, target_header_id)
                 
@@ -200,13 +269,14 @@ class Client:
     def _send_encrypted_json(self, data_dict, target_id):
         json_bytes = json.dumps(data_dict).encode('utf-8')
         
-        self.seq_send += 1
-        
-        encrypted_frame = crypto_utils.encrypt_message(
-            self.key_c2s, json_bytes, self.client_id, target_id, self.seq_send
-        )
-        
-        self._send_raw_frame(encrypted_frame)
+        with self.send_lock:
+            self.seq_send += 1
+            
+            encrypted_frame = crypto_utils.encrypt_message(
+                self.cipher_c2s, json_bytes, self.client_id, target_id, self.seq_send
+            )
+            
+            self._send_raw_frame(encrypted_frame)
 
     def _send_raw_frame(self, data):
         """Envia dados com prefixo de tamanho (4 bytes)."""
@@ -236,5 +306,16 @@ class Client:
             except: pass
 
 if __name__ == "__main__":
-    client = Client()
+    parser = argparse.ArgumentParser(description="Cliente de chat seguro")
+    parser.add_argument('host', nargs='?', default='localhost')
+    parser.add_argument('port', nargs='?', type=int, default=5000)
+    parser.add_argument('--unix', metavar='PATH', help="Conecta por socket de domínio Unix em vez de TCP")
+    parser.add_argument('--cipher-suite', action='append', dest='cipher_suites',
+                        choices=sorted(crypto_utils.CIPHER_SUITES),
+                        help="Suite de cifra oferecida, em ordem de preferência (padrão: benchmark local)")
+    parser.add_argument('--cert', default=crypto_utils.DEFAULT_CERT_PATH, help="Certificado pinado do servidor")
+    args = parser.parse_args()
+
+    client = Client(args.host, args.port, cert_path=args.cert, transport=from_address(args.host, args.port, args.unix),
+                    cipher_suites=args.cipher_suites)
     client.connect()
\ No newline at end of file
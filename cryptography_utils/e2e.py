@@ -0,0 +1,215 @@
+import base64
+import struct
+
+# Como em utils.py, os módulos do cryptography são importados no primeiro uso: o servidor
+# importa este módulo só por SEALED_FLAG/peek_address e nunca abre um frame selado.
+# Modo fim a fim (E2E): o servidor só repassa o payload selado, sem decifrar.
+#
+# Cada cliente publica um bundle: chave de identidade X25519 + prekeys de uso único.
+# Para falar com B, A busca o bundle de B (o servidor entrega uma prekey por pedido)
+# e deriva a chave da sessão A->B no estilo X3DH, com uma chave efêmera E_A:
+#     DH(IK_A, PK_B) || DH(E_A, IK_B) || DH(E_A, OPK_B)
+# onde PK_B é a prekey (OPK_B) ou, se o estoque acabou, a própria identidade de B.
+#
+# Frame selado (prefixo de tamanho com o bit SEALED_FLAG ligado):
+#     remetente(16) | destino(16) | versão(1) | prekey_id(4) | E_A(32) | IK_A(32) | contador(8) | ciphertext
+# Os dados de abertura da sessão vão em todo frame: o destino deriva a chave na primeira
+# mensagem que receber e reaproveita depois. Tudo antes do ciphertext é AAD; o nonce é o
+# contador, único por chave. O servidor confere o remetente e roteia pelo destino.
+#
+# A chave de identidade de cada peer é fixada no primeiro contato (bundle buscado ou
+# primeiro frame autêntico recebido): um bundle ou frame com outra identidade para o
+# mesmo client_id é recusado. A impressão digital fixada fica disponível para a
+# conferência fora de banda (peer_fingerprint). Os client_id só valem dentro de uma
+# época do servidor (a cada partida, sem histórico, eles recomeçam): as fixações são
+# descartadas quando a reconexão cai em outra época.
+
+SEALED_FLAG = 0x80000000
+VERSION = 1
+ADDRESS = struct.Struct('!16s16s')
+PREAMBLE = struct.Struct('!BI32s32sQ')
+INFO = b'chat-e2e-v1'
+
+
+def _raw(public_key):
+    from cryptography.hazmat.primitives import serialization
+    return public_key.public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+
+
+def _b64(data):
+    return base64.b64encode(data).decode('utf-8')
+
+
+def _derive(dh, identity_a, identity_b, ephemeral):
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=INFO + identity_a + identity_b + ephemeral,
+    ).derive(dh)
+
+
+def peek_address(frame):
+    """(remetente, destino) de um frame selado; é tudo o que o servidor lê."""
+    sender, target = ADDRESS.unpack_from(frame)
+    return int.from_bytes(sender, 'big'), int.from_bytes(target, 'big')
+
+
+def fingerprint(identity_key):
+    """Impressão digital da chave de identidade, para conferência fora de banda."""
+    from cryptography.hazmat.primitives import hashes
+    digest = hashes.Hash(hashes.SHA256())
+    digest.update(identity_key)
+    return digest.finalize()[:10].hex(' ', 2)
+
+
+class _Outgoing:
+    __slots__ = ('preamble_fields', 'aead', 'counter', 'sender_id')
+
+    def __init__(self, preamble_fields, key, sender_id):
+        self.preamble_fields = preamble_fields  # (prekey_id, E_A, IK_A)
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        self.aead = AESGCM(key)
+        self.counter = 0
+        self.sender_id = sender_id
+
+
+class E2EIdentity:
+    """Chaves E2E de um cliente: identidade, prekeys privadas e sessões com os peers."""
+
+    def __init__(self):
+        from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+        self._identity = X25519PrivateKey.generate()
+        self.identity_key = _raw(self._identity.public_key())
+        self._prekeys = {}
+        self._next_prekey = 1
+        self._peers = {}     # {peer_id: (IK_B, OPK_B ou None, prekey_id)} do último bundle
+        self._pinned = {}    # {peer_id: IK} fixada no primeiro contato
+        self._outgoing = {}  # {peer_id: _Outgoing}
+        self._incoming = {}  # {peer_id: [E_A, AESGCM, último contador]}
+        self._epoch = None   # época do servidor a que os peer_id acima se referem
+
+    # --- Bundle ---
+
+    def prekey_bundle(self, count):
+        """Gera `count` prekeys novas; retorna o pedido 'publish_prekeys'."""
+        from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+        prekeys = []
+        for _ in range(count):
+            prekey_id = self._next_prekey
+            self._next_prekey += 1
+            private = X25519PrivateKey.generate()
+            self._prekeys[prekey_id] = private
+            prekeys.append({'id': prekey_id, 'key': _b64(_raw(private.public_key()))})
+        return {'type': 'publish_prekeys', 'identity_key': _b64(self.identity_key), 'prekeys': prekeys}
+
+    def reset_sessions(self, epoch=None):
+        """
+        Novo client_id (reconexão): sessões, prekeys publicadas e bundles ficaram com a
+        sessão antiga. Se a época do servidor mudou, os IDs fixados podem ser de outra pessoa.
+        """
+        self._outgoing.clear()
+        self._incoming.clear()
+        self._prekeys.clear()
+        self._peers.clear()
+        if epoch != self._epoch:
+            if self._epoch is not None:
+                self._pinned.clear()
+            self._epoch = epoch
+
+    def knows(self, peer_id):
+        """Já temos o bundle deste peer?"""
+        return peer_id in self._peers
+
+    def peer_fingerprint(self, peer_id):
+        """Impressão digital da identidade fixada para o peer (None se ainda não houve contato)."""
+        identity = self._pinned.get(peer_id)
+        return fingerprint(identity) if identity is not None else None
+
+    def _check_pin(self, peer_id, identity):
+        pinned = self._pinned.get(peer_id)
+        if pinned is not None and pinned != identity:
+            raise ValueError(f"Chave de identidade de {peer_id} diferente da fixada")
+
+    def add_peer(self, bundle):
+        """Registra o bundle de um peer (resposta 'prekey_bundle'); levanta ValueError se a identidade mudou."""
+        peer_id = bundle['client_id']
+        identity = base64.b64decode(bundle['identity_key'])
+        self._check_pin(peer_id, identity)
+        self._pinned[peer_id] = identity
+        prekey = bundle.get('prekey')
+        self._peers[peer_id] = (
+            identity,
+            base64.b64decode(prekey['key']) if prekey else None,
+            prekey['id'] if prekey else 0,
+        )
+        self._outgoing.pop(peer_id, None)
+
+    # --- Selar / abrir ---
+
+    def seal(self, sender_id, target_id, plaintext):
+        session = self._outgoing.get(target_id)
+        if session is None or session.sender_id != sender_id:
+            session = self._outgoing[target_id] = self._start(sender_id, target_id)
+        session.counter += 1
+        address = ADDRESS.pack(sender_id.to_bytes(16, 'big'), target_id.to_bytes(16, 'big'))
+        header = address + PREAMBLE.pack(VERSION, *session.preamble_fields, session.counter)
+        nonce = session.counter.to_bytes(12, 'big')
+        return header + session.aead.encrypt(nonce, plaintext, header)
+
+    def _start(self, sender_id, target_id):
+        from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+        identity_b, prekey_b, prekey_id = self._peers[target_id]
+        if prekey_b:
+            # Prekey de uso único: sessões seguintes (ex.: após reconexão) usam só a identidade
+            self._peers[target_id] = (identity_b, None, 0)
+        ephemeral = X25519PrivateKey.generate()
+        ephemeral_pub = _raw(ephemeral.public_key())
+        pk_b = X25519PublicKey.from_public_bytes(prekey_b or identity_b)
+        dh = self._identity.exchange(pk_b) + ephemeral.exchange(X25519PublicKey.from_public_bytes(identity_b))
+        if prekey_b:
+            dh += ephemeral.exchange(pk_b)
+        key = _derive(dh, self.identity_key, identity_b, ephemeral_pub)
+        return _Outgoing((prekey_id, ephemeral_pub, self.identity_key), key, sender_id)
+
+    def open(self, frame, own_id):
+        """Abre um frame selado. Retorna (remetente, plaintext); levanta exceção se inválido."""
+        sender_id, target_id = peek_address(frame)
+        if target_id != own_id:
+            raise ValueError("Frame selado para outro destino")
+        offset = ADDRESS.size + PREAMBLE.size
+        version, prekey_id, ephemeral_pub, identity_a, counter = PREAMBLE.unpack_from(frame, ADDRESS.size)
+        if version != VERSION:
+            raise ValueError(f"Versão E2E desconhecida: {version}")
+        self._check_pin(sender_id, identity_a)
+
+        session = self._incoming.get(sender_id)
+        new_session = session is None or session[0] != ephemeral_pub
+        if new_session:
+            session = self._accept(prekey_id, ephemeral_pub, identity_a)
+        if counter <= session[2]:
+            raise ValueError("Frame selado repetido")
+        plaintext = session[1].decrypt(counter.to_bytes(12, 'big'), frame[offset:], frame[:offset])
+        session[2] = counter
+        if new_session:
+            # Só um frame autêntico estabelece a sessão e consome a prekey
+            self._incoming[sender_id] = session
+            self._prekeys.pop(prekey_id, None)
+            self._pinned.setdefault(sender_id, identity_a)
+        return sender_id, plaintext
+
+    def _accept(self, prekey_id, ephemeral_pub, identity_a):
+        from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PublicKey
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        ephemeral = X25519PublicKey.from_public_bytes(ephemeral_pub)
+        identity_peer = X25519PublicKey.from_public_bytes(identity_a)
+        prekey = self._prekeys.get(prekey_id) if prekey_id else None
+        if prekey_id and prekey is None:
+            raise ValueError(f"Prekey {prekey_id} desconhecida ou já usada")
+        dh = (prekey or self._identity).exchange(identity_peer) + self._identity.exchange(ephemeral)
+        if prekey is not None:
+            dh += prekey.exchange(ephemeral)
+        key = _derive(dh, identity_a, self.identity_key, ephemeral_pub)
+        return [ephemeral_pub, AESGCM(key), 0]
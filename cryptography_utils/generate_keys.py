@@ -1,16 +1,38 @@
 from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import rsa, ec, ed25519
 from cryptography import x509
 from cryptography.x509.oid import NameOID
 from cryptography.hazmat.primitives import hashes
+import argparse
 import datetime
+import os
 
-private_key = rsa.generate_private_key(
-    public_exponent=65537,
-    key_size=2048,
-)
+# Ed25519 e ECDSA P-256 assinam bem mais rápido que RSA-2048, reduzindo o custo
+# por handshake no servidor; RSA continua o padrão por compatibilidade.
+parser = argparse.ArgumentParser(description="Gera a chave privada e o certificado autoassinado do servidor")
+parser.add_argument('--algorithm', choices=['rsa', 'ecdsa', 'ed25519'], default='rsa')
+parser.add_argument('--rsa-bits', type=int, default=2048)
+parser.add_argument('--out-dir', default=os.path.dirname(os.path.abspath(__file__)),
+                    help="Diretório de saída (padrão: cryptography_utils/)")
+args = parser.parse_args()
 
-with open("server_private_key.pem", "wb") as f:
+if args.algorithm == 'ed25519':
+    private_key = ed25519.Ed25519PrivateKey.generate()
+    signature_hash = None  # Ed25519 não usa hash externo
+elif args.algorithm == 'ecdsa':
+    private_key = ec.generate_private_key(ec.SECP256R1())
+    signature_hash = hashes.SHA256()
+else:
+    private_key = rsa.generate_private_key(
+        public_exponent=65537,
+        key_size=args.rsa_bits,
+    )
+    signature_hash = hashes.SHA256()
+
+key_path = os.path.join(args.out_dir, "server_private_key.pem")
+cert_path = os.path.join(args.out_dir, "server.crt")
+
+with open(key_path, "wb") as f:
     f.write(private_key.private_bytes(
         encoding=serialization.Encoding.PEM,
         format=serialization.PrivateFormat.PKCS8,
@@ -22,6 +44,7 @@ subject = issuer = x509.Name([
     x509.NameAttribute(NameOID.COMMON_NAME, u"ServidorChatSeguro"),
 ])
 
+now = datetime.datetime.now(datetime.timezone.utc)
 cert = x509.CertificateBuilder().subject_name(
     subject
 ).issuer_name(
@@ -31,15 +54,15 @@ cert = x509.CertificateBuilder().subject_name(
 ).serial_number(
     x509.random_serial_number()
 ).not_valid_before(
-    datetime.datetime.utcnow()
+    now
 ).not_valid_after(
-    datetime.datetime.utcnow() + datetime.timedelta(days=365) # Válido por 1 ano
+    now + datetime.timedelta(days=365) # Válido por 1 ano
 ).add_extension(
     x509.BasicConstraints(ca=True, path_length=None), critical=True,
-).sign(private_key, hashes.SHA256())
+).sign(private_key, signature_hash)
 
 # Salvar certificado
-with open("server.crt", "wb") as f:
+with open(cert_path, "wb") as f:
     f.write(cert.public_bytes(serialization.Encoding.PEM))
 
-print("Chaves geradas: server_private_key.pem e server.crt")
\ No newline at end of file
+print(f"Chaves geradas ({args.algorithm}): {key_path} e {cert_path}")
@@ -1,11 +1,80 @@
 import os
-from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.hazmat.primitives.kdf.hkdf import HKDF
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+import functools
+import time
+
+# Os módulos do cryptography (ec, serialization, HKDF, AEAD) são importados no primeiro
+# uso: importá-los custa dezenas de ms, pagos só por quem chega ao handshake (e não,
+# por exemplo, por um `--help` ou por ferramentas que só leem as constantes daqui).
+# Caminhos padrão, relativos ao diretório deste módulo (independe do cwd)
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_PRIVATE_KEY_PATH = os.path.join(_BASE_DIR, "server_private_key.pem")
+DEFAULT_CERT_PATH = os.path.join(_BASE_DIR, "server.crt")
+
+# --- Chaves de longo prazo do servidor (RSA, ECDSA P-256 ou Ed25519) ---
+def load_private_key(path=DEFAULT_PRIVATE_KEY_PATH):
+    """Carrega a chave privada PEM do servidor (cacheada por caminho + mtime)."""
+    return _load_private_key_cached(os.path.abspath(path), os.stat(path).st_mtime_ns)
+
+@functools.lru_cache(maxsize=8)
+def _load_private_key_cached(path, mtime_ns):
+    from cryptography.hazmat.primitives import serialization
+    with open(path, "rb") as key_file:
+        return serialization.load_pem_private_key(key_file.read(), password=None)
+
+def load_certificate(path=DEFAULT_CERT_PATH):
+    """
+    Lê o certificado X.509 e retorna (cert_pem, chave_pública).
+    O módulo x509 só é importado aqui: o servidor apenas repassa o PEM e não paga esse custo.
+    """
+    return _load_certificate_cached(os.path.abspath(path), os.stat(path).st_mtime_ns)
+
+@functools.lru_cache(maxsize=8)
+def _load_certificate_cached(path, mtime_ns):
+    from cryptography import x509
+    with open(path, "rb") as cert_file:
+        cert_pem = cert_file.read()
+    cert = x509.load_pem_x509_certificate(cert_pem)
+    return cert_pem, cert.public_key()
+
+def sign_handshake(private_key, data):
+    """Assina os parâmetros do handshake conforme o tipo da chave do servidor."""
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import ec, rsa, ed25519, padding
+    if isinstance(private_key, ed25519.Ed25519PrivateKey):
+        return private_key.sign(data)
+    if isinstance(private_key, ec.EllipticCurvePrivateKey):
+        return private_key.sign(data, ec.ECDSA(hashes.SHA256()))
+    if isinstance(private_key, rsa.RSAPrivateKey):
+        return private_key.sign(
+            data,
+            padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH),
+            hashes.SHA256()
+        )
+    raise TypeError(f"Tipo de chave não suportado: {type(private_key).__name__}")
+
+def verify_handshake(public_key, signature, data):
+    """Verifica a assinatura do handshake. Levanta InvalidSignature se inválida."""
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import ec, rsa, ed25519, padding
+    if isinstance(public_key, ed25519.Ed25519PublicKey):
+        public_key.verify(signature, data)
+    elif isinstance(public_key, ec.EllipticCurvePublicKey):
+        public_key.verify(signature, data, ec.ECDSA(hashes.SHA256()))
+    elif isinstance(public_key, rsa.RSAPublicKey):
+        public_key.verify(
+            signature,
+            data,
+            padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH),
+            hashes.SHA256()
+        )
+    else:
+        raise TypeError(f"Tipo de chave não suportado: {type(public_key).__name__}")
+
 
 def generate_ecdh_pair():
     """Gera par de chaves efêmeras (ECDHE)"""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
     private_key = ec.generate_private_key(ec.SECP256R1())
     public_key_bytes = private_key.public_key().public_bytes(
         encoding=serialization.Encoding.PEM,
@@ -15,37 +84,98 @@ def generate_ecdh_pair():
 
 def compute_shared_secret(private_key, peer_public_key_bytes):
     """Calcula o segredo Z"""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
     peer_public_key = serialization.load_pem_public_key(peer_public_key_bytes)
     shared_secret = private_key.exchange(ec.ECDH(), peer_public_key)
     return shared_secret
 
 # --- HKDF (Derivação de Chaves) ---
-def derive_keys(shared_secret, salt):
+def derive_keys(shared_secret, salt, key_size=16):
     """
-    Deriva chaves no estilo TLS 1.3
+    Deriva chaves no estilo TLS 1.3. `key_size` vem da suite negociada (16 = AES-128).
     """
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
     hkdf = HKDF(
         algorithm=hashes.SHA256(),
-        length=32,
+        length=2 * key_size,
         salt=salt,
         info=b"handshake data",
     )
 
     key_material = hkdf.derive(shared_secret)
 
-    key_c2s = key_material[:16]
-    key_s2c = key_material[16:]
+    key_c2s = key_material[:key_size]
+    key_s2c = key_material[key_size:]
 
     return key_c2s, key_s2c
 
+# --- Suites de cifra (AEAD) ---
+# Todas usam nonce de 12 bytes e tag de 16, então o formato do frame não muda.
+# Sem a cipher_suites no hello (clientes antigos) a sessão usa DEFAULT_SUITE.
+# Valores: (classe AEAD em cryptography.hazmat.primitives.ciphers.aead, tamanho da chave)
+CIPHER_SUITES = {
+    'AES_128_GCM': ('AESGCM', 16),
+    'AES_256_GCM': ('AESGCM', 32),
+    'CHACHA20_POLY1305': ('ChaCha20Poly1305', 32),
+}
+DEFAULT_SUITE = 'AES_128_GCM'
+
+def suite_key_size(suite):
+    return CIPHER_SUITES[suite][1]
+
+def new_cipher(suite, key):
+    """Objeto AEAD da suite; reutilizável por toda a sessão."""
+    from cryptography.hazmat.primitives.ciphers import aead
+    return getattr(aead, CIPHER_SUITES[suite][0])(key)
+
+def benchmark_suites(suites=None, size=1024, duration=0.02):
+    """
+    Vazão local (bytes/s de cifrar + decifrar frames de `size` bytes) de cada suite.
+    Sem aceleração de AES no processador o ChaCha20-Poly1305 costuma ser bem mais
+    rápido; com AES-NI o AES-GCM ganha. Suites que o OpenSSL não oferece ficam de fora.
+    """
+    from cryptography.exceptions import UnsupportedAlgorithm
+    results = {}
+    nonce = bytes(12)
+    data = os.urandom(size)
+    for suite in suites or CIPHER_SUITES:
+        try:
+            cipher = new_cipher(suite, os.urandom(suite_key_size(suite)))
+        except UnsupportedAlgorithm:
+            continue
+        rounds = 0
+        start = time.perf_counter()
+        deadline = start + duration
+        while True:
+            cipher.decrypt(nonce, cipher.encrypt(nonce, data, None), None)
+            rounds += 1
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+        results[suite] = rounds * size / (now - start)
+    return results
+
+@functools.lru_cache(maxsize=1)
+def preferred_suites():
+    """Suites disponíveis, da mais rápida para a mais lenta nesta máquina (medido uma vez)."""
+    speeds = benchmark_suites()
+    return tuple(sorted(speeds, key=speeds.get, reverse=True))
+
+# --- Cifragem dos frames ---
+def _aesgcm(key):
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    return AESGCM(key)
 
-# --- AES-GCM ---
 def encrypt_message(key, plaintext_bytes, sender_id, target_id, seq_no):
     """
     Header: [Nonce (12B)] + [SenderID (16B)] + [TargetID (16B)] + [SeqNo (8B)]
+    `key` pode ser a chave AES-128 (bytes) ou o objeto AEAD da suite negociada
+    (ver new_cipher), reutilizado por sessão.
     """
-    aesgcm = AESGCM(key)
+    aesgcm = _aesgcm(key) if isinstance(key, bytes) else key
     nonce = os.urandom(12)
     
     # IDs convertidos para 16 bytes (big-endian)
@@ -81,7 +211,7 @@ def decrypt_message(key, data_bytes):
     seq_no = int.from_bytes(seq_bytes, 'big')
     
     aad = sender_bytes + target_bytes + seq_bytes
-    aesgcm = AESGCM(key)
+    aesgcm = _aesgcm(key) if isinstance(key, bytes) else key
     
     plaintext = aesgcm.decrypt(nonce, ciphertext, aad)
     return plaintext, sender_id, target_id, seq_no
\ No newline at end of file
@@ -4,51 +4,299 @@ import sys
 import json
 import struct
 import base64
-from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.hazmat.primitives.asymmetric import padding
 import os
+import time
+import random
+import signal
+import argparse
+import heapq
+from concurrent.futures import ThreadPoolExecutor
 
 import cryptography_utils.utils as crypto_utils
+from cryptography_utils.e2e import SEALED_FLAG, peek_address
+from transport import TcpTransport, from_address
+from server_utils.metrics import ServerMetrics, TimedLock, start_metrics_server
+from server_utils.log import get_logger, setup_logging, parse_sample_rates
+from server_utils.tracing import Tracer, SamplingProfiler, install_signal_handlers
+from server_utils.timer_wheel import TimerWheel
+from server_utils.ratelimit import KeyedRateLimiter
+from server_utils import handoff
+from server_utils.keypool import EphemeralKeyPool
+from server_utils.session import ClientSession, CachedCipherSession, LogicalUser, PrekeyBundle
+from server_utils.receipts import ReceiptBatch
+from server_utils.cluster import Cluster, MAX_NODES, load_secret
+from server_utils.history import MessageLog, load_storage_key
+from server_utils.directory import NameIndex
+from server_utils.capture import TrafficCapture
+from server_utils.outbound import OutboundQueue, OutboundFrame, CONTROL, INTERACTIVE, BULK, CLASS_NAMES, DEFAULT_WEIGHTS, check_weights
+from server_utils.pipeline import DecryptPool, ReceivePipeline, AVAILABLE as PIPELINE_AVAILABLE
+
+HISTORY_PAGE_MAX = 100
+DIRECTORY_RESULTS_MAX = 50  # Clientes por resposta de 'find_users'
+PREKEY_MAX = 200  # Prekeys E2E guardadas por cliente
+PREKEY_LOW = 5    # Abaixo disso o dono é avisado para publicar mais
+OUTBOUND_BUDGET = 64  # Frames que uma thread escreve para outra conexão antes de passar a vez
+DRAIN_FLUSH_TIMEOUT = 2.0  # Segundos para esvaziar as filas de saída antes de derrubar as sessões
+RELAY_FLUSH_WORKERS = 4  # Threads que escrevem as mensagens vindas de outros nós do cluster
+DEFAULT_HISTORY_KEY_PATH = os.path.join(os.path.dirname(crypto_utils.DEFAULT_PRIVATE_KEY_PATH), 'history.key')
+
+log = get_logger()
 
 class Server:
-    def __init__(self, host='localhost', port=5000):
+    def __init__(self, host='localhost', port=5000, metrics_port=None, metrics_host='127.0.0.1',
+                 trace=False, trace_sample_rate=100, trace_file='trace.jsonl',
+                 idle_timeout=90.0, ping_interval=30.0, handshake_timeout=10.0, keepalive_tick=1.0,
+                 backlog=128, max_connections=10000, max_connections_per_ip=100,
+                 connection_rate_per_ip=20.0, message_rate_per_client=200.0, message_rate_per_ip=1000.0,
+                 handoff_path=None, takeover_path=None, drain_timeout=30.0, reconnect_jitter=5.0,
+                 max_users_per_connection=10000,
+                 key_path=crypto_utils.DEFAULT_PRIVATE_KEY_PATH, cert_path=crypto_utils.DEFAULT_CERT_PATH,
+                 ecdh_pool_size=64, receipt_batch=64, receipt_delay=0.05, transport=None,
+                 node_id=None, cluster_address=None, cluster_peers=None, cluster_secret=None,
+                 history_dir=None, history_key_path=DEFAULT_HISTORY_KEY_PATH, history_retention=30 * 24 * 3600.0,
+                 history_segment_size=64 * 1024 * 1024, history_sync_interval=1.0, history_compact_interval=3600.0,
+                 cipher_suites=None, cipher_slowdown_limit=4.0, decrypt_workers=None, pipeline_window=32,
+                 outbound_weights=DEFAULT_WEIGHTS, outbound_quantum=4096, outbound_max_bytes=8 * 1024 * 1024,
+                 bulk_threshold=16 * 1024, notsent_lowat=128 * 1024, capture_path=None, cache_ciphers=False):
         self.host = host
         self.port = port
+        # TCP por padrão; UnixTransport/SocketPairTransport em transport.py
+        self.transport = transport or TcpTransport(host, port)
         self.server_socket = None
-        # Estrutura: {client_id: {'socket': sock, 'name': name, 'keys': (c2s, s2c), 'seq_recv': 0, 'seq_send': 0}}
+        # Estrutura: {client_id: ClientSession | LogicalUser} (ver server_utils/session.py)
         self.connected_clients = {}
-        self.client_lock = threading.Lock()
+        # Índice de nomes de connected_clients, atualizado sob client_lock (busca 'find_users')
+        self.names = NameIndex()
+        self.metrics = ServerMetrics()
+        self.metrics.connected_clients.set_function(lambda: len(self.connected_clients))
+        self.client_lock = TimedLock(self.metrics.lock_wait_seconds)
         self.client_id_counter = 0
+        # Muda a cada partida: sem histórico os IDs recomeçam do zero, e os clientes E2E
+        # descartam as identidades fixadas por ID quando veem outra época
+        self.epoch = os.urandom(8).hex()
+
+        # Endpoint /metrics (desabilitado quando metrics_port é None)
+        self.metrics_host = metrics_host
+        self.metrics_port = metrics_port
+        self.metrics_httpd = None
+
+        # Tracing por estágio (opcional; desabilitado não custa nada no hot path)
+        self.tracer = Tracer(self.metrics.registry, enabled=trace,
+                             sample_rate=trace_sample_rate, trace_file=trace_file)
+
+        # Keepalive: ping após `ping_interval` sem tráfego, desconexão após `idle_timeout`.
+        # idle_timeout=None (ou 0) desabilita o reaper.
+        self.idle_timeout = idle_timeout or None
+        self.ping_interval = min(ping_interval, idle_timeout) if idle_timeout else ping_interval
+        self.handshake_timeout = handshake_timeout
+        self.timer_wheel = TimerWheel(tick=keepalive_tick)
+        self.reaped_clients = self.metrics.registry.counter('chat_reaped_clients_total', 'Sessões encerradas por inatividade')
+        self.pings_sent = self.metrics.registry.counter('chat_pings_sent_total', 'Pings de keepalive enviados')
+
+        # Controle de admissão (aplicado no accept, antes do handshake RSA) e rate limiting.
+        # Limites None desabilitam a verificação correspondente; bursts são 2x a taxa.
+        self.backlog = backlog
+        self.max_connections = max_connections
+        self.max_connections_per_ip = max_connections_per_ip
+        self.admission_lock = threading.Lock()
+        self.active_connections = 0
+        self.connections_per_ip = {}
+        self.connection_limiter = KeyedRateLimiter(connection_rate_per_ip, 2 * connection_rate_per_ip) if connection_rate_per_ip else None
+        self.client_limiter = KeyedRateLimiter(message_rate_per_client, 2 * message_rate_per_client) if message_rate_per_client else None
+        self.ip_limiter = KeyedRateLimiter(message_rate_per_ip, 2 * message_rate_per_ip) if message_rate_per_ip else None
+        self.rejected_connections = self.metrics.registry.counter('chat_rejected_connections_total', 'Conexões recusadas pelo controle de admissão')
+        self.rate_limited_frames = self.metrics.registry.counter('chat_rate_limited_frames_total', 'Frames descartados por rate limiting')
+
+        # Encerramento gracioso: drenagem das sessões e passagem do socket de escuta
+        # para um novo processo (handoff_path no antigo, takeover_path no novo).
+        self.accepting = False
+        self.draining = False
+        self.drain_done = threading.Event()
+        self.drain_timeout = drain_timeout
+        self.reconnect_jitter = reconnect_jitter
+        self.handoff_path = handoff_path
+        self.takeover_path = takeover_path
+        self.client_threads = set()
+
+        # Multiplexação: limite de identidades lógicas por conexão autenticada
+        self.max_users_per_connection = max_users_per_connection
+
+        # Pares ECDH efêmeros pré-gerados: o handshake paga só assinatura + exchange
+        self.ecdh_pool = EphemeralKeyPool(
+            ecdh_pool_size,
+            hits=self.metrics.registry.counter('chat_ecdh_pool_hits_total', 'Handshakes atendidos pelo pool de chaves ECDH'),
+            misses=self.metrics.registry.counter('chat_ecdh_pool_misses_total', 'Handshakes que geraram o par ECDH na hora'),
+        ) if ecdh_pool_size else None
+        self.metrics.registry.gauge('chat_ecdh_pool_size', 'Pares ECDH disponíveis no pool',
+                                    fn=lambda: self.ecdh_pool.available() if self.ecdh_pool else 0)
+
+        # Recibos de entrega (opt-in por mensagem com 'receipt': true): acumulados por
+        # sessão e enviados como intervalos de seq a cada `receipt_delay` segundos
+        # ou assim que `receipt_batch` resultados estiverem pendentes.
+        self.receipt_batch = receipt_batch
+        self.receipt_delay = receipt_delay
+        self.receipt_lock = threading.Lock()
+        self.pending_receipts = set()
+        self.receipts_sent = self.metrics.registry.counter('chat_receipts_sent_total', 'Frames de recibo de entrega enviados')
+        self.undelivered_messages = self.metrics.registry.counter('chat_undelivered_messages_total', 'Mensagens não entregues (destino offline ou falha de envio)')
+
+        # Modo cluster (node_id definido): diretório compartilhado e encaminhamento entre nós
+        self.node_id = node_id
+        self.cluster = None
+        self.relay_flusher = None
+        if node_id is not None:
+            # A thread de leitura de um link não escreve nos sockets dos clientes: um destino
+            # lento pararia todas as mensagens vindas daquele nó
+            self.relay_flusher = ThreadPoolExecutor(max_workers=RELAY_FLUSH_WORKERS, thread_name_prefix='relay-flush')
+            self.cluster = Cluster(node_id, cluster_secret, cluster_address, cluster_peers or {},
+                                   on_relay=self._deliver_relayed, on_join=self._notify_remote_joined,
+                                   local_clients=self._local_clients)
+            self.metrics.registry.gauge('chat_cluster_links', 'Links ativos com outros nós',
+                                        fn=lambda: len(self.cluster.links))
+            self.metrics.registry.gauge('chat_cluster_remote_clients', 'Clientes conectados em outros nós',
+                                        fn=lambda: len(self.cluster.directory))
+        self.cluster_forwarded = self.metrics.registry.counter('chat_cluster_forwarded_total', 'Mensagens encaminhadas a outros nós')
+
+        # Histórico durável (opcional): log segmentado cifrado com a chave de armazenamento
+        self.history = None
+        self.history_sync_interval = history_sync_interval
+        self.history_compact_interval = history_compact_interval
+        if history_dir:
+            self.history = MessageLog(history_dir, load_storage_key(history_key_path),
+                                      segment_size=history_segment_size, retention=history_retention)
+            # IDs continuam de onde a execução anterior parou (nunca reutilizados)
+            self.client_id_counter = self.history.reserved_ids()
+        self.id_reserved = self.client_id_counter
+        self.history_records = self.metrics.registry.counter('chat_history_records_total', 'Mensagens gravadas no histórico')
+        self.sealed_forwarded = self.metrics.registry.counter('chat_sealed_forwarded_total', 'Frames E2E repassados sem decifrar')
+        self.directory_searches = self.metrics.registry.counter('chat_directory_searches_total', 'Buscas por nome no diretório')
+
+        # Recebimento em estágios (server_utils/pipeline.py): rajadas de uma conexão são
+        # decifradas em paralelo por um pool compartilhado e despachadas em ordem.
+        # decrypt_workers=0 mantém todo o processamento na thread da conexão; com um núcleo
+        # só o pool não tem o que paralelizar e fica desabilitado por padrão.
+        if decrypt_workers is None:
+            cores = os.cpu_count() or 1
+            decrypt_workers = cores if cores > 1 else 0
+        self.pipeline_window = pipeline_window
+        self.decrypt_pool = DecryptPool(decrypt_workers, self._decode_frame) if decrypt_workers and PIPELINE_AVAILABLE else None
+        self.metrics.registry.gauge('chat_pipeline_decrypt_queue', 'Frames aguardando um worker de decifração',
+                                    fn=lambda: self.decrypt_pool.queued if self.decrypt_pool else 0)
+        self.metrics.registry.gauge('chat_pipeline_dispatch_queue', 'Frames lidos aguardando despacho em ordem',
+                                    fn=lambda: self.decrypt_pool.in_flight if self.decrypt_pool else 0)
+        self.pipeline_offloaded = self.metrics.registry.counter('chat_pipeline_offloaded_total', 'Frames decifrados pelo pool (rajadas)')
+        self.pipeline_inline = self.metrics.registry.counter('chat_pipeline_inline_total', 'Frames isolados processados na thread da conexão')
+
+        # Envio com prioridade por classe (server_utils/outbound.py): controle, interativo e bulk,
+        # com DRR ponderado por conexão. Mensagens acima de `bulk_threshold` bytes são bulk.
+        self.outbound_weights = check_weights(outbound_weights)
+        self.outbound_quantum = outbound_quantum
+        self.outbound_max_bytes = outbound_max_bytes
+        self.bulk_threshold = bulk_threshold
+        # Limita os bytes ainda não enviados no buffer do kernel (TCP_NOTSENT_LOWAT): o
+        # excesso fica na fila de saída, onde a prioridade por classe ainda vale
+        self.notsent_lowat = notsent_lowat
+        # Objetos AEAD guardados por sessão: menos CPU por frame, ~5 KB a mais por sessão ativa
+        self.session_class = CachedCipherSession if cache_ciphers else ClientSession
+        self.outbound_wait = [
+            self.metrics.registry.histogram(f'chat_outbound_wait_{name}_seconds', f'Espera na fila de saída (classe {name})')
+            for name in CLASS_NAMES
+        ]
+        self.metrics.registry.gauge('chat_outbound_queued_frames', 'Frames nas filas de saída de todas as conexões',
+                                    fn=self._outbound_depth)
+
+        # Captura da linha do tempo de cada conexão (só metadados) para benchmarks/replay.py
+        self.capture = TrafficCapture(capture_path) if capture_path else None
+
+        # Suites de cifra aceitas, medidas nesta máquina na inicialização (ver _select_suite)
+        self.cipher_slowdown_limit = cipher_slowdown_limit
+        self.suite_speeds = crypto_utils.benchmark_suites(cipher_suites)
+        if not self.suite_speeds:
+            raise ValueError(f"Nenhuma suite de cifra disponível entre {cipher_suites}")
+        log.info("cipher_benchmark", **{suite.lower(): f"{speed / 1e6:.0f}MB/s" for suite, speed in self.suite_speeds.items()})
+        self.suite_handshakes = {
+            suite: self.metrics.registry.counter(f'chat_handshakes_{suite.lower()}_total', f'Sessões negociadas com {suite}')
+            for suite in self.suite_speeds
+        }
         
         try:
-            with open("cryptography_utils/server_private_key.pem", "rb") as key_file:
-                self.rsa_private_key = serialization.load_pem_private_key(
-                    key_file.read(), password=None
-                )
-            with open("cryptography_utils/server.crt", "rb") as cert_file:
+            # Chave de assinatura do handshake: RSA, ECDSA P-256 ou Ed25519 (ver generate_keys.py)
+            self.private_key = crypto_utils.load_private_key(key_path)
+            with open(cert_path, "rb") as cert_file:
                 self.cert_pem = cert_file.read()
-            print("[SISTEMA] Chaves RSA carregadas com sucesso.")
+            log.info("keys_loaded", key_path=key_path, key_type=type(self.private_key).__name__)
         except FileNotFoundError:
-            print("[ERRO] Chaves não encontradas! Rode o script generate_keys.py primeiro.")
+            log.error("keys_not_found", hint="Rode o script generate_keys.py primeiro.")
             sys.exit(1)
 
     def _generate_client_id(self):
         with self.client_lock:
             self.client_id_counter += 1
+            if self.history is not None and self.client_id_counter > self.id_reserved:
+                # Reserva em blocos: uma escrita a cada 1000 IDs
+                self.id_reserved = self.client_id_counter + 1000
+                self.history.reserve_ids(self.id_reserved)
+            if self.node_id is not None:
+                # Únicos no cluster: o resto da divisão identifica o nó de origem
+                return self.client_id_counter * MAX_NODES + self.node_id
             return self.client_id_counter
         
     def start(self):
         try:
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(5)
+            if self.takeover_path:
+                # Zero downtime: herda o socket já em escuta do processo anterior
+                self.server_socket = handoff.receive_listener(self.takeover_path)
+                log.info("listener_inherited", path=self.takeover_path)
+            else:
+                self.server_socket = self.transport.listen(self.backlog)
+            # Timeout para que o loop perceba o fim da aceitação sem fechar o socket
+            # (o fd pode ter sido compartilhado com o novo processo)
+            self.server_socket.settimeout(0.5)
+            self.accepting = True
             
-            print(f"[SERVIDOR] Iniciado em {self.host}:{self.port} (Seguro)")
+            log.info("server_started", transport=str(self.transport))
+
+            if self.metrics_port is not None:
+                self.metrics_httpd = start_metrics_server(self.metrics.registry, self.metrics_host, self.metrics_port)
+                log.info("metrics_started", url=f"http://{self.metrics_host}:{self.metrics_port}/metrics")
+
+            if self.idle_timeout:
+                threading.Thread(target=self._keepalive_loop, daemon=True).start()
+
+            if self.ecdh_pool:
+                self.ecdh_pool.start()
+
+            threading.Thread(target=self._receipt_loop, daemon=True).start()
+
+            if self.cluster:
+                self.cluster.start()
+
+            if self.history:
+                threading.Thread(target=self._history_loop, daemon=True).start()
+
+            if self.handoff_path and handoff.supported() and self.transport.supports_handoff:
+                threading.Thread(target=self._serve_handoff, daemon=True).start()
             
-            while True:
-                client_socket, client_address = self.server_socket.accept()
-                print(f"[CONEXÃO] Nova conexão: {client_address}")
+            while self.accepting:
+                try:
+                    client_socket, client_address = self.server_socket.accept()
+                except socket.timeout:
+                    continue
+                except OSError:
+                    if not self.accepting: break
+                    raise
+                client_socket.settimeout(None)
+                client_address = self.transport.peer(client_socket, client_address)
+                self.metrics.connections.inc()
+                
+                reason = self._admit(client_address[0])
+                if reason:
+                    # Recusa barata: nenhuma thread, nenhuma operação criptográfica
+                    self.rejected_connections.inc()
+                    log.warning("connection_rejected", address=client_address, reason=reason)
+                    client_socket.close()
+                    continue
+                log.info("connection_accepted", address=client_address)
                 
                 client_thread = threading.Thread(
                     target=self.handle_client,
@@ -56,36 +304,81 @@ class Server:
                     daemon=True
                 )
                 client_thread.start()
+            
+            # Aceitação encerrada por drain(): espera as sessões terminarem
+            self.drain_done.wait()
         except KeyboardInterrupt:
-            print("\n[SERVIDOR] Encerrando...")
+            log.info("server_stopping")
         finally:
             self.close()
 
+    def _admit(self, ip):
+        """Decide se uma nova conexão é aceita. Retorna o motivo da recusa ou None."""
+        if self.connection_limiter is not None and not self.connection_limiter.allow(ip):
+            return 'connection_rate'
+        with self.admission_lock:
+            if self.max_connections is not None and self.active_connections >= self.max_connections:
+                return 'max_connections'
+            per_ip = self.connections_per_ip.get(ip, 0)
+            if self.max_connections_per_ip is not None and per_ip >= self.max_connections_per_ip:
+                return 'max_connections_per_ip'
+            self.active_connections += 1
+            self.connections_per_ip[ip] = per_ip + 1
+        return None
+
+    def _release(self, ip):
+        with self.admission_lock:
+            self.active_connections -= 1
+            remaining = self.connections_per_ip.get(ip, 1) - 1
+            if remaining > 0:
+                self.connections_per_ip[ip] = remaining
+            else:
+                self.connections_per_ip.pop(ip, None)
+
+    def _allow_frame(self, client_id, ip):
+        """Rate limiting por cliente e por endereço, antes da decifração."""
+        if self.client_limiter is not None and not self.client_limiter.allow(client_id):
+            return False
+        if self.ip_limiter is not None and not self.ip_limiter.allow(ip):
+            return False
+        return True
+
     def handle_client(self, client_socket, client_address):
         client_id = None
+        client_info = None
+        pipeline = None
+        current = threading.current_thread()
+        with self.admission_lock:
+            self.client_threads.add(current)
         try:
-            header = client_socket.recv(4)
-            if not header: return
-            msg_len = struct.unpack('!I', header)[0]
-            data = client_socket.recv(msg_len)
+            # Conexões que não completam o handshake a tempo são descartadas
+            client_socket.settimeout(self.handshake_timeout)
+            client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            data = self._recv_frame(client_socket)
+            if data is None: return
+            handshake_start = time.perf_counter()
             
             client_hello = json.loads(data.decode('utf-8'))
             client_name = client_hello.get('name', 'Anonimo')
             client_pk_pem = client_hello['public_key'].encode()
+            offered = client_hello.get('cipher_suites')
+            suite = self._select_suite(offered) if offered is not None else crypto_utils.DEFAULT_SUITE
             
             client_id = self._generate_client_id()
-            server_sk, server_pk_pem = crypto_utils.generate_ecdh_pair()
+            if self.ecdh_pool:
+                server_sk, server_pk_pem = self.ecdh_pool.take()
+            else:
+                server_sk, server_pk_pem = crypto_utils.generate_ecdh_pair()
             salt = os.urandom(16) 
             
             transcript = client_pk_pem # O transcript vincula o handshake ao cliente correto, evitando replay de mensagens de handshake.
             
             data_to_sign = server_pk_pem + str(client_id).encode() + transcript + salt
+            if offered is not None:
+                # Lista oferecida e suite escolhida assinadas: um MITM não força um downgrade
+                data_to_sign += ','.join(offered).encode() + b'|' + suite.encode()
             
-            signature = self.rsa_private_key.sign(
-                data_to_sign,
-                padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH),
-                hashes.SHA256()
-            )
+            signature = crypto_utils.sign_handshake(self.private_key, data_to_sign)
             
             response = {
                 'type': 'handshake_response',
@@ -93,79 +386,384 @@ class Server:
                 'public_key': server_pk_pem.decode(),
                 'salt': base64.b64encode(salt).decode(),
                 'signature': base64.b64encode(signature).decode(),
-                'cert': self.cert_pem.decode()
+                'cert': self.cert_pem.decode(),
+                'epoch': self.epoch,
             }
+            if offered is not None:
+                response['cipher_suite'] = suite
             resp_bytes = json.dumps(response).encode('utf-8')
             client_socket.sendall(struct.pack('!I', len(resp_bytes)) + resp_bytes)
             
             shared_secret = crypto_utils.compute_shared_secret(server_sk, client_pk_pem)
-            key_c2s, key_s2c = crypto_utils.derive_keys(shared_secret, salt)
+            key_c2s, key_s2c = crypto_utils.derive_keys(shared_secret, salt, crypto_utils.suite_key_size(suite))
+            self.metrics.handshake_seconds.observe(time.perf_counter() - handshake_start)
+            if suite in self.suite_handshakes:
+                self.suite_handshakes[suite].inc()
             
+            client_socket.settimeout(None)
+            client_info = self.session_class(client_id, client_socket, client_address, client_name, key_c2s, key_s2c, suite)
+            client_info.outbound = OutboundQueue(self.outbound_weights, self.outbound_quantum, self.outbound_max_bytes)
+            if self.notsent_lowat and hasattr(socket, 'TCP_NOTSENT_LOWAT'):
+                try:
+                    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NOTSENT_LOWAT, self.notsent_lowat)
+                except OSError:
+                    pass  # Socket Unix/socketpair: sem a opção
             with self.client_lock:
-                self.connected_clients[client_id] = {
-                    'socket': client_socket,
-                    'name': client_name,
-                    'key_c2s': key_c2s,
-                    'key_s2c': key_s2c,
-                    'seq_recv': 0, # Esperado do cliente
-                    'seq_send': 0  # Próximo a enviar
-                }
+                self.connected_clients[client_id] = client_info
+                self.names.add(client_id, client_name)
+            if self.capture is not None:
+                self.capture.connect(client_id)
+            if self.idle_timeout:
+                self.timer_wheel.schedule(client_id, self.ping_interval)
             
-            print(f"[HANDSHAKE] Sucesso com {client_name} (ID: {client_id})")
+            log.info("handshake_ok", client_id=client_id, name=client_name, cipher_suite=suite)
+            if self.cluster:
+                self.cluster.announce_join(client_id, client_name)
             
             # Notifica todos os clientes sobre o novo cliente
             self._broadcast_client_joined(client_id)
+            if self.draining:
+                self._send_control(client_id, self._reconnect_hint())
             
+            metrics = self.metrics
+            tracer = self.tracer
+            if self.decrypt_pool is not None:
+                pipeline = ReceivePipeline(self.decrypt_pool, client_socket, self.pipeline_window)
             while True:
-                len_bytes = client_socket.recv(4)
-                if not len_bytes: break
+                if pipeline is not None and pipeline.pending and (pipeline.full or not pipeline.readable()):
+                    # Socket sem dados prontos (ou janela cheia): despacha o frame mais antigo
+                    if not self._process_frame(client_id, client_info, *pipeline.pop()): break
+                    continue
+                
+                len_bytes = self._recv_exact(client_socket, 4)
+                if len_bytes is None:
+                    self._drain_pipeline(client_id, client_info, pipeline)
+                    break
+                # O tempo ocioso até o cabeçalho chegar não conta como estágio 'recv'
+                trace = tracer.start(client_id)
                 frame_len = struct.unpack('!I', len_bytes)[0]
+                encrypted_frame = self._recv_exact(client_socket, frame_len & ~SEALED_FLAG)
+                if encrypted_frame is None:
+                    self._drain_pipeline(client_id, client_info, pipeline)
+                    break
+                if trace: trace.mark('recv')
+                metrics.frames_in.inc()
+                metrics.bytes_in.inc(len(encrypted_frame) + 4)
+                metrics.frame_size.observe(len(encrypted_frame))
                 
-                encrypted_frame = b''
-                while len(encrypted_frame) < frame_len:
-                    chunk = client_socket.recv(frame_len - len(encrypted_frame))
-                    if not chunk: break
-                    encrypted_frame += chunk
-
+                # Descartado antes da decifração: excesso de tráfego não consome CPU de AES-GCM
+                sealed = bool(frame_len & SEALED_FLAG)
+                if not self._allow_frame(client_id, client_address[0]):
+                    self.rate_limited_frames.inc()
+                    log.debug("rate_limited", client_id=client_id, address=client_address)
+                    if not sealed and client_info.receipts is not None:
+                        # Frames à frente primeiro: o recibo não pode ultrapassar um seq em processamento
+                        if not self._drain_pipeline(client_id, client_info, pipeline): break
+                        self._record_rate_limited(client_info, encrypted_frame)
+                    continue
                 
-                try:
-                    plaintext, sid, tid, seq = crypto_utils.decrypt_message(
-                        key_c2s, encrypted_frame
-                    )
-                    
-                    current_seq = self.connected_clients[client_id]['seq_recv']
-                    if seq <= current_seq and current_seq != 0:
-                        print(f"[ALERTA] Replay detectado de ID {client_id}")
-                        continue 
-                    self.connected_clients[client_id]['seq_recv'] = seq
-                    
-                    msg_data = json.loads(plaintext.decode('utf-8'))
-                    msg_type = msg_data.get('type')
-                    
-                    if msg_type == 'send_message':
-                        target_id = msg_data.get('target_id')
-                        content = msg_data.get('message')
-                        self._send_secure_message(client_id, target_id, content)
-                        
-                    elif msg_type == 'get_online_clients':
-                        self._send_online_list_secure(client_id)
-                        
-                except Exception as e:
-                    print(f"[ERRO CRIPTO] Cliente {client_id}: {e}")
-                    break
+                if pipeline is None or not pipeline.pending and (sealed or not pipeline.readable()):
+                    # Frame isolado (ou selado sem fila à frente): despachado aqui mesmo
+                    if pipeline is not None: self.pipeline_inline.inc()
+                    if not self._process_frame(client_id, client_info, None, encrypted_frame, sealed, trace): break
+                elif sealed:
+                    pipeline.push_sealed(encrypted_frame, trace)
+                else:
+                    # Rajada: decifração e parse no pool enquanto a leitura continua
+                    self.pipeline_offloaded.inc()
+                    pipeline.push(client_info.cipher_c2s, encrypted_frame, trace)
                     
         except Exception as e:
-            print(f"[ERRO] Falha na conexão: {e}")
+            if client_info is None:
+                self.metrics.handshake_failures.inc()
+            log.error("connection_error", client_id=client_id, address=client_address, error=str(e))
         finally:
-            self.disconnect_client(client_id)
+            if pipeline is not None:
+                pipeline.discard()
+            if client_info is not None:
+                self.disconnect_client(client_id)
+            else:
+                # Handshake não concluído: a sessão nunca foi registrada e o socket é só
+                # desta thread (a variável do loop de accept o manteria aberto)
+                client_socket.close()
+            if self.client_limiter is not None and client_id is not None:
+                self.client_limiter.forget(client_id)
+            self._release(client_address[0])
+            with self.admission_lock:
+                self.client_threads.discard(current)
+
+    def _decode_frame(self, cipher, encrypted_frame, trace):
+        """Estágio de decifração + parse (no pool ou na thread da conexão). Retorna (msg_data, sid, seq)."""
+        decrypt_start = time.perf_counter()
+        plaintext, sid, tid, seq = crypto_utils.decrypt_message(cipher, encrypted_frame)
+        self.metrics.decrypt_seconds.observe(time.perf_counter() - decrypt_start)
+        if trace: trace.mark('decrypt')
+        msg_data = json.loads(plaintext.decode('utf-8'))
+        if trace: trace.mark('parse')
+        return msg_data, sid, seq
+
+    def _drain_pipeline(self, client_id, client_info, pipeline):
+        """
+        Despacha os frames já lidos, como no processamento sequencial (EOF, ou antes de um
+        recibo de rate limiting). Retorna False se a conexão deve ser encerrada.
+        """
+        while pipeline is not None and pipeline.pending:
+            if not self._process_frame(client_id, client_info, *pipeline.pop()):
+                return False
+        return True
+
+    def _process_frame(self, client_id, client_info, job, encrypted_frame, sealed, trace):
+        """
+        Estágio de despacho, sempre na ordem de chegada: replay, roteamento e respostas.
+        `job` é o future do pool, ou None para decifrar aqui. Retorna False se a conexão
+        deve ser encerrada.
+        """
+        if sealed:
+            # E2E: roteado só pelo cabeçalho, sem decifrar nem recifrar
+            self._forward_sealed(client_id, client_info, encrypted_frame, trace)
+            if trace and not trace.queued: self.tracer.finish(trace)
+            return True
+        
+        metrics = self.metrics
+        try:
+            if job is None:
+                msg_data, sid, seq = self._decode_frame(client_info.cipher_c2s, encrypted_frame, trace)
+            else:
+                msg_data, sid, seq = job.result()
+                if trace: trace.mark('dispatch_wait')
+            
+            current_seq = client_info.seq_recv
+            if seq <= current_seq and current_seq != 0:
+                metrics.replay_drops.inc()
+                log.warning("replay_detected", client_id=client_id, seq=seq, last_seq=current_seq)
+                return True
+            client_info.seq_recv = seq
+            # Só tráfego autenticado conta como atividade
+            client_info.last_seen = time.monotonic()
+            msg_type = msg_data.get('type')
+            
+            # O campo sender do cabeçalho (autenticado via AAD) seleciona o usuário
+            # lógico; IDs que a conexão não possui são recusados.
+            if sid == client_id:
+                origin_id = client_id
+            elif sid in client_info.users:
+                origin_id = sid
+            else:
+                self._send_control(client_id, {'type': 'error', 'message': f'Remetente {sid} não pertence a esta conexão'})
+                return True
+            if self.capture is not None:
+                self.capture.frame(client_id, origin_id, msg_type, msg_data.get('target_id', msg_data.get('with_id')),
+                                   len(encrypted_frame), bool(msg_data.get('receipt')))
+            
+            if msg_type == 'send_message':
+                target_id = msg_data.get('target_id')
+                content = msg_data.get('message')
+                on_done = self._expect_receipt(client_info, seq) if msg_data.get('receipt') else None
+                status = self._send_secure_message(origin_id, target_id, content, trace, on_done)
+                if on_done is not None and status != 'queued':
+                    on_done(status)  # Resolvido sem passar pela fila de saída
+                
+            elif msg_type == 'get_online_clients':
+                self._send_online_list_secure(origin_id, trace)
+            
+            elif msg_type == 'find_users':
+                self._find_users(origin_id, msg_data)
+            
+            elif msg_type == 'get_history':
+                self._send_history(origin_id, msg_data)
+            
+            elif msg_type == 'publish_prekeys':
+                self._store_prekeys(client_id, client_info, msg_data)
+            
+            elif msg_type == 'get_prekey_bundle':
+                self._send_prekey_bundle(origin_id, msg_data)
+            
+            elif msg_type == 'register_user':
+                self._register_logical_user(client_id, client_info, msg_data)
+            
+            elif msg_type == 'unregister_user':
+                if msg_data.get('client_id') in client_info.users:
+                    self.disconnect_client(msg_data['client_id'])
+            
+            elif msg_type == 'ping':
+                self._send_control(client_id, {'type': 'pong', 'ts': msg_data.get('ts')})
+            
+            # 'pong' apenas atualiza last_seen (feito acima)
+            
+            # Frame enfileirado para um destino: o trace termina na escrita (_write_frame)
+            if trace and not trace.queued: self.tracer.finish(trace)
+            return True
+                
+        except Exception as e:
+            metrics.crypto_errors.inc()
+            log.error("crypto_error", client_id=client_id, error=str(e))
+            return False
+
+    def _select_suite(self, offered):
+        """
+        Primeira suite da lista do cliente (ordenada pelo benchmark da máquina dele) que o
+        servidor aceita, desde que aqui não seja mais que `cipher_slowdown_limit` vezes mais
+        lenta que a melhor opção em comum: o relay decifra e recifra todo frame da sessão.
+        """
+        if not isinstance(offered, list):
+            raise ValueError("cipher_suites inválido")
+        common = [suite for suite in offered[:len(crypto_utils.CIPHER_SUITES)] if suite in self.suite_speeds]
+        if not common:
+            raise ValueError(f"Nenhuma suite de cifra em comum: {offered[:8]}")
+        best = max(self.suite_speeds[suite] for suite in common)
+        for suite in common:
+            if self.suite_speeds[suite] * self.cipher_slowdown_limit >= best:
+                return suite
+
+    def _recv_exact(self, sock, n):
+        """Lê exatamente n bytes do socket (None se a conexão fechar antes)."""
+        data = b''
+        while len(data) < n:
+            chunk = sock.recv(n - len(data))
+            if not chunk: return None
+            data += chunk
+        return data
+
+    def _recv_frame(self, sock):
+        """Lê um frame com prefixo de tamanho (4 bytes)."""
+        len_bytes = self._recv_exact(sock, 4)
+        if len_bytes is None: return None
+        frame_len = struct.unpack('!I', len_bytes)[0]
+        return self._recv_exact(sock, frame_len)
+
+    def _send_encrypted(self, info, payload, sender_id, target_id, trace=None, traffic=CONTROL, on_done=None):
+        """
+        Enfileira o payload na fila de saída do destino, na classe `traffic`. Usuários
+        lógicos usam a conexão (chaves, seq e fila) da sessão que os hospeda.
+        Retorna a sessão se quem chamou virou o escritor: ele deve chamar
+        _flush_outbound depois de soltar o client_lock. Levanta ConnectionError
+        (um OSError) se a conexão do destino caiu; senão `on_done` recebe o resultado
+        da escrita.
+        """
+        session = info.session
+        writer = session.outbound.put(OutboundFrame(payload, sender_id, target_id, trace=trace, on_done=on_done), traffic)
+        if trace: trace.queued = True
+        return session if writer else None
+
+    def _flush_outbound(self, session):
+        """
+        Esvazia a fila de saída de `session` (chamado pelo escritor, fora do client_lock).
+        Depois de OUTBOUND_BUDGET frames o restante passa para uma thread auxiliar, e a
+        thread atual volta a atender a própria conexão.
+        """
+        outbound = session.outbound
+        for _ in range(OUTBOUND_BUDGET):
+            frame, traffic = outbound.take()
+            if frame is None:
+                return
+            try:
+                self._write_frame(session, frame, traffic)
+            except OSError as e:
+                # A thread do destino percebe a conexão quebrada e faz a limpeza
+                self.metrics.send_errors.inc()
+                dropped = outbound.close()
+                log.warning("send_failed", target_id=session.client_id, dropped=len(dropped), error=str(e))
+                self._discard_frames([frame] + dropped)
+                return
+            if frame.on_done is not None:
+                frame.on_done('delivered')
+        threading.Thread(target=self._flush_outbound, args=(session,), daemon=True).start()
+
+    def _discard_frames(self, frames):
+        """Frames que saíram da fila sem ser escritos: quem espera o resultado recebe 'send_failed'."""
+        for frame in frames:
+            if frame.on_done is not None:
+                frame.on_done('send_failed')
+
+    def _write_frame(self, session, frame, traffic):
+        """Cifra (seq atribuído aqui, na ordem de escrita) e envia um frame da fila."""
+        trace = frame.trace
+        self.outbound_wait[traffic].observe(time.perf_counter() - frame.queued_at)
+        if trace: trace.mark('outbound_queue')
+        if frame.sealed:
+            data = struct.pack('!I', len(frame.payload) | SEALED_FLAG) + frame.payload
+        else:
+            seq = session.seq_send + 1
+            session.seq_send = seq
+            
+            encrypt_start = time.perf_counter()
+            encrypted_frame = crypto_utils.encrypt_message(session.cipher_s2c, frame.payload, frame.sender_id, frame.target_id, seq)
+            self.metrics.encrypt_seconds.observe(time.perf_counter() - encrypt_start)
+            if trace: trace.mark('encrypt')
+            data = struct.pack('!I', len(encrypted_frame)) + encrypted_frame
+        
+        session.socket.sendall(data)
+        if trace:
+            trace.mark('send')
+            self.tracer.finish(trace)
+        self.metrics.frames_out.inc()
+        self.metrics.bytes_out.inc(len(data))
+        if frame.sealed:
+            self.sealed_forwarded.inc()
+
+    def _outbound_depth(self):
+        # Sem o client_lock: list() copia os valores do dict de uma vez (atômico com o GIL)
+        # e depths() só lê o tamanho das deques; a coleta não disputa com o relay
+        sessions = list(self.connected_clients.values())
+        return sum(sum(i.outbound.depths()) for i in sessions if not i.is_logical)
+
+    def _send_secure_message(self, sender_id, target_id, content, trace=None, on_done=None):
+        """
+        Encaminha a mensagem. Retorna 'queued' (na fila de saída do destino local, ou a
+        caminho do nó remoto; o resultado da escrita vai para `on_done`), 'offline' ou
+        'send_failed'.
+        """
+        if self.cluster is not None and target_id not in self.connected_clients:
+            remote = self.cluster.lookup(target_id)
+            if remote is not None:
+                return self._forward_remote(remote[0], sender_id, target_id, content, on_done)
+        return self._deliver_local(sender_id, None, target_id, content, trace, on_done)
 
-    def _send_secure_message(self, sender_id, target_id, content):
+    def _forward_remote(self, node_id, sender_id, target_id, content, on_done=None):
+        """
+        Encaminha ao nó do destino; lá a mensagem é cifrada com a chave da sessão dele.
+        Com `on_done`, o nó do destino devolve o status da entrega pelo link.
+        """
+        sender = self.connected_clients.get(sender_id)
+        if sender is None:
+            return 'send_failed'
+        relay = {'type': 'relay', 'from_id': sender_id, 'from_name': sender.name,
+                 'target_id': target_id, 'message': content}
+        if not self.cluster.forward(node_id, relay, on_done):
+            self.undelivered_messages.inc()
+            return 'send_failed'
+        self.cluster_forwarded.inc()
+        self._record_history(sender_id, sender.name, target_id, content)
+        return 'queued'
+
+    def _deliver_relayed(self, relay, reply=None):
+        """Mensagem vinda de outro nó para um cliente deste; `reply` devolve o status ao nó de origem."""
+        status = self._deliver_local(relay['from_id'], relay['from_name'], relay['target_id'], relay['message'],
+                                     on_done=reply, relayed=True)
+        if reply is not None and status != 'queued':
+            reply(status)
+
+    def _deliver_local(self, sender_id, sender_name, target_id, content, trace=None, on_done=None, relayed=False):
+        status, sender_name = self._write_local(sender_id, sender_name, target_id, content, trace, on_done, relayed)
+        if status == 'queued':
+            self._record_history(sender_id, sender_name, target_id, content)
+        return status
+
+    def _write_local(self, sender_id, sender_name, target_id, content, trace, on_done=None, relayed=False):
+        """
+        Enfileira para o destino local. Retorna (status, sender_name); 'queued' se entrou na fila.
+        Com `relayed` (thread de um link do cluster) não espera pelo backpressure do destino
+        e a escrita fica com o relay_flusher.
+        """
         with self.client_lock:
+            if trace: trace.mark('lock_wait')
             if target_id not in self.connected_clients:
-                return
+                self.undelivered_messages.inc()
+                return 'offline', sender_name
             
             target_info = self.connected_clients[target_id]
-            sender_name = self.connected_clients[sender_id]['name']
+            if sender_name is None:
+                sender_name = self.connected_clients[sender_id].name
             
             payload = json.dumps({
                 'type': 'message',
@@ -173,81 +771,605 @@ class Server:
                 'from_name': sender_name,
                 'message': content
             }).encode('utf-8')
-            
-            key = target_info['key_s2c']
-            seq = target_info['seq_send'] + 1
-            target_info['seq_send'] = seq
-            
-            encrypted_frame = crypto_utils.encrypt_message(key, payload, sender_id, target_id, seq)
+            if trace: trace.mark('serialize')
             
             try:
-                target_info['socket'].sendall(struct.pack('!I', len(encrypted_frame)) + encrypted_frame)
-                print(f"[ENCAMINHADO] {sender_id} -> {target_id}")
-            except:
-                pass
+                writer = self._send_encrypted(target_info, payload, sender_id, target_id, trace,
+                                              self._traffic(payload), on_done)
+            except OSError as e:
+                self.metrics.send_errors.inc()
+                self.undelivered_messages.inc()
+                log.warning("send_failed", sender_id=sender_id, target_id=target_id, error=str(e))
+                return 'send_failed', sender_name
+        if not relayed:
+            self._flush_or_wait(writer, target_info.session)
+        elif writer is not None:
+            self.relay_flusher.submit(self._flush_outbound, writer)
+        log.debug("message_forwarded", sender_id=sender_id, target_id=target_id)
+        return 'queued', sender_name
+
+    def _traffic(self, payload):
+        return BULK if len(payload) > self.bulk_threshold else INTERACTIVE
+
+    def _flush_or_wait(self, writer, session):
+        """Após enfileirar chat: escreve (se virou o escritor) ou respeita o backpressure do destino."""
+        if writer is not None:
+            self._flush_outbound(writer)
+        else:
+            session.outbound.wait_writable()
 
-    def _send_online_list_secure(self, requestor_id):
+    def _forward_sealed(self, client_id, client_info, frame, trace=None):
+        """
+        Repassa um frame E2E intacto. O servidor lê apenas remetente e destino: o
+        remetente precisa pertencer à conexão e o destino precisa ter publicado um
+        bundle (ou seja, sabe abrir frames selados).
+        """
+        try:
+            sender_id, target_id = peek_address(frame)
+        except struct.error:
+            return
+        if sender_id != client_id and sender_id not in client_info.users:
+            self._send_control(client_id, {'type': 'error', 'message': f'Remetente {sender_id} não pertence a esta conexão'})
+            return
+        if self.capture is not None:
+            self.capture.frame(client_id, sender_id, 'sealed', target_id, len(frame))
         with self.client_lock:
-            clients_list = [{'id': c, 'name': i['name']} for c, i in self.connected_clients.items() if c != requestor_id]
+            if trace: trace.mark('lock_wait')
+            target_info = self.connected_clients.get(target_id)
+            if target_info is None or target_info.prekey_bundle is None:
+                target_info = None
+            else:
+                try:
+                    writer = target_info.outbound.put(
+                        OutboundFrame(frame, sender_id, target_id, sealed=True, trace=trace), self._traffic(frame))
+                    if trace: trace.queued = True
+                except OSError as e:
+                    self.metrics.send_errors.inc()
+                    log.warning("send_failed", sender_id=sender_id, target_id=target_id, error=str(e))
+                    return
+        if target_info is None:
+            self.undelivered_messages.inc()
+            self._send_control(client_id, {'type': 'error', 'message': f'Cliente {target_id} indisponível para E2E'})
+            return
+        self._flush_or_wait(target_info.session if writer else None, target_info.session)
+
+    def _store_prekeys(self, client_id, client_info, msg_data):
+        """Guarda o bundle E2E publicado pela conexão (identidade + prekeys de uso único)."""
+        try:
+            identity_key = msg_data['identity_key']
+            if len(base64.b64decode(identity_key)) != 32:
+                raise ValueError
+            prekeys = [{'id': int(p['id']), 'key': p['key']} for p in msg_data.get('prekeys', [])
+                       if len(base64.b64decode(p['key'])) == 32]
+        except (KeyError, TypeError, ValueError):
+            self._send_control(client_id, {'type': 'error', 'message': 'Bundle E2E inválido'})
+            return
+        with self.client_lock:
+            bundle = client_info.prekey_bundle
+            if bundle is None or bundle.identity_key != identity_key:
+                bundle = client_info.prekey_bundle = PrekeyBundle(identity_key)
+            bundle.prekeys.extend(prekeys[:PREKEY_MAX - len(bundle.prekeys)])
+        log.debug("prekeys_published", client_id=client_id, available=len(bundle.prekeys))
+
+    def _send_prekey_bundle(self, requestor_id, msg_data):
+        target_id = msg_data.get('client_id')
+        ref = msg_data.get('ref')
+        with self.client_lock:
+            target_info = self.connected_clients.get(target_id)
+            bundle = target_info.prekey_bundle if target_info is not None else None
+            prekey = bundle.take() if bundle is not None else None
+            remaining = len(bundle.prekeys) if bundle is not None else 0
+        if bundle is None:
+            self._send_control(requestor_id, {'type': 'error', 'ref': ref,
+                                              'message': f'Cliente {target_id} não publicou chaves E2E'})
+            return
+        self._send_control(requestor_id, {'type': 'prekey_bundle', 'ref': ref, 'client_id': target_id,
+                                          'identity_key': bundle.identity_key, 'prekey': prekey})
+        if prekey is not None and remaining < PREKEY_LOW:
+            self._send_control(target_id, {'type': 'prekeys_low', 'remaining': remaining})
+
+    def _record_history(self, sender_id, sender_name, target_id, content):
+        # Fora do client_lock: a escrita em disco não atrasa o relay de outros clientes
+        if self.history is not None:
+            try:
+                self.history.append(sender_id, sender_name, target_id, content)
+                self.history_records.inc()
+            except OSError as e:
+                log.error("history_write_failed", error=str(e))
+
+    def _send_history(self, requestor_id, msg_data):
+        """Página do histórico da conversa entre o solicitante e `with_id`."""
+        if self.history is None:
+            self._send_control(requestor_id, {'type': 'error', 'message': 'Histórico desabilitado neste servidor'})
+            return
+        try:
+            with_id = int(msg_data['with_id'])
+            limit = max(1, min(int(msg_data.get('limit', 50)), HISTORY_PAGE_MAX))
+            before = msg_data.get('before')
+            since = msg_data.get('since')
+            messages, cursor = self.history.fetch(
+                requestor_id, with_id,
+                before=int(before) if before is not None else None,
+                since=float(since) if since is not None else None,
+                limit=limit,
+            )
+        except (KeyError, TypeError, ValueError):
+            self._send_control(requestor_id, {'type': 'error', 'message': 'Pedido de histórico inválido'})
+            return
+        self._send_control(requestor_id, {'type': 'history', 'with_id': with_id,
+                                          'messages': messages, 'before': cursor}, traffic=BULK)
+
+    def _find_users(self, requestor_id, msg_data):
+        """
+        Busca por nome (exata ou por prefixo) no índice, sem enviar a lista completa de
+        online: até `limit` clientes em ordem de nome; 'more' indica que há outros.
+        """
+        ref = msg_data.get('ref')
+        query = msg_data.get('query')
+        try:
+            if not isinstance(query, str) or not query.strip():
+                raise ValueError(query)
+            limit = max(1, min(int(msg_data.get('limit', 20)), DIRECTORY_RESULTS_MAX))
+        except (TypeError, ValueError):
+            self._send_control(requestor_id, {'type': 'error', 'ref': ref, 'message': 'Pedido de busca inválido'})
+            return
+        prefix = bool(msg_data.get('prefix', True))
+        self.directory_searches.inc()
+        with self.client_lock:
+            found = self.names.search(query, prefix, limit, exclude=requestor_id)
+        if self.cluster is not None:
+            # Os dois resultados já estão em ordem de nome
+            found = list(heapq.merge(found, self.cluster.search(query, prefix, limit)))
+        self._send_control(requestor_id, {
+            'type': 'users_found', 'ref': ref, 'query': query,
+            'clients': [{'id': c, 'name': name} for _, c, name in found[:limit]],
+            'more': len(found) > limit,
+        })
+
+    def _send_online_list_secure(self, requestor_id, trace=None):
+        with self.client_lock:
+            if trace: trace.mark('lock_wait')
+            clients_list = [{'id': c, 'name': i.name} for c, i in self.connected_clients.items() if c != requestor_id]
+            if self.cluster is not None:
+                clients_list.extend({'id': c, 'name': name} for c, name in self.cluster.remote_clients())
             
             payload = json.dumps({
                 'type': 'online_clients',
                 'clients': clients_list
             }).encode('utf-8')
+            if trace: trace.mark('serialize')
             
             info = self.connected_clients[requestor_id]
-            key = info['key_s2c']
-            seq = info['seq_send'] + 1
-            info['seq_send'] = seq
-            
-            encrypted_frame = crypto_utils.encrypt_message(key, payload, 0, requestor_id, seq)
-            info['socket'].sendall(struct.pack('!I', len(encrypted_frame)) + encrypted_frame)
+            writer = self._send_encrypted(info, payload, 0, requestor_id, trace)
+        if writer is not None:
+            self._flush_outbound(writer)
+
+    def _send_control(self, client_id, message, traffic=CONTROL):
+        """Envia um frame de controle (remetente 0) cifrado para um cliente."""
+        queued, writer = self._enqueue_control(client_id, message, traffic)
+        if writer is not None:
+            self._flush_outbound(writer)
+        return queued
+
+    def _enqueue_control(self, client_id, message, traffic=CONTROL):
+        """
+        Só enfileira o frame de controle. Retorna (enfileirado, sessão a esvaziar ou None):
+        quem recebe a sessão chama _flush_outbound depois de soltar os próprios locks.
+        """
+        payload = json.dumps(message).encode('utf-8')
+        with self.client_lock:
+            info = self.connected_clients.get(client_id)
+            if info is None:
+                return False, None
+            try:
+                return True, self._send_encrypted(info, payload, 0, client_id, traffic=traffic)
+            except Exception:
+                self.metrics.send_errors.inc()
+                return False, None
+
+    def _expect_receipt(self, info, seq):
+        """Registra que o frame `seq` pediu recibo; retorna o callback que recebe o resultado."""
+        batch = info.receipts
+        if batch is None:
+            batch = info.receipts = ReceiptBatch()
+        batch.expect(seq)
+        return lambda status: self._record_receipt(info, seq, status)
+
+    def _record_receipt(self, info, seq, status):
+        """Acumula o resultado do frame `seq`; envia na hora se o lote encheu."""
+        batch = info.receipts
+        if batch is None:
+            batch = info.receipts = ReceiptBatch()
+        if batch.add(seq, status) >= self.receipt_batch:
+            self._flush_receipts(info)
+        else:
+            with self.receipt_lock:
+                self.pending_receipts.add(info)
+
+    def _record_rate_limited(self, info, encrypted_frame):
+        """
+        Falha 'rate_limited' para um frame descartado sem decifrar, para quem espera o
+        recibo não ficar pendente. O seq vem do cabeçalho em claro (não autenticado), então
+        só avança o recibo: seq_recv continua sendo o do último frame autenticado. Só vale
+        para sessões que já pediram recibo (o servidor não sabe se este frame pediu).
+        """
+        if len(encrypted_frame) < 52:
+            return
+        seq = int.from_bytes(encrypted_frame[44:52], 'big')  # nonce | sender | target | seq
+        if seq > info.seq_recv and seq > info.receipts.through:
+            self._record_receipt(info, seq, 'rate_limited')
+
+    def _flush_receipts(self, info):
+        # Sob o lock do lote o recibo só entra na fila (a ordem entre recibos vem daí). A
+        # escrita fica para depois: ela dispara callbacks on_done, que podem voltar a este
+        # mesmo lote (ex.: usuários lógicos da mesma conexão trocando mensagens com recibo).
+        result = info.receipts.flush(lambda receipt: self._enqueue_control(info.client_id, receipt))
+        if result is None:
+            return
+        queued, writer = result
+        if queued:
+            self.receipts_sent.inc()
+        if writer is not None:
+            self._flush_outbound(writer)
+
+    def _receipt_loop(self):
+        """Envia os recibos acumulados; só visita sessões com resultados pendentes."""
+        while True:
+            time.sleep(self.receipt_delay)
+            with self.receipt_lock:
+                pending = self.pending_receipts
+                self.pending_receipts = set()
+            for info in pending:
+                self._flush_receipts(info)
+
+    def _history_loop(self):
+        """fsync periódico do segmento ativo e compactação por retenção."""
+        next_compact = time.monotonic() + self.history_compact_interval
+        while True:
+            time.sleep(self.history_sync_interval)
+            try:
+                self.history.sync()
+                if time.monotonic() >= next_compact:
+                    next_compact = time.monotonic() + self.history_compact_interval
+                    self.history.compact()
+            except OSError as e:
+                log.error("history_maintenance_failed", error=str(e))
+
+    def _local_clients(self):
+        with self.client_lock:
+            return [(c, i.name) for c, i in self.connected_clients.items()]
+
+    def _keepalive_loop(self):
+        """Avança o timer wheel e verifica apenas as sessões cujo prazo venceu."""
+        wheel = self.timer_wheel
+        next_tick = time.monotonic() + wheel.tick
+        while True:
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_tick += wheel.tick
+            for client_id in wheel.advance():
+                self._check_idle(client_id)
+
+    def _check_idle(self, client_id):
+        info = self.connected_clients.get(client_id)
+        if info is None:
+            return  # Já desconectado (cancelamento preguiçoso)
+        idle = time.monotonic() - info.last_seen
+        
+        if idle >= self.idle_timeout:
+            self.reaped_clients.inc()
+            log.info("client_reaped", client_id=client_id, idle=round(idle, 3))
+            self.disconnect_client(client_id)
+        elif idle >= self.ping_interval:
+            if self._send_control(client_id, {'type': 'ping', 'ts': time.time()}):
+                self.pings_sent.inc()
+            self.timer_wheel.schedule(client_id, self.idle_timeout - idle)
+        else:
+            self.timer_wheel.schedule(client_id, self.ping_interval - idle)
 
     def _broadcast_client_joined(self, new_client_id):
         """
         Notifica todos os clientes (exceto o novo) sobre a conexão do novo cliente.
         """
+        new_client_info = self.connected_clients.get(new_client_id)
+        if new_client_info is not None:
+            # Não notifica a própria conexão (nem a que hospeda o novo usuário lógico)
+            self._notify_joined(new_client_id, new_client_info.name, new_client_info.session.client_id)
+
+    def _notify_remote_joined(self, client_id, name):
+        """Cliente conectado em outro nó do cluster."""
+        self._notify_joined(client_id, name, None)
+
+    def _notify_joined(self, new_client_id, name, own_connection):
+        writers = []
         try:
             with self.client_lock:
-                new_client_info = self.connected_clients[new_client_id]
-                
                 # Mensagem de notificação
                 notification = {
                     'type': 'client_joined',
                     'client_id': new_client_id,
-                    'client_name': new_client_info['name']
+                    'client_name': name
                 }
                 
-                # Envia para todos os clientes existentes
+                payload = json.dumps(notification).encode('utf-8')
+                
+                # Envia para cada conexão existente. Conexões multiplexadas recebem uma
+                # única notificação e a repassam localmente aos seus usuários lógicos.
                 for client_id, client_info in self.connected_clients.items():
-                    if client_id != new_client_id:  # Não notifica o próprio cliente
+                    if client_id != own_connection and not client_info.is_logical:
                         try:
-                            payload = json.dumps(notification).encode('utf-8')
-                            key = client_info['key_s2c']
-                            seq = client_info['seq_send'] + 1
-                            client_info['seq_send'] = seq
-                            
-                            encrypted_frame = crypto_utils.encrypt_message(key, payload, 0, client_id, seq)
-                            client_info['socket'].sendall(struct.pack('!I', len(encrypted_frame)) + encrypted_frame)
+                            writer = self._send_encrypted(client_info, payload, 0, client_id)
                         except Exception as e:
-                            print(f"[ERRO] Falha ao notificar cliente {client_id}: {e}")
+                            self.metrics.send_errors.inc()
+                            log.error("notify_failed", client_id=client_id, error=str(e))
+                            continue
+                        if writer is not None:
+                            writers.append(writer)
                 
-                print(f"[BROADCAST] Notificação de novo cliente {new_client_id} ({new_client_info['name']}) enviada")
+                log.info("client_joined_broadcast", client_id=new_client_id, name=name)
         except Exception as e:
-            print(f"[ERRO] Erro ao fazer broadcast: {e}")
+            log.error("broadcast_failed", error=str(e))
+        for writer in writers:
+            self._flush_outbound(writer)
+
+    def _register_logical_user(self, client_id, client_info, msg_data):
+        """Cria uma identidade lógica hospedada na conexão `client_id`, sem novo handshake."""
+        ref = msg_data.get('ref')
+        if len(client_info.users) >= self.max_users_per_connection:
+            self._send_control(client_id, {'type': 'error', 'ref': ref, 'message': 'Limite de usuários por conexão atingido'})
+            return
+        
+        name = msg_data.get('name') or 'Anonimo'
+        user_id = self._generate_client_id()
+        with self.client_lock:
+            if client_id not in self.connected_clients:
+                return
+            self.connected_clients[user_id] = LogicalUser(user_id, name, client_info)
+            self.names.add(user_id, name)
+            client_info.users.add(user_id)
+        
+        self._send_control(client_id, {'type': 'user_registered', 'ref': ref, 'client_id': user_id, 'name': name})
+        log.info("logical_user_registered", client_id=user_id, parent_id=client_id, name=name)
+        if self.cluster:
+            self.cluster.announce_join(user_id, name)
+        self._broadcast_client_joined(user_id)
 
     def disconnect_client(self, client_id):
-        if client_id in self.connected_clients:
-            with self.client_lock:
-                try:
-                    self.connected_clients[client_id]['socket'].close()
-                except: pass
-                del self.connected_clients[client_id]
-            print(f"[DESCONEXÃO] Cliente {client_id} saiu.")
+        with self.client_lock:
+            info = self.connected_clients.pop(client_id, None)
+            self.names.remove(client_id)
+            if info is not None and info.is_logical:
+                # Usuário lógico: apenas desvincula da conexão hospedeira
+                info.session.users.discard(client_id)
+            elif info is not None:
+                for user_id in info.users:
+                    self.connected_clients.pop(user_id, None)
+                    self.names.remove(user_id)
+        if info is None:
+            return
+        if self.cluster:
+            self.cluster.announce_leave([client_id] + ([] if info.is_logical else list(info.users)))
+        if info.is_logical:
+            log.info("logical_user_removed", client_id=client_id, parent_id=info.parent_id)
+            return
+        if self.capture is not None:
+            self.capture.disconnect(client_id)
+        # Frames ainda na fila de saída são descartados; quem espera por espaço é acordado
+        self._discard_frames(info.outbound.close())
+        sock = info.socket
+        try:
+            # shutdown acorda a thread bloqueada em recv() deste cliente
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+        try:
+            sock.close()
+        except: pass
+        log.info("client_disconnected", client_id=client_id)
     
+    def _reconnect_hint(self):
+        # Jitter espalha as reconexões e evita uma tempestade de handshakes no novo processo
+        return {
+            'type': 'server_draining',
+            'reconnect_after': round(random.uniform(0, self.reconnect_jitter), 3)
+        }
+
+    def _serve_handoff(self):
+        """Entrega o socket de escuta ao novo processo e inicia a drenagem."""
+        try:
+            handoff.serve_listener(self.handoff_path, self.server_socket)
+        except Exception as e:
+            log.error("handoff_failed", path=self.handoff_path, error=str(e))
+            return
+        log.info("listener_handed_off", path=self.handoff_path)
+        self.drain()
+
+    def drain(self, timeout=None):
+        """
+        Para de aceitar conexões, avisa cada cliente (frame cifrado com dica de
+        reconexão) e aguarda as sessões terminarem; após `timeout` as restantes
+        são desconectadas. Frames em trânsito continuam sendo encaminhados, e o que
+        ainda estiver nas filas de saída tem até DRAIN_FLUSH_TIMEOUT segundos para ser
+        escrito antes da desconexão.
+        """
+        if self.draining:
+            self.drain_done.wait()
+            return
+        self.draining = True
+        self.accepting = False
+        timeout = self.drain_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        
+        writers = []
+        with self.client_lock:
+            clients = [(c, i) for c, i in self.connected_clients.items() if not i.is_logical]
+            for client_id, info in clients:
+                try:
+                    writer = self._send_encrypted(info, json.dumps(self._reconnect_hint()).encode('utf-8'), 0, client_id)
+                except Exception:
+                    self.metrics.send_errors.inc()
+                    continue
+                if writer is not None:
+                    writers.append(writer)
+        for writer in writers:
+            self._flush_outbound(writer)
+        log.info("drain_started", clients=len(clients), timeout=timeout)
+        
+        while self.connected_clients and time.monotonic() < deadline:
+            time.sleep(0.05)
+        
+        sessions = [i for i in list(self.connected_clients.values()) if not i.is_logical]
+        flush_deadline = time.monotonic() + DRAIN_FLUSH_TIMEOUT
+        # Um escritor ativo é uma fila com frames pendentes; disconnect_client os descartaria
+        while any(i.outbound.writing for i in sessions) and time.monotonic() < flush_deadline:
+            time.sleep(0.05)
+        remaining = [i.client_id for i in sessions]
+        for client_id in remaining:
+            self.disconnect_client(client_id)
+        
+        with self.admission_lock:
+            threads = list(self.client_threads)
+        for thread in threads:
+            thread.join(max(0.1, deadline - time.monotonic()))
+        
+        log.info("drain_finished", forced=len(remaining))
+        self.drain_done.set()
+
     def close(self):
+        self.accepting = False
+        if self.ecdh_pool: self.ecdh_pool.stop()
+        if self.decrypt_pool: self.decrypt_pool.shutdown()
+        if self.cluster: self.cluster.stop()
+        if self.relay_flusher: self.relay_flusher.shutdown(wait=False)
+        if self.history: self.history.close()
+        if self.capture: self.capture.close()
         if self.server_socket: self.server_socket.close()
+        if self.metrics_httpd: self.metrics_httpd.shutdown()
 
 if __name__ == "__main__":
-    server = Server()
-    server.start()
\ No newline at end of file
+    def outbound_weights(value):
+        try:
+            return check_weights(int(w) for w in value.split(','))
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"esperado três inteiros positivos, ex.: 8,4,1 (recebido {value!r})")
+
+    parser = argparse.ArgumentParser(description="Servidor de chat seguro")
+    parser.add_argument('host', nargs='?', default='localhost')
+    parser.add_argument('port', nargs='?', type=int, default=5000)
+    parser.add_argument('--unix', metavar='PATH',
+                        help="Escuta em um socket de domínio Unix em vez de TCP (serviços no mesmo host)")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="Porta do endpoint HTTP /metrics (desabilitado por padrão)")
+    parser.add_argument('--metrics-host', default='127.0.0.1')
+    parser.add_argument('--log-level', default='INFO',
+                        help="Nível de log (DEBUG registra cada mensagem encaminhada, com amostragem)")
+    parser.add_argument('--log-sample', action='append', metavar='EVENTO=N',
+                        help="Registra 1 a cada N ocorrências do evento (ex.: message_forwarded=100)")
+    parser.add_argument('--trace', action='store_true',
+                        help="Habilita tracing por estágio (SIGUSR2 grava os traces, SIGUSR1 abre uma janela de profiling)")
+    parser.add_argument('--trace-sample', type=int, default=100, help="Guarda 1 a cada N traces para gravação")
+    parser.add_argument('--trace-file', default='trace.jsonl')
+    parser.add_argument('--profile-seconds', type=float, default=10.0, help="Duração da janela de profiling")
+    parser.add_argument('--idle-timeout', type=float, default=90.0,
+                        help="Segundos sem tráfego até desconectar o cliente (0 desabilita)")
+    parser.add_argument('--ping-interval', type=float, default=30.0,
+                        help="Segundos sem tráfego até enviar um ping cifrado")
+    parser.add_argument('--backlog', type=int, default=128, help="Fila de conexões pendentes do listen()")
+    parser.add_argument('--max-connections', type=int, default=10000)
+    parser.add_argument('--max-connections-per-ip', type=int, default=100)
+    parser.add_argument('--connection-rate', type=float, default=20.0,
+                        help="Novas conexões por segundo por IP (0 desabilita)")
+    parser.add_argument('--message-rate', type=float, default=200.0,
+                        help="Mensagens por segundo por cliente (0 desabilita)")
+    parser.add_argument('--message-rate-per-ip', type=float, default=1000.0,
+                        help="Mensagens por segundo por IP, somando todas as sessões (0 desabilita)")
+    parser.add_argument('--handoff-socket', metavar='PATH',
+                        help="Socket Unix onde um novo processo pode assumir o socket de escuta")
+    parser.add_argument('--takeover', metavar='PATH',
+                        help="Assume o socket de escuta de um processo em execução (via --handoff-socket)")
+    parser.add_argument('--drain-timeout', type=float, default=30.0,
+                        help="Segundos aguardando os clientes saírem durante a drenagem")
+    parser.add_argument('--max-users-per-connection', type=int, default=10000,
+                        help="Usuários lógicos que uma conexão multiplexada pode registrar")
+    parser.add_argument('--ecdh-pool-size', type=int, default=64,
+                        help="Pares ECDH efêmeros pré-gerados para handshakes (0 desabilita)")
+    parser.add_argument('--receipt-batch', type=int, default=64,
+                        help="Resultados pendentes que forçam o envio imediato do recibo de entrega")
+    parser.add_argument('--receipt-delay', type=float, default=0.05,
+                        help="Intervalo máximo (s) de acúmulo dos recibos de entrega")
+    parser.add_argument('--node-id', type=int, default=None,
+                        help="Habilita o modo cluster com este ID de nó (1 a 1023)")
+    parser.add_argument('--cluster-listen', metavar='HOST:PORTA', help="Endereço dos links entre nós")
+    parser.add_argument('--peer', action='append', default=[], metavar='ID=HOST:PORTA',
+                        help="Outro nó do cluster (repita para cada nó)")
+    parser.add_argument('--cluster-secret-file', help="Segredo compartilhado que autentica os links entre nós")
+    parser.add_argument('--history-dir', help="Habilita o histórico durável de mensagens neste diretório")
+    parser.add_argument('--history-key', default=DEFAULT_HISTORY_KEY_PATH,
+                        help="Chave AES-256 de armazenamento do histórico (criada se não existir)")
+    parser.add_argument('--history-retention-days', type=float, default=30.0)
+    parser.add_argument('--history-segment-mb', type=int, default=64, help="Tamanho máximo de cada segmento do log")
+    parser.add_argument('--decrypt-workers', type=int, default=None,
+                        help="Threads do pool de decifração compartilhado (padrão: núcleos da máquina, 0 com um núcleo só; 0 desabilita)")
+    parser.add_argument('--pipeline-window', type=int, default=32,
+                        help="Frames de uma conexão em trânsito pelo pool antes de despachar")
+    parser.add_argument('--outbound-weights', type=outbound_weights, default=DEFAULT_WEIGHTS, metavar='C,I,B',
+                        help="Pesos do DRR das filas de saída: controle, interativo e bulk (inteiros positivos)")
+    parser.add_argument('--bulk-threshold', type=int, default=16 * 1024,
+                        help="Mensagens acima deste tamanho (bytes) vão para a classe bulk")
+    parser.add_argument('--notsent-lowat', type=int, default=128 * 1024,
+                        help="TCP_NOTSENT_LOWAT dos sockets de cliente (0 mantém o padrão do kernel)")
+    parser.add_argument('--cache-ciphers', action='store_true',
+                        help="Guarda os objetos de cifra em cada sessão (menos CPU por frame, ~5 KB a mais por sessão ativa)")
+    parser.add_argument('--capture', metavar='ARQUIVO',
+                        help="Grava a linha do tempo do tráfego (sem conteúdo) para benchmarks/replay.py")
+    parser.add_argument('--cipher-suite', action='append', dest='cipher_suites',
+                        choices=sorted(crypto_utils.CIPHER_SUITES),
+                        help="Suite de cifra aceita (repita para várias; padrão: todas as disponíveis)")
+    parser.add_argument('--key', default=crypto_utils.DEFAULT_PRIVATE_KEY_PATH, help="Chave privada PEM do servidor")
+    parser.add_argument('--cert', default=crypto_utils.DEFAULT_CERT_PATH, help="Certificado X.509 do servidor")
+    args = parser.parse_args()
+
+    def host_port(value):
+        host, _, port = value.rpartition(':')
+        return (host or 'localhost', int(port))
+
+    cluster_options = {}
+    if args.node_id is not None:
+        if not args.cluster_listen or not args.cluster_secret_file:
+            parser.error("--node-id exige --cluster-listen e --cluster-secret-file")
+        cluster_options = dict(
+            node_id=args.node_id,
+            cluster_address=host_port(args.cluster_listen),
+            cluster_peers={int(p.split('=', 1)[0]): host_port(p.split('=', 1)[1]) for p in args.peer},
+            cluster_secret=load_secret(args.cluster_secret_file),
+        )
+
+    log_listener = setup_logging(args.log_level, sample_rates=parse_sample_rates(args.log_sample))
+
+    server = Server(args.host, args.port, metrics_port=args.metrics_port, metrics_host=args.metrics_host,
+                    trace=args.trace, trace_sample_rate=args.trace_sample, trace_file=args.trace_file,
+                    idle_timeout=args.idle_timeout, ping_interval=args.ping_interval,
+                    backlog=args.backlog, max_connections=args.max_connections,
+                    max_connections_per_ip=args.max_connections_per_ip,
+                    connection_rate_per_ip=args.connection_rate, message_rate_per_client=args.message_rate,
+                    message_rate_per_ip=args.message_rate_per_ip,
+                    handoff_path=args.handoff_socket, takeover_path=args.takeover,
+                    drain_timeout=args.drain_timeout, max_users_per_connection=args.max_users_per_connection,
+                    key_path=args.key, cert_path=args.cert, ecdh_pool_size=args.ecdh_pool_size,
+                    receipt_batch=args.receipt_batch, receipt_delay=args.receipt_delay,
+                    transport=from_address(args.host, args.port, args.unix), **cluster_options,
+                    history_dir=args.history_dir, history_key_path=args.history_key,
+                    history_retention=args.history_retention_days * 24 * 3600,
+                    history_segment_size=args.history_segment_mb * 1024 * 1024,
+                    cipher_suites=args.cipher_suites, decrypt_workers=args.decrypt_workers,
+                    pipeline_window=args.pipeline_window,
+                    outbound_weights=args.outbound_weights,
+                    bulk_threshold=args.bulk_threshold, notsent_lowat=args.notsent_lowat,
+                    capture_path=args.capture, cache_ciphers=args.cache_ciphers)
+    install_signal_handlers(server.tracer, SamplingProfiler(duration=args.profile_seconds))
+    # SIGTERM drena as sessões em vez de derrubá-las
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.drain).start())
+    try:
+        server.start()
+    finally:
+        log_listener.stop()
\ No newline at end of file
@@ -0,0 +1,87 @@
+import json
+import queue
+import threading
+import time
+
+from server_utils.log import get_logger
+
+log = get_logger()
+
+# Captura de tráfego para replay (benchmarks/replay.py): a linha do tempo de cada
+# conexão, só com metadados. O conteúdo das mensagens nunca é gravado.
+#
+# JSON lines; a primeira linha é o cabeçalho {"capture": 1, "started": <epoch>}, depois
+# um evento por linha, com `t` em segundos desde o início da captura:
+#   {"t": 0.5, "event": "connect", "conn": 1}
+#   {"t": 0.6, "event": "frame", "conn": 1, "from": 1, "type": "send_message",
+#    "target": 2, "size": 180, "receipt": false}
+#   {"t": 9.1, "event": "disconnect", "conn": 1}
+# `conn` e `from` são client_ids do servidor capturado (`from` difere de `conn` para
+# usuários lógicos); `size` é o tamanho do frame cifrado, sem o prefixo de tamanho.
+#
+# Os eventos passam por uma fila limitada até a thread de escrita, como no log: o
+# caminho de encaminhamento nunca espera pelo disco. Com a fila cheia o evento é
+# descartado e contado em `dropped`.
+
+FORMAT_VERSION = 1
+FRAME_OVERHEAD = 12 + 16 + 16 + 8 + 16  # nonce + remetente + destino + seq + tag AEAD
+
+
+class TrafficCapture:
+    def __init__(self, path, queue_size=100000):
+        self.path = path
+        self.events = 0
+        self.dropped = 0
+        self._start = time.monotonic()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._file = open(path, 'w', encoding='utf-8')
+        self._file.write(json.dumps({'capture': FORMAT_VERSION, 'started': time.time()}) + '\n')
+        self._thread = threading.Thread(target=self._run, name='capture', daemon=True)
+        self._thread.start()
+        log.info("capture_started", path=path)
+
+    def connect(self, conn):
+        self._put({'event': 'connect', 'conn': conn})
+
+    def disconnect(self, conn):
+        self._put({'event': 'disconnect', 'conn': conn})
+
+    def frame(self, conn, origin, msg_type, target, size, receipt=False):
+        self._put({'event': 'frame', 'conn': conn, 'from': origin, 'type': msg_type,
+                   'target': target, 'size': size, 'receipt': receipt})
+
+    def _put(self, event):
+        event['t'] = round(time.monotonic() - self._start, 6)
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            event = self._queue.get()
+            if event is None:
+                break
+            self._file.write(json.dumps(event) + '\n')
+            self.events += 1
+        self._file.close()
+
+    def close(self):
+        """Grava os eventos pendentes e fecha o arquivo."""
+        if not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        self._thread.join(5.0)
+        log.info("capture_closed", path=self.path, events=self.events, dropped=self.dropped)
+
+
+def load(path):
+    """Lê uma captura. Retorna (cabeçalho, eventos em ordem de `t`)."""
+    with open(path, encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        if header.get('capture') != FORMAT_VERSION:
+            raise ValueError(f"Formato de captura desconhecido: {header.get('capture')}")
+        events = [json.loads(line) for line in f if line.strip()]
+    # Eventos de threads diferentes podem chegar à fila fora de ordem
+    events.sort(key=lambda event: event['t'])
+    return header, events
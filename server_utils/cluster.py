@@ -0,0 +1,371 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import socket
+import struct
+import threading
+import time
+
+import cryptography_utils.utils as crypto_utils
+from server_utils.directory import NameIndex
+from server_utils.log import get_logger
+
+log = get_logger()
+
+# Modo cluster: vários nós de relay compartilham um diretório client_id -> nó e
+# encaminham mensagens entre si por links autenticados.
+#
+# Link entre nós: cada lado envia um hello em claro (node_id, chave ECDH efêmera, nonce).
+# O salt do HKDF é o HMAC do segredo do cluster sobre os dois hellos, então só quem
+# conhece o segredo deriva as mesmas chaves; o primeiro frame cifrado ('link_auth')
+# confirma isso. Depois o link usa o mesmo formato de frame dos clientes (AES-GCM com
+# remetente/destino/seq como AAD), com os node_ids no cabeçalho.
+#
+# Para evitar links duplicados, cada nó só disca para peers com node_id maior.
+
+MAX_NODES = 1024  # client_id = contador * MAX_NODES + node_id (IDs únicos no cluster)
+
+
+def load_secret(path):
+    with open(path, 'rb') as f:
+        secret = f.read().strip()
+    if len(secret) < 16:
+        raise ValueError("Segredo do cluster muito curto (mínimo 16 bytes)")
+    return secret
+
+
+class ClusterLink:
+    """Link autenticado com outro nó; envios serializados por lock (seq compartilhado)."""
+
+    def __init__(self, node_id, peer_id, sock, key_send, key_recv):
+        self.node_id = node_id
+        self.peer_id = peer_id
+        self.socket = sock
+        # Importado aqui: `import server` não paga pelo AEAD quando o cluster está desligado
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        self._cipher_send = AESGCM(key_send)
+        self._cipher_recv = AESGCM(key_recv)
+        self._send_lock = threading.Lock()
+        self.seq_send = 0
+        self.seq_recv = 0
+
+    def send(self, message):
+        payload = json.dumps(message).encode('utf-8')
+        with self._send_lock:
+            self.seq_send += 1
+            frame = crypto_utils.encrypt_message(self._cipher_send, payload, self.node_id, self.peer_id, self.seq_send)
+            self.socket.sendall(struct.pack('!I', len(frame)) + frame)
+
+    def recv(self):
+        """Próxima mensagem do peer (None se o link fechar). Frames fora de ordem derrubam o link."""
+        frame = _recv_frame(self.socket)
+        if frame is None:
+            return None
+        plaintext, sender_id, _, seq = crypto_utils.decrypt_message(self._cipher_recv, frame)
+        if sender_id != self.peer_id or seq <= self.seq_recv:
+            raise ConnectionError("Frame inválido ou repetido no link do cluster")
+        self.seq_recv = seq
+        return json.loads(plaintext.decode('utf-8'))
+
+    def close(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+        self.socket.close()
+
+
+class Cluster:
+    """
+    Links com os outros nós e o diretório de clientes remotos.
+
+    O servidor chama announce_join/announce_leave para os seus clientes e
+    lookup/forward para entregar mensagens a clientes em outros nós. Mensagens
+    recebidas de outros nós chegam pelos callbacks:
+      on_relay(message, reply)  -> entregar a um cliente local; se o remetente pediu o
+                                   resultado, reply(status) o devolve ao nó de origem
+                                   (senão reply é None)
+      on_join(client_id, name)  -> notificar os clientes locais
+      local_clients()           -> [(client_id, name), ...] para o snapshot inicial
+    """
+
+    def __init__(self, node_id, secret, listen_address, peers, on_relay, on_join, local_clients,
+                 connect_timeout=5.0, retry_max=10.0):
+        if not 0 < node_id < MAX_NODES:
+            raise ValueError(f"node_id deve estar entre 1 e {MAX_NODES - 1}")
+        self.node_id = node_id
+        self.secret = secret
+        self.listen_address = listen_address
+        self.peers = peers  # {node_id: (host, port)}
+        self.on_relay = on_relay
+        self.on_join = on_join
+        self.local_clients = local_clients
+        self.connect_timeout = connect_timeout
+        self.retry_max = retry_max
+
+        self.links = {}      # {peer_id: ClusterLink}
+        self.directory = {}  # {client_id: (node_id, name)} apenas clientes remotos
+        self.names = NameIndex()  # Busca por nome no diretório (sob self._lock)
+        self._results = {}   # {ref: (ClusterLink, on_result)} relays aguardando o status
+        self._next_ref = 0
+        self._lock = threading.Lock()
+        # Serializa anúncios e snapshots: um 'dir_leave' nunca ultrapassa o snapshot
+        # que ainda continha o cliente
+        self._announce_lock = threading.Lock()
+        self._listener = None
+        self._running = False
+
+    # --- Ciclo de vida ---
+
+    def start(self):
+        self._running = True
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(self.listen_address)
+        self._listener.listen(len(self.peers) + 8)
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        for peer_id, address in self.peers.items():
+            if peer_id > self.node_id:
+                threading.Thread(target=self._dial_loop, args=(peer_id, address), daemon=True).start()
+        log.info("cluster_started", node_id=self.node_id, listen=self.listen_address, peers=sorted(self.peers))
+
+    def stop(self):
+        self._running = False
+        if self._listener: self._listener.close()
+        with self._lock:
+            links = list(self.links.values())
+        for link in links:
+            link.close()
+
+    # --- Diretório e encaminhamento ---
+
+    def lookup(self, client_id):
+        """Retorna (node_id, name) de um cliente remoto, ou None."""
+        return self.directory.get(client_id)
+
+    def remote_clients(self):
+        with self._lock:
+            return [(client_id, name) for client_id, (_, name) in self.directory.items()]
+
+    def search(self, query, prefix=True, limit=20):
+        """Clientes remotos por nome; mesmo formato de NameIndex.search."""
+        with self._lock:
+            return self.names.search(query, prefix, limit)
+
+    def forward(self, node_id, message, on_result=None):
+        """
+        Envia `message` ao nó `node_id`. Retorna False se não houver link ativo. Com
+        `on_result`, o nó do destino devolve o status da entrega ('relay_result') e
+        on_result(status) é chamado na chegada, ou com 'send_failed' se o link cair antes.
+        """
+        link = self.links.get(node_id)
+        if link is None:
+            return False
+        ref = None
+        if on_result is not None:
+            with self._lock:
+                self._next_ref += 1
+                ref = message['ref'] = self._next_ref
+                self._results[ref] = (link, on_result)
+        try:
+            link.send(message)
+            return True
+        except OSError as e:
+            log.warning("cluster_send_failed", peer_id=node_id, error=str(e))
+            link.close()
+            if ref is None:
+                return False
+            with self._lock:
+                # Já resolvido (link derrubado por outra thread): on_result já foi chamado
+                return self._results.pop(ref, None) is None
+
+    def _reply(self, peer_id, ref, status):
+        self.forward(peer_id, {'type': 'relay_result', 'ref': ref, 'status': status})
+
+    def announce_join(self, client_id, name):
+        self._announce({'type': 'dir_join', 'client_id': client_id, 'name': name})
+
+    def announce_leave(self, client_ids):
+        self._announce({'type': 'dir_leave', 'client_ids': list(client_ids)})
+
+    def _announce(self, message):
+        with self._announce_lock:
+            with self._lock:
+                links = list(self.links.values())
+            for link in links:
+                try:
+                    link.send(message)
+                except OSError:
+                    link.close()  # A thread de leitura remove o link
+
+    # --- Links ---
+
+    def _accept_loop(self):
+        while self._running:
+            try:
+                sock, address = self._listener.accept()
+            except OSError:
+                if not self._running: return
+                continue
+            threading.Thread(target=self._run_link, args=(sock, False, None), daemon=True).start()
+
+    def _dial_loop(self, peer_id, address):
+        delay = 0.5
+        while self._running:
+            try:
+                sock = socket.create_connection(address, timeout=self.connect_timeout)
+            except OSError:
+                time.sleep(delay)
+                delay = min(self.retry_max, delay * 2)
+                continue
+            delay = 0.5
+            self._run_link(sock, True, peer_id)
+            if self._running:
+                time.sleep(delay)
+
+    def _handshake(self, sock, dialer, expected_peer):
+        sock.settimeout(self.connect_timeout)
+        sk, pk_pem = crypto_utils.generate_ecdh_pair()
+        hello = json.dumps({
+            'type': 'cluster_hello',
+            'node_id': self.node_id,
+            'public_key': pk_pem.decode('utf-8'),
+            'nonce': base64.b64encode(os.urandom(16)).decode('utf-8'),
+        }).encode('utf-8')
+        sock.sendall(struct.pack('!I', len(hello)) + hello)
+        peer_hello = _recv_frame(sock)
+        if peer_hello is None:
+            raise ConnectionError("Link fechado durante o handshake")
+        peer = json.loads(peer_hello.decode('utf-8'))
+        peer_id = peer['node_id']
+        if peer_id == self.node_id or (expected_peer is not None and peer_id != expected_peer):
+            raise ConnectionError(f"node_id inesperado: {peer_id}")
+
+        # Transcript na ordem discador -> aceitador, igual nos dois lados
+        transcript = hello + peer_hello if dialer else peer_hello + hello
+        salt = hmac.new(self.secret, transcript, hashlib.sha256).digest()
+        shared = crypto_utils.compute_shared_secret(sk, peer['public_key'].encode())
+        key_dial, key_accept = crypto_utils.derive_keys(shared, salt)
+        if dialer:
+            link = ClusterLink(self.node_id, peer_id, sock, key_dial, key_accept)
+        else:
+            link = ClusterLink(self.node_id, peer_id, sock, key_accept, key_dial)
+
+        link.send({'type': 'link_auth'})
+        # Segredo diferente -> chaves diferentes -> falha de autenticação do AES-GCM
+        if (link.recv() or {}).get('type') != 'link_auth':
+            raise ConnectionError("Autenticação do link falhou")
+        sock.settimeout(None)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        return link
+
+    def _run_link(self, sock, dialer, expected_peer):
+        link = None
+        try:
+            try:
+                link = self._handshake(sock, dialer, expected_peer)
+            except Exception as e:
+                log.warning("cluster_auth_failed", dialer=dialer, expected_peer=expected_peer, error=str(e))
+                sock.close()
+                return
+
+            with self._lock:
+                previous = self.links.get(link.peer_id)
+                self.links[link.peer_id] = link
+            if previous is not None:
+                previous.close()
+            with self._announce_lock:
+                link.send({'type': 'dir_snapshot', 'clients': self.local_clients()})
+            log.info("cluster_link_up", peer_id=link.peer_id)
+
+            while True:
+                message = link.recv()
+                if message is None: break
+                self._handle(link, message)
+        except Exception as e:
+            log.warning("cluster_link_error", peer_id=link.peer_id if link else None, error=str(e))
+        finally:
+            if link is not None:
+                self._drop_link(link)
+
+    def _drop_link(self, link):
+        link.close()
+        with self._lock:
+            lost = [ref for ref, (pending_link, _) in self._results.items() if pending_link is link]
+            lost = [self._results.pop(ref)[1] for ref in lost]
+        # O relay pode ou não ter chegado ao destino: o resultado é desconhecido
+        for on_result in lost:
+            on_result('send_failed')
+        with self._lock:
+            if self.links.get(link.peer_id) is not link:
+                return  # Substituído por um link mais novo
+            del self.links[link.peer_id]
+            removed = self._purge(link.peer_id)
+        log.info("cluster_link_down", peer_id=link.peer_id, removed_clients=removed)
+
+    def _purge(self, peer_id):
+        """Remove do diretório os clientes de `peer_id` (chamado sob self._lock)."""
+        stale = [c for c, (node, _) in self.directory.items() if node == peer_id]
+        for client_id in stale:
+            del self.directory[client_id]
+            self.names.remove(client_id)
+        return len(stale)
+
+    def _handle(self, link, message):
+        peer_id = link.peer_id
+        m_type = message.get('type')
+        if m_type == 'relay':
+            ref = message.get('ref')
+            self.on_relay(message, None if ref is None else lambda status: self._reply(peer_id, ref, status))
+        elif m_type == 'relay_result':
+            with self._lock:
+                pending = self._results.get(message.get('ref'))
+                if pending is not None and pending[0].peer_id == peer_id:
+                    del self._results[message['ref']]
+                else:
+                    pending = None
+            if pending is not None:
+                pending[1](message.get('status', 'send_failed'))
+        # Anúncios de diretório só valem pelo link atual do peer: um link substituído
+        # ainda pode ter mensagens antigas em trânsito
+        elif m_type == 'dir_join':
+            with self._lock:
+                if self.links.get(peer_id) is not link:
+                    return
+                self.directory[message['client_id']] = (peer_id, message['name'])
+                self.names.add(message['client_id'], message['name'])
+            self.on_join(message['client_id'], message['name'])
+        elif m_type == 'dir_leave':
+            with self._lock:
+                if self.links.get(peer_id) is not link:
+                    return
+                for client_id in message['client_ids']:
+                    if self.directory.get(client_id, (None,))[0] == peer_id:
+                        del self.directory[client_id]
+                        self.names.remove(client_id)
+        elif m_type == 'dir_snapshot':
+            # O snapshot é a lista completa do peer: substitui tudo o que havia dele
+            with self._lock:
+                if self.links.get(peer_id) is not link:
+                    return
+                self._purge(peer_id)
+                for client_id, name in message['clients']:
+                    self.directory[client_id] = (peer_id, name)
+                    self.names.add(client_id, name)
+
+
+def _recv_frame(sock):
+    header = _recv_exact(sock, 4)
+    if header is None:
+        return None
+    return _recv_exact(sock, struct.unpack('!I', header)[0])
+
+
+def _recv_exact(sock, n):
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk: return None
+        data += chunk
+    return data
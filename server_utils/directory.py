@@ -0,0 +1,67 @@
+import bisect
+
+# Índice de nomes dos clientes conectados, para busca exata e por prefixo no servidor
+# (pedido 'find_users') sem enviar a lista completa de online.
+#
+# Lista ordenada de (nome normalizado, client_id, nome): a busca é uma bisseção até o
+# primeiro nome >= consulta seguida de uma varredura curta, limitada pelo tamanho da
+# página. Entradas com o mesmo nome ficam em ordem de client_id, então o resultado é
+# determinístico. Inserção e remoção deslocam a lista (memmove), o que para alguns
+# milhares de clientes custa menos que os nós de uma trie em Python.
+#
+# Não há lock próprio: quem é dono do índice o atualiza sob o lock que já protege o
+# diretório correspondente (client_lock no servidor, Cluster._lock para os remotos).
+
+
+def normalize(name):
+    """Chave de busca: sem diferença de maiúsculas/minúsculas nem espaços nas pontas."""
+    return str(name).strip().casefold()
+
+
+class NameIndex:
+    __slots__ = ('_entries', '_keys')
+
+    def __init__(self):
+        self._entries = []  # [(chave, client_id, nome)], em ordem
+        self._keys = {}     # {client_id: chave}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, client_id, name):
+        if client_id in self._keys:
+            self.remove(client_id)
+        key = self._keys[client_id] = normalize(name)
+        bisect.insort(self._entries, (key, client_id, name))
+
+    def remove(self, client_id):
+        key = self._keys.pop(client_id, None)
+        if key is None:
+            return
+        # (chave, id) vem antes de (chave, id, nome): bisect_left cai na própria entrada
+        i = bisect.bisect_left(self._entries, (key, client_id))
+        if i < len(self._entries) and self._entries[i][1] == client_id:
+            del self._entries[i]
+
+    def clear(self):
+        self._entries.clear()
+        self._keys.clear()
+
+    def search(self, query, prefix=True, limit=20, exclude=None):
+        """
+        Até `limit` + 1 entradas (chave, client_id, nome) cujo nome é igual a `query` (ou
+        começa com ela, se `prefix`), em ordem de nome. A entrada extra indica que há mais;
+        a chave permite intercalar resultados de índices diferentes (locais e remotos).
+        """
+        key = normalize(query)
+        entries = self._entries
+        results = []
+        for i in range(bisect.bisect_left(entries, (key,)), len(entries)):
+            entry_key, client_id, name = entries[i]
+            if not (entry_key.startswith(key) if prefix else entry_key == key):
+                break
+            if client_id != exclude:
+                results.append((entry_key, client_id, name))
+                if len(results) > limit:
+                    break
+        return results
@@ -0,0 +1,76 @@
+import os
+import socket
+import struct
+
+from server_utils.log import get_logger
+from transport import UnixTransport
+
+log = get_logger()
+
+# Passagem do socket de escuta entre processos via SCM_RIGHTS (apenas Unix).
+# O processo antigo serve o socket de controle; o novo conecta, recebe o fd e
+# confirma, e só então o antigo deixa de aceitar conexões e entra em drenagem.
+#
+# Quem recebe o fd passa a atender os clientes: o socket de controle nasce com modo
+# 0600 e o fd só é entregue a um processo do mesmo usuário (SO_PEERCRED, onde houver).
+
+HANDOFF_MAGIC = b'chat-listener'
+
+
+def supported():
+    return hasattr(socket, 'AF_UNIX') and hasattr(socket, 'send_fds')
+
+
+def _peer_uid(conn):
+    """UID do processo do outro lado, ou None se o sistema não informa."""
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    _, uid, _ = struct.unpack('3i', conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))
+    return uid
+
+
+def serve_listener(path, listener):
+    """
+    Aguarda (bloqueante) um novo processo em `path` e entrega o fd de `listener`.
+    Retorna depois que o novo processo confirma o recebimento; conexões de outro
+    usuário ou que caem sem confirmar são ignoradas (o socket segue conosco). Um
+    socket órfão em `path` é substituído; outro arquivo, ou um processo ainda
+    escutando, é recusado.
+    """
+    control = UnixTransport(path, mode=0o600).listen(1)
+    try:
+        while True:
+            conn, _ = control.accept()
+            with conn:
+                uid = _peer_uid(conn)
+                if uid is not None and uid != os.geteuid():
+                    log.warning("handoff_peer_rejected", path=path, uid=uid)
+                    continue
+                try:
+                    socket.send_fds(conn, [HANDOFF_MAGIC], [listener.fileno()])
+                    # Aguarda o ack para não fechar nossa cópia antes da transferência
+                    confirmed = conn.recv(1) == b'1'
+                except OSError:
+                    confirmed = False
+                if confirmed:
+                    return
+                log.warning("handoff_not_confirmed", path=path, uid=uid)
+    finally:
+        control.close()
+        if os.path.lexists(path):
+            os.unlink(path)
+
+
+def receive_listener(path):
+    """Conecta ao processo antigo em `path` e retorna o socket de escuta herdado."""
+    control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        control.connect(path)
+        msg, fds, _, _ = socket.recv_fds(control, len(HANDOFF_MAGIC), 1)
+        if msg != HANDOFF_MAGIC or not fds:
+            raise ConnectionError("Resposta de handoff inválida")
+        listener = socket.socket(fileno=fds[0])
+        control.sendall(b'1')
+        return listener
+    finally:
+        control.close()
@@ -0,0 +1,341 @@
+import bisect
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+from server_utils.log import get_logger
+
+log = get_logger()
+
+# Log de mensagens append-only, dividido em segmentos e cifrado em repouso.
+#
+# Registro: [tamanho 4B][record_id 8B][nonce 12B][ciphertext + tag]
+#   - tamanho cobre record_id + nonce + ciphertext
+#   - record_id (global e crescente) é o AAD: um registro não pode ser trocado por
+#     outro, mas pode ser copiado para outro segmento na compactação sem recifrar
+#   - o plaintext é JSON: {ts, from_id, from_name, target_id, message}
+#
+# O índice (conversa -> registros em ordem) fica em memória e é reconstruído na
+# abertura decifrando os segmentos; a leitura dos segmentos usa mmap.
+
+RECORD_HEADER = struct.Struct('!IQ')
+NONCE_SIZE = 12
+SEGMENT_NAME = re.compile(r'^segment-(\d{8})\.log$')
+
+
+def load_storage_key(path):
+    """Lê a chave AES-256 de armazenamento, criando-a (modo 0600) se não existir."""
+    try:
+        with open(path, 'rb') as f:
+            key = f.read()
+    except FileNotFoundError:
+        key = os.urandom(32)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(key)
+        log.info("history_key_created", path=path)
+    if len(key) != 32:
+        raise ValueError(f"Chave de armazenamento deve ter 32 bytes: {path}")
+    return key
+
+
+class _Conversation:
+    """Registros de uma conversa em ordem de record_id (listas paralelas)."""
+
+    __slots__ = ('ids', 'ts', 'locations')
+
+    def __init__(self):
+        self.ids = []
+        self.ts = []
+        self.locations = []  # (segmento, offset, tamanho)
+
+
+class _Segment:
+    """Registros vivos de um segmento, para a compactação não percorrer todas as conversas."""
+
+    __slots__ = ('records', 'total')
+
+    def __init__(self):
+        self.records = {}  # {record_id: _Conversation}
+        self.total = 0     # Registros no arquivo, vivos ou não
+
+
+class MessageLog:
+    def __init__(self, directory, storage_key, segment_size=64 * 1024 * 1024,
+                 retention=30 * 24 * 3600.0, compact_ratio=0.5):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.retention = retention
+        self.compact_ratio = compact_ratio
+        # Importado aqui: `import server` não paga pelo AEAD quando o histórico está desligado
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        self._aead = AESGCM(storage_key)
+        self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()  # Uma compactação por vez
+
+        self._conversations = {}  # {(id_menor, id_maior): _Conversation}
+        self._segments = {}       # {segmento: _Segment}
+        self._maps = {}           # {segmento: (mmap, tamanho mapeado)}
+        self._next_record = 1
+        self._last_ts = 0.0
+        self._active = None
+        self._active_fd = None
+        self._active_size = 0
+        self._dirty = False
+
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self._load()
+
+    # --- Escrita ---
+
+    def append(self, from_id, from_name, target_id, message):
+        """Grava uma mensagem entregue. Retorna o record_id."""
+        with self._lock:
+            if self._active_fd is None:
+                raise OSError("Histórico fechado")
+            # ts não decresce: o índice de tempo pode usar busca binária
+            ts = self._last_ts = max(self._last_ts, time.time())
+            record_id = self._next_record
+            self._next_record += 1
+            plaintext = json.dumps({
+                'ts': ts, 'from_id': from_id, 'from_name': from_name,
+                'target_id': target_id, 'message': message,
+            }).encode('utf-8')
+            record = self._seal(record_id, plaintext)
+
+            if self._active_size + len(record) > self.segment_size and self._active_size:
+                self._roll()
+            offset = self._active_size
+            os.write(self._active_fd, record)
+            self._active_size += len(record)
+            self._dirty = True
+            self._index(record_id, ts, from_id, target_id, (self._active, offset, len(record)))
+            return record_id
+
+    def sync(self):
+        """fsync do segmento ativo (chamado periodicamente pelo servidor)."""
+        with self._lock:
+            if self._dirty and self._active_fd is not None:
+                os.fsync(self._active_fd)
+                self._dirty = False
+
+    def _seal(self, record_id, plaintext):
+        nonce = os.urandom(NONCE_SIZE)
+        aad = record_id.to_bytes(8, 'big')
+        body = nonce + self._aead.encrypt(nonce, plaintext, aad)
+        return RECORD_HEADER.pack(8 + len(body), record_id) + body
+
+    def _roll(self):
+        os.fsync(self._active_fd)
+        os.close(self._active_fd)
+        self._open_segment(self._active + 1)
+
+    def _open_segment(self, number):
+        self._active = number
+        self._active_fd = os.open(self._path(number), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self._active_size = os.fstat(self._active_fd).st_size
+        self._segments.setdefault(number, _Segment())
+
+    def _index(self, record_id, ts, from_id, target_id, location):
+        key = (min(from_id, target_id), max(from_id, target_id))
+        conversation = self._conversations.get(key)
+        if conversation is None:
+            conversation = self._conversations[key] = _Conversation()
+        conversation.ids.append(record_id)
+        conversation.ts.append(ts)
+        conversation.locations.append(location)
+        segment = self._segments[location[0]]
+        segment.records[record_id] = conversation
+        segment.total += 1
+
+    # --- Leitura ---
+
+    def fetch(self, client_id, other_id, before=None, since=None, limit=50):
+        """
+        Página da conversa entre `client_id` e `other_id`, em ordem cronológica:
+        até `limit` mensagens com record_id < `before` e ts >= `since`.
+        Retorna (mensagens, cursor) — cursor é o `before` da página anterior, ou None.
+        """
+        with self._lock:
+            conversation = self._conversations.get((min(client_id, other_id), max(client_id, other_id)))
+            if conversation is None:
+                return [], None
+            end = len(conversation.ids) if before is None else bisect.bisect_left(conversation.ids, before)
+            start = 0 if since is None else bisect.bisect_left(conversation.ts, since)
+            first = max(start, end - limit)
+            records = [(conversation.ids[i], self._read(*conversation.locations[i])) for i in range(first, end)]
+            cursor = conversation.ids[first] if first > start else None
+
+        # Decifração fora do lock
+        messages = []
+        for record_id, raw in records:
+            entry = json.loads(self._open(record_id, raw))
+            entry['id'] = record_id
+            messages.append(entry)
+        return messages, cursor
+
+    def _read(self, segment, offset, length):
+        mapped = self._maps.get(segment)
+        if mapped is None or mapped[1] < offset + length:
+            # Segmento novo ou ativo que cresceu desde o último mapeamento
+            if mapped is not None:
+                mapped[0].close()
+            with open(self._path(segment), 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                mapped = self._maps[segment] = (mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ), size)
+        return mapped[0][offset:offset + length]
+
+    def _open(self, record_id, raw):
+        body = raw[RECORD_HEADER.size:]
+        return self._aead.decrypt(body[:NONCE_SIZE], body[NONCE_SIZE:], record_id.to_bytes(8, 'big'))
+
+    # --- Compactação ---
+
+    def compact(self):
+        """
+        Remove mensagens mais antigas que `retention`. Segmentos sem registros vivos são
+        apagados; segmentos com menos de `compact_ratio` vivos são reescritos só com os vivos.
+        A cópia dos registros e o fsync acontecem fora do lock: append e fetch só esperam
+        a troca do arquivo e das posições no índice.
+        """
+        with self._compact_lock:
+            with self._lock:
+                cutoff = time.time() - self.retention
+                expired = 0
+                for key in list(self._conversations):
+                    conversation = self._conversations[key]
+                    n = bisect.bisect_left(conversation.ts, cutoff)
+                    if not n:
+                        continue
+                    for record_id, (segment, _, _) in zip(conversation.ids[:n], conversation.locations[:n]):
+                        del self._segments[segment].records[record_id]
+                    del conversation.ids[:n], conversation.ts[:n], conversation.locations[:n]
+                    expired += n
+                    if not conversation.ids:
+                        del self._conversations[key]
+
+                removed = 0
+                candidates = []
+                for number, segment in sorted(self._segments.items()):
+                    if number == self._active:
+                        continue
+                    if not segment.records:
+                        self._drop_segment(number)
+                        removed += 1
+                    elif len(segment.records) < self.compact_ratio * segment.total:
+                        candidates.append((number, set(segment.records)))
+
+            # Segmentos fora do ativo não recebem mais escritas: a cópia não precisa do lock
+            for number, live in candidates:
+                self._rewrite_segment(number, live)
+        if expired or removed or candidates:
+            log.info("history_compacted", expired=expired, segments_removed=removed, segments_rewritten=len(candidates))
+
+    def _drop_segment(self, segment):
+        mapped = self._maps.pop(segment, None)
+        if mapped is not None:
+            mapped[0].close()
+        del self._segments[segment]
+        os.unlink(self._path(segment))
+
+    def _rewrite_segment(self, number, live):
+        """Copia os registros `live` para um arquivo novo e troca o segmento (só a troca sob o lock)."""
+        tmp_path = self._path(number) + '.compact'
+        locations = {}  # {record_id: (offset, tamanho)} no arquivo novo
+        offset = 0
+        with open(tmp_path, 'wb') as out:
+            for record_id, _, raw in self._scan(number):
+                if record_id not in live:
+                    continue
+                out.write(raw)
+                locations[record_id] = (offset, len(raw))
+                offset += len(raw)
+            out.flush()
+            os.fsync(out.fileno())
+
+        with self._lock:
+            segment = self._segments[number]
+            for record_id, conversation in segment.records.items():
+                i = bisect.bisect_left(conversation.ids, record_id)
+                conversation.locations[i] = (number, *locations[record_id])
+            mapped = self._maps.pop(number, None)
+            if mapped is not None:
+                mapped[0].close()
+            os.replace(tmp_path, self._path(number))
+            segment.total = len(locations)
+
+    # --- Abertura ---
+
+    def _path(self, number):
+        return os.path.join(self.directory, f'segment-{number:08d}.log')
+
+    def _scan(self, segment):
+        """Itera (record_id, offset, bytes) de um segmento; para no primeiro registro incompleto."""
+        with open(self._path(segment), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as data:
+                offset = 0
+                while offset + RECORD_HEADER.size <= size:
+                    length, record_id = RECORD_HEADER.unpack_from(data, offset)
+                    end = offset + 4 + length
+                    if end > size:
+                        break
+                    yield record_id, offset, data[offset:end]
+                    offset = end
+
+    def _load(self):
+        numbers = sorted(int(m.group(1)) for m in map(SEGMENT_NAME.match, os.listdir(self.directory)) if m)
+        records = 0
+        for number in numbers:
+            self._segments[number] = _Segment()
+            valid_end = 0
+            for record_id, offset, raw in self._scan(number):
+                entry = json.loads(self._open(record_id, raw))
+                self._index(record_id, entry['ts'], entry['from_id'], entry['target_id'], (number, offset, len(raw)))
+                self._next_record = max(self._next_record, record_id + 1)
+                self._last_ts = max(self._last_ts, entry['ts'])
+                valid_end = offset + len(raw)
+                records += 1
+            if number == numbers[-1] and os.path.getsize(self._path(number)) > valid_end:
+                # Escrita interrompida (queda do processo): descarta o registro parcial
+                os.truncate(self._path(number), valid_end)
+        self._open_segment(numbers[-1] if numbers else 1)
+        log.info("history_loaded", directory=self.directory, segments=len(self._segments), records=records)
+
+    # --- IDs de cliente ---
+
+    def reserve_ids(self, upto):
+        """
+        Persiste o maior client_id que pode ter sido atribuído. Na reinicialização o
+        servidor continua daí, então um ID nunca é reutilizado e o histórico de uma
+        conversa não fica acessível a um cliente novo com o mesmo ID.
+        """
+        path = os.path.join(self.directory, 'client_ids')
+        with open(path + '.tmp', 'w') as f:
+            f.write(str(upto))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def reserved_ids(self):
+        try:
+            with open(os.path.join(self.directory, 'client_ids')) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def close(self):
+        with self._lock:
+            if self._active_fd is not None:
+                os.fsync(self._active_fd)
+                os.close(self._active_fd)
+                self._active_fd = None
+            for mapped, _ in self._maps.values():
+                mapped.close()
+            self._maps.clear()
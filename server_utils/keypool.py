@@ -0,0 +1,60 @@
+import queue
+import threading
+
+import cryptography_utils.utils as crypto_utils
+
+
+class EphemeralKeyPool:
+    """
+    Pool de pares ECDH efêmeros pré-gerados (chave privada + PEM público já serializado).
+    Cada par é entregue uma única vez e nunca persistido, preservando o sigilo perfeito;
+    apenas a geração sai do caminho crítico do handshake.
+    Uma thread em background repõe o pool quando ele cai abaixo de `low_water`.
+    Se o pool esvaziar (rajada de conexões), o par é gerado na hora.
+    """
+
+    def __init__(self, size=64, low_water=None, hits=None, misses=None):
+        self.size = size
+        self.low_water = low_water if low_water is not None else size // 2
+        self._keys = queue.Queue(maxsize=size)
+        self._refill = threading.Event()
+        self._stopped = False
+        self._thread = None
+        # Contadores opcionais (server_utils.metrics.Counter)
+        self._hits = hits
+        self._misses = misses
+
+    def start(self):
+        if self._thread is None:
+            self._refill.set()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self._refill.set()
+
+    def take(self):
+        """Retorna (private_key, public_key_pem) de uso único."""
+        try:
+            pair = self._keys.get_nowait()
+            if self._hits is not None: self._hits.inc()
+        except queue.Empty:
+            pair = crypto_utils.generate_ecdh_pair()
+            if self._misses is not None: self._misses.inc()
+        if self._keys.qsize() < self.low_water:
+            self._refill.set()
+        return pair
+
+    def _run(self):
+        while not self._stopped:
+            self._refill.wait()
+            self._refill.clear()
+            while not self._stopped and not self._keys.full():
+                try:
+                    self._keys.put_nowait(crypto_utils.generate_ecdh_pair())
+                except queue.Full:
+                    break
+
+    def available(self):
+        return self._keys.qsize()
@@ -0,0 +1,157 @@
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+
+LOGGER_NAME = 'chat.server'
+
+# Eventos de alta frequência e a taxa de amostragem padrão (1 a cada N).
+DEFAULT_SAMPLE_RATES = {
+    'message_forwarded': 100,
+    'replay_detected': 10,
+    'rate_limited': 100,
+}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formata cada registro como uma linha JSON."""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 6),
+            'level': record.levelname.lower(),
+            'event': record.getMessage(),
+        }
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        sampled = getattr(record, 'sample_rate', None)
+        if sampled:
+            entry['sample_rate'] = sampled
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Mantém apenas 1 a cada N registros dos eventos configurados.
+    Eventos fora da tabela passam sempre.
+    """
+
+    def __init__(self, rates=None):
+        super().__init__()
+        self.rates = dict(rates or {})
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        rate = self.rates.get(record.msg)
+        if not rate or rate <= 1:
+            return True
+        with self._lock:
+            n = self._counters.get(record.msg, 0)
+            self._counters[record.msg] = n + 1
+        if n % rate:
+            return False
+        record.sample_rate = rate
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler que nunca bloqueia: se a fila estiver cheia o registro é
+    descartado e contabilizado em `dropped`.
+    """
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # A formatação fica para a thread do listener; apenas congela args/exc_info.
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class StructuredLogger:
+    """
+    Fachada fina sobre logging.Logger: `log.info('evento', campo=valor)`.
+    Verifica o nível antes de montar o registro para custo mínimo quando desabilitado.
+    """
+
+    __slots__ = ('_logger',)
+
+    def __init__(self, logger):
+        self._logger = logger
+
+    def _log(self, level, event, fields, exc_info=False):
+        if self._logger.isEnabledFor(level):
+            self._logger.log(level, event, extra={'fields': fields}, exc_info=exc_info)
+
+    def debug(self, event, **fields):
+        self._log(logging.DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        self._log(logging.INFO, event, fields)
+
+    def warning(self, event, **fields):
+        self._log(logging.WARNING, event, fields)
+
+    def error(self, event, exc_info=False, **fields):
+        self._log(logging.ERROR, event, fields, exc_info)
+
+    def is_enabled_for(self, level):
+        return self._logger.isEnabledFor(level)
+
+
+def get_logger(name=LOGGER_NAME):
+    return StructuredLogger(logging.getLogger(name))
+
+
+def setup_logging(level='INFO', stream=None, sample_rates=None, queue_size=10000):
+    """
+    Configura o logger do servidor: filtro de amostragem -> fila limitada ->
+    QueueListener (thread em background) -> StreamHandler com JSON lines.
+    Retorna o QueueListener já iniciado (chame .stop() no encerramento).
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(level.upper() if isinstance(level, str) else level)
+    logger.propagate = False
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter())
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    queue_handler = DroppingQueueHandler(log_queue)
+    rates = DEFAULT_SAMPLE_RATES if sample_rates is None else sample_rates
+    queue_handler.addFilter(SamplingFilter(rates))
+    logger.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def parse_sample_rates(specs):
+    """Converte ['evento=N', ...] em {'evento': N}, sobre os padrões."""
+    rates = dict(DEFAULT_SAMPLE_RATES)
+    for spec in specs or []:
+        event, _, rate = spec.partition('=')
+        rates[event.strip()] = int(rate)
+    return rates
@@ -0,0 +1,275 @@
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Buckets padrão (segundos), do microssegundo até alguns segundos.
+DEFAULT_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+)
+
+# Buckets para tamanhos em bytes.
+SIZE_BUCKETS = (64, 128, 256, 512, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+# Contadores e gauges não usam lock no inc(): com o GIL, `self.value += amount` num
+# atributo de slot não é interrompido por outra thread (a troca só acontece em chamadas
+# e saltos para trás do bytecode). Em um build sem GIL o pior caso é perder incrementos
+# de uma métrica, nunca corromper estado do relay.
+
+class Counter:
+    """Contador monotônico."""
+
+    __slots__ = ('name', 'help', 'value')
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def render(self):
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} counter",
+            f"{self.name} {self.value}",
+        ]
+
+
+class Gauge:
+    """Valor instantâneo que pode subir ou descer."""
+
+    __slots__ = ('name', 'help', 'value', '_fn')
+
+    def __init__(self, name, help='', fn=None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        # Se fornecida, a função é avaliada apenas na coleta (custo zero no hot path)
+        self._fn = fn
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, fn):
+        self._fn = fn
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def render(self):
+        value = self._fn() if self._fn else self.value
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {value}",
+        ]
+
+
+class Histogram:
+    """Histograma de buckets fixos (cumulativos na exportação)."""
+
+    __slots__ = ('name', 'help', 'buckets', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, name, help='', buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # Último slot é o bucket +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value, count=1):
+        """Registra `value` (`count` vezes, para observações amostradas)."""
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[idx] += count
+            self.sum += value * count
+            self.count += count
+
+    def time(self):
+        return _Timer(self)
+
+    def render(self):
+        with self._lock:
+            counts = list(self.counts)
+            total_sum = self.sum
+            total_count = self.count
+
+        lines = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} histogram",
+        ]
+        cumulative = 0
+        for bound, c in zip(self.buckets, counts):
+            cumulative += c
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {total_count}')
+        lines.append(f"{self.name}_sum {total_sum}")
+        lines.append(f"{self.name}_count {total_count}")
+        return lines
+
+
+class _Timer:
+    """Context manager que observa a duração do bloco em um histograma."""
+
+    __slots__ = ('_hist', '_start')
+
+    def __init__(self, hist):
+        self._hist = hist
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._hist.observe(time.perf_counter() - self._start)
+        return False
+
+
+class MetricsRegistry:
+    """Agrupa as métricas e gera o formato texto do Prometheus."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                return self._metrics[metric.name]
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help=''):
+        return self._register(Counter(name, help))
+
+    def gauge(self, name, help='', fn=None):
+        return self._register(Gauge(name, help, fn))
+
+    def histogram(self, name, help='', buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, buckets))
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class ServerMetrics:
+    """Conjunto de métricas do relay."""
+
+    def __init__(self, registry=None):
+        self.registry = registry or MetricsRegistry()
+        r = self.registry
+
+        self.handshake_seconds = r.histogram('chat_handshake_seconds', 'Duração do handshake ECDHE + assinatura do servidor')
+        self.handshake_failures = r.counter('chat_handshake_failures_total', 'Handshakes que falharam')
+        self.decrypt_seconds = r.histogram('chat_decrypt_seconds', 'Tempo de decifração por frame (suite negociada)')
+        self.encrypt_seconds = r.histogram('chat_encrypt_seconds', 'Tempo de cifração por frame (suite negociada)')
+        self.lock_wait_seconds = r.histogram('chat_lock_wait_seconds', 'Tempo de espera pelo client_lock')
+        self.frames_in = r.counter('chat_frames_in_total', 'Frames recebidos dos clientes')
+        self.frames_out = r.counter('chat_frames_out_total', 'Frames enviados aos clientes')
+        self.bytes_in = r.counter('chat_bytes_in_total', 'Bytes recebidos (incluindo prefixo de tamanho)')
+        self.bytes_out = r.counter('chat_bytes_out_total', 'Bytes enviados (incluindo prefixo de tamanho)')
+        self.frame_size = r.histogram('chat_frame_size_bytes', 'Tamanho dos frames recebidos', SIZE_BUCKETS)
+        self.replay_drops = r.counter('chat_replay_drops_total', 'Frames descartados por replay')
+        self.crypto_errors = r.counter('chat_crypto_errors_total', 'Frames com falha de autenticação/decifração')
+        self.send_errors = r.counter('chat_send_errors_total', 'Falhas de envio para clientes')
+        self.connections = r.counter('chat_connections_total', 'Conexões TCP aceitas')
+        self.connected_clients = r.gauge('chat_connected_clients', 'Clientes com sessão estabelecida')
+
+    def render(self):
+        return self.registry.render()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Silencia o log padrão do http.server
+        pass
+
+
+def start_metrics_server(registry, host='127.0.0.1', port=9100):
+    """
+    Sobe o endpoint HTTP /metrics em uma thread daemon.
+    Retorna o ThreadingHTTPServer (use .shutdown() para encerrar).
+    """
+    handler = type('MetricsHandler', (_MetricsHandler,), {'registry': registry})
+    httpd = ThreadingHTTPServer((host, port), handler)
+    httpd.daemon_threads = True
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    return httpd
+
+
+class TimedLock:
+    """
+    Lock que registra o tempo de espera pela aquisição em um histograma.
+    Usado no lugar de threading.Lock em `with self.client_lock:`.
+
+    Só a aquisição disputada é cronometrada. As livres (espera zero, a maioria) são
+    contadas sob o próprio lock e registradas em lote a cada `sample`, sem relógio.
+    """
+
+    __slots__ = ('_lock', '_hist', '_sample', '_free')
+
+    def __init__(self, hist, sample=64):
+        self._lock = threading.Lock()
+        self._hist = hist
+        self._sample = sample
+        self._free = 0
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(False):
+            self._free += 1  # Protegido pelo lock recém-adquirido
+            if self._free >= self._sample:
+                self._hist.observe(0.0, self._free)
+                self._free = 0
+            return True
+        if not blocking:
+            return False
+        start = time.perf_counter()
+        acquired = self._lock.acquire(True, timeout)
+        self._hist.observe(time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self._lock.release()
+        return False
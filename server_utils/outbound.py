@@ -0,0 +1,176 @@
+import collections
+import functools
+import threading
+import time
+
+# Fila de saída por conexão, com três classes de tráfego:
+#   CONTROL     - presença, lista de online, ping/pong, recibos, respostas a pedidos
+#   INTERACTIVE - mensagens de chat
+#   BULK        - páginas de histórico e mensagens grandes
+#
+# As classes são servidas por deficit round robin (DRR) ponderado em bytes: a cada
+# rodada a classe recebe `quantum * peso` bytes de crédito. Um frame de controle que
+# chega durante uma rajada espera no máximo um quantum de bulk, e não a fila inteira.
+#
+# Não há thread de escrita por conexão: quem enfileira num destino sem escritor ativo
+# vira o escritor e esvazia a fila (ver Server._flush_outbound). O seq e a cifragem
+# são aplicados na escrita, então o reordenamento entre classes não quebra a
+# verificação de replay do cliente.
+#
+# Há uma fila por conexão e a maioria fica ociosa: as deques de cada classe, o contador de
+# remetentes em bulk, os déficits e a Condition do backpressure só são criados no primeiro
+# uso. Uma fila nunca usada custa algumas centenas de bytes em vez de ~3,9 KB.
+
+CONTROL, INTERACTIVE, BULK = 0, 1, 2
+CLASS_NAMES = ('control', 'interactive', 'bulk')
+DEFAULT_WEIGHTS = (8, 4, 1)
+
+
+def check_weights(weights):
+    """
+    Pesos do DRR: exatamente três inteiros positivos (controle, interativo, bulk). Um
+    peso zero deixaria a classe sem crédito e o take() girando para sempre com o lock.
+    Retorna a tupla; levanta ValueError se inválidos.
+    """
+    weights = tuple(weights)
+    if len(weights) != 3 or not all(isinstance(w, int) and w > 0 for w in weights):
+        raise ValueError(f"Pesos do DRR precisam ser três inteiros positivos: {weights}")
+    return weights
+
+
+@functools.lru_cache(maxsize=None)
+def _quanta(weights, quantum):
+    # Compartilhado entre as filas com a mesma configuração
+    return tuple(quantum * w for w in check_weights(weights))
+
+
+class OutboundFrame:
+    __slots__ = ('payload', 'sender_id', 'target_id', 'sealed', 'trace', 'queued_at', 'on_done')
+
+    def __init__(self, payload, sender_id, target_id, sealed=False, trace=None, on_done=None):
+        self.payload = payload
+        self.sender_id = sender_id
+        self.target_id = target_id
+        self.sealed = sealed  # Frame E2E já pronto: enviado sem cifrar
+        self.trace = trace
+        self.queued_at = time.perf_counter()
+        self.on_done = on_done  # on_done(status): 'delivered' após a escrita, 'send_failed' se descartado
+
+
+class OutboundQueue:
+    """
+    Frames pendentes de uma conexão. Uma mensagem de um remetente que ainda tem frames
+    em BULK nesta fila vai para BULK também: as mensagens de um remetente nunca se
+    ultrapassam, mesmo quando só algumas delas são grandes.
+    """
+
+    __slots__ = ('quanta', 'max_bytes', '_queues', '_deficit', '_turn', '_bulk_senders',
+                 '_lock', '_cond', 'pending_bytes', 'writing', 'closed')
+
+    def __init__(self, weights=DEFAULT_WEIGHTS, quantum=4096, max_bytes=8 * 1024 * 1024):
+        if quantum <= 0:
+            raise ValueError(f"Quantum do DRR precisa ser positivo: {quantum}")
+        self.quanta = _quanta(tuple(weights), quantum)
+        self.max_bytes = max_bytes
+        self._queues = [None, None, None]  # deque por classe, criada no primeiro frame dela
+        self._deficit = None  # Só existe depois da primeira disputa entre classes
+        self._turn = CONTROL
+        self._bulk_senders = None  # Counter, no primeiro frame em BULK
+        self._lock = threading.Lock()
+        self._cond = None  # Condition sobre _lock, só para o backpressure
+        self.pending_bytes = 0
+        self.writing = False
+        self.closed = False
+
+    def put(self, frame, traffic):
+        """
+        Enfileira `frame` na classe `traffic`. Retorna True se quem chamou virou o
+        escritor e deve esvaziar a fila. Levanta ConnectionError se a conexão caiu.
+        """
+        with self._lock:
+            if self.closed:
+                raise ConnectionError("Conexão encerrada")
+            if traffic == INTERACTIVE and self._bulk_senders and frame.sender_id in self._bulk_senders:
+                traffic = BULK
+            if traffic == BULK:
+                if self._bulk_senders is None:
+                    self._bulk_senders = collections.Counter()
+                self._bulk_senders[frame.sender_id] += 1
+            queue = self._queues[traffic]
+            if queue is None:
+                queue = self._queues[traffic] = collections.deque()
+            queue.append(frame)
+            self.pending_bytes += len(frame.payload)
+            if self.writing:
+                return False
+            self.writing = True
+            return True
+
+    def take(self):
+        """
+        Próximo (frame, classe) pelo DRR; só o escritor chama. Com a fila vazia devolve
+        (None, None) e libera o papel de escritor.
+        """
+        with self._lock:
+            queues = self._queues
+            control, interactive, bulk = queues
+            if not (control or interactive or bulk):
+                self.writing = False
+                return None, None
+            if bool(control) + bool(interactive) + bool(bulk) == 1:
+                # Uma classe só: sem disputa, o DRR não tem o que decidir
+                turn = CONTROL if control else INTERACTIVE if interactive else BULK
+                return self._pop(queues[turn], turn), turn
+            deficit = self._deficit
+            if deficit is None:
+                deficit = self._deficit = [self.quanta[CONTROL], 0, 0]
+            while True:
+                turn = self._turn
+                queue = queues[turn]
+                if queue and deficit[turn] >= len(queue[0].payload):
+                    frame = self._pop(queue, turn)
+                    deficit[turn] -= len(frame.payload)
+                    if not queue:
+                        deficit[turn] = 0
+                    return frame, turn
+                if not queue:
+                    deficit[turn] = 0
+                self._turn = turn = (turn + 1) % 3
+                deficit[turn] += self.quanta[turn]
+
+    def _pop(self, queue, turn):
+        frame = queue.popleft()
+        size = len(frame.payload)
+        if turn == BULK:
+            count = self._bulk_senders[frame.sender_id] - 1
+            if count:
+                self._bulk_senders[frame.sender_id] = count
+            else:
+                del self._bulk_senders[frame.sender_id]
+        self.pending_bytes -= size
+        if self._cond is not None and self.pending_bytes <= self.max_bytes < self.pending_bytes + size:
+            self._cond.notify_all()  # Cruzou o limite: libera o backpressure
+        return frame
+
+    def wait_writable(self):
+        """Backpressure: aguarda a fila baixar de `max_bytes` (ou a conexão cair)."""
+        with self._lock:
+            if self._cond is None:
+                self._cond = threading.Condition(self._lock)
+            while self.pending_bytes > self.max_bytes and not self.closed:
+                self._cond.wait()
+
+    def depths(self):
+        return [len(queue) if queue else 0 for queue in self._queues]
+
+    def close(self):
+        """Descarta os frames pendentes e acorda quem espera. Retorna os frames descartados."""
+        with self._lock:
+            dropped = [frame for queue in self._queues if queue for frame in queue]
+            self._queues = [None, None, None]
+            self._bulk_senders = None
+            self.pending_bytes = 0
+            self.closed = True
+            if self._cond is not None:
+                self._cond.notify_all()
+            return dropped
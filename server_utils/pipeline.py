@@ -0,0 +1,96 @@
+import collections
+import select
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Recebimento em estágios por conexão:
+#   leitor (thread da conexão) -> pool compartilhado de decifração + parse -> despacho em ordem
+#
+# A thread da conexão lê frames enquanto houver dados prontos no socket e entrega a
+# decifração e o json.loads ao pool; quando o socket esvazia (ou a janela enche) ela
+# despacha os resultados na ordem de chegada, então replay, seq e roteamento não mudam.
+# Um frame isolado (tráfego interativo) é processado na própria thread, sem o custo
+# da troca de thread. A cryptography libera o GIL durante o AEAD, então rajadas de
+# um mesmo cliente passam a usar mais de um núcleo.
+
+AVAILABLE = hasattr(select, 'poll')
+
+
+class DecryptPool:
+    """
+    Workers compartilhados por todas as conexões. `decode(cipher, frame, trace)` é a
+    função do estágio (decifra e faz o parse); exceções ficam no future e são tratadas
+    pelo despacho, na ordem do frame.
+    """
+
+    def __init__(self, workers, decode):
+        self.workers = workers
+        self._decode = decode
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='decrypt')
+        self._lock = threading.Lock()
+        self.queued = 0     # Frames aguardando um worker
+        self.in_flight = 0  # Frames lidos e ainda não despachados, em todas as conexões
+
+    def submit(self, cipher, frame, trace):
+        with self._lock:
+            self.queued += 1
+        return self._executor.submit(self._run, cipher, frame, trace)
+
+    def _run(self, cipher, frame, trace):
+        with self._lock:
+            self.queued -= 1
+        if trace: trace.mark('queue')
+        return self._decode(cipher, frame, trace)
+
+    def track(self, delta):
+        with self._lock:
+            self.in_flight += delta
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ReceivePipeline:
+    """
+    Frames de uma conexão em trânsito, na ordem de chegada: (job, frame, sealed, trace).
+    `job` é o future do pool, ou None para frames selados (E2E), que não passam pela
+    decifração mas esperam a vez para não ultrapassar os anteriores.
+    """
+
+    __slots__ = ('pool', 'window', '_pending', '_poller')
+
+    def __init__(self, pool, sock, window):
+        self.pool = pool
+        self.window = window
+        self._pending = collections.deque()
+        self._poller = select.poll()
+        self._poller.register(sock, select.POLLIN)
+
+    @property
+    def pending(self):
+        return bool(self._pending)
+
+    @property
+    def full(self):
+        return len(self._pending) >= self.window
+
+    def readable(self):
+        """Há bytes (ou EOF) prontos no socket? Não bloqueia."""
+        return bool(self._poller.poll(0))
+
+    def push(self, cipher, frame, trace):
+        self.pool.track(1)
+        self._pending.append((self.pool.submit(cipher, frame, trace), frame, False, trace))
+
+    def push_sealed(self, frame, trace):
+        self.pool.track(1)
+        self._pending.append((None, frame, True, trace))
+
+    def pop(self):
+        self.pool.track(-1)
+        return self._pending.popleft()
+
+    def discard(self):
+        """Conexão encerrada: resultados ainda não despachados são abandonados."""
+        self.pool.track(-len(self._pending))
+        self._pending.clear()
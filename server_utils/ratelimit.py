@@ -0,0 +1,68 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket clássico: `rate` tokens por segundo, capacidade `burst`.
+    Não é thread-safe por si só; use via KeyedRateLimiter ou com lock externo.
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def consume(self, now, amount=1):
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self.updated = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+
+class KeyedRateLimiter:
+    """
+    Um token bucket por chave (client_id, endereço IP...).
+    Buckets cheios e ociosos são removidos periodicamente para não acumular memória.
+    """
+
+    def __init__(self, rate, burst=None, prune_interval=60.0):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.prune_interval = prune_interval
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._last_prune = time.monotonic()
+
+    def allow(self, key, amount=1):
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+            allowed = bucket.consume(now, amount)
+            if now - self._last_prune >= self.prune_interval:
+                self._prune(now)
+        return allowed
+
+    def forget(self, key):
+        with self._lock:
+            self._buckets.pop(key, None)
+
+    def _prune(self, now):
+        # Um bucket ocioso há tempo suficiente para reencher por completo equivale a um novo
+        refill_time = self.burst / self.rate
+        stale = [k for k, b in self._buckets.items() if now - b.updated >= refill_time]
+        for key in stale:
+            del self._buckets[key]
+        self._last_prune = now
+
+    def __len__(self):
+        return len(self._buckets)
@@ -0,0 +1,73 @@
+import threading
+
+
+class ReceiptBatch:
+    """
+    Recibos de entrega pendentes de uma sessão, indexados pelo seq do frame do remetente.
+    Os seqs entregues são guardados como intervalos [início, fim] (um remetente envia
+    seqs crescentes, então rajadas viram um único intervalo); falhas vão à parte com o motivo.
+    `through` é cumulativo: todo seq <= through já foi processado, e um seq que pediu
+    recibo mas não aparece em nenhuma lista foi descartado (ex.: replay). Frames
+    descartados por rate limiting aparecem em `failed` como 'rate_limited'.
+
+    Um frame enfileirado para o destino só tem resultado quando é escrito (ou
+    descartado): expect() o registra antes, e `through` não passa dele até lá.
+    """
+
+    __slots__ = ('delivered', 'failed', 'through', 'count', '_unresolved', '_last', '_lock', '_flush_lock')
+
+    def __init__(self):
+        self.delivered = []
+        self.failed = []
+        self.through = 0
+        self.count = 0
+        self._unresolved = {}  # {seq: None}, em ordem de seq (o remetente envia seqs crescentes)
+        self._last = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def expect(self, seq):
+        """Frame `seq` aguarda o resultado da escrita (entregue depois com add)."""
+        with self._lock:
+            self._unresolved[seq] = None
+
+    def add(self, seq, status):
+        """Registra o resultado de um frame. Retorna o total pendente."""
+        with self._lock:
+            if status == 'delivered':
+                ranges = self.delivered
+                if ranges and ranges[-1][1] == seq - 1:
+                    ranges[-1][1] = seq
+                else:
+                    ranges.append([seq, seq])
+            else:
+                self.failed.append([seq, status])
+            unresolved = self._unresolved
+            unresolved.pop(seq, None)
+            self._last = last = max(self._last, seq)
+            self.through = min(last, next(iter(unresolved)) - 1) if unresolved else last
+            self.count += 1
+            return self.count
+
+    def flush(self, enqueue):
+        """
+        Passa o recibo acumulado para `enqueue` (se houver) e retorna o resultado dele, ou
+        None. Os recibos da mesma sessão entram na fila em série: um recibo com `through`
+        maior nunca ultrapassa um anterior. `enqueue` só pode enfileirar, nunca escrever:
+        a escrita dispara callbacks que podem voltar a este lote, e o lock não é reentrante.
+        """
+        with self._flush_lock:
+            receipt = self.take()
+            return None if receipt is None else enqueue(receipt)
+
+    def take(self):
+        """Retorna e zera o recibo acumulado (None se vazio)."""
+        with self._lock:
+            if not self.count:
+                return None
+            receipt = {'type': 'receipt', 'through': self.through,
+                       'delivered': self.delivered, 'failed': self.failed}
+            self.delivered = []
+            self.failed = []
+            self.count = 0
+            return receipt
@@ -0,0 +1,117 @@
+import collections
+import time
+
+import cryptography_utils.utils as crypto_utils
+
+
+class ClientSession:
+    """
+    Estado de uma conexão autenticada. Com __slots__ não há __dict__ por
+    instância: menos memória por sessão e acesso a atributo mais rápido que
+    lookups por string em um dict. O objeto AEAD da suite negociada é criado a
+    cada frame; CachedCipherSession o guarda na sessão.
+    """
+
+    __slots__ = (
+        'client_id', 'socket', 'address', 'name',
+        'key_c2s', 'key_s2c', 'suite',
+        'seq_recv', 'seq_send', 'last_seen', 'users', 'receipts', 'prekey_bundle', 'outbound',
+    )
+
+    is_logical = False
+
+    def __init__(self, client_id, sock, address, name, key_c2s, key_s2c, suite=crypto_utils.DEFAULT_SUITE):
+        self.client_id = client_id
+        self.socket = sock
+        self.address = address
+        self.name = name
+        self.key_c2s = key_c2s
+        self.key_s2c = key_s2c
+        self.suite = suite
+        self.seq_recv = 0  # Último recebido do cliente
+        self.seq_send = 0  # Último enviado ao cliente
+        self.last_seen = time.monotonic()
+        self.users = set()  # IDs lógicos multiplexados nesta conexão
+        self.receipts = None  # ReceiptBatch, criado no primeiro pedido de recibo
+        self.prekey_bundle = None  # PrekeyBundle publicado pelo cliente (modo E2E)
+        self.outbound = None  # OutboundQueue, atribuída pelo servidor após o handshake
+
+    @property
+    def cipher_c2s(self):
+        return crypto_utils.new_cipher(self.suite, self.key_c2s)
+
+    @property
+    def cipher_s2c(self):
+        return crypto_utils.new_cipher(self.suite, self.key_s2c)
+
+    @property
+    def session(self):
+        """Sessão que transporta os frames (a própria conexão)."""
+        return self
+
+    def __repr__(self):
+        return f"ClientSession(id={self.client_id}, name={self.name!r})"
+
+
+class CachedCipherSession(ClientSession):
+    """
+    ClientSession que guarda os objetos AEAD (criados no primeiro frame em cada
+    sentido). Cada frame fica ~1-2 µs mais barato, mas uma sessão ativa ocupa ~5 KB a
+    mais de contexto OpenSSL (benchmarks/session_memory.py). Opcional: Server(cache_ciphers=True).
+    """
+
+    __slots__ = ('_cipher_c2s', '_cipher_s2c')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cipher_c2s = None
+        self._cipher_s2c = None
+
+    @property
+    def cipher_c2s(self):
+        cipher = self._cipher_c2s
+        if cipher is None:
+            cipher = self._cipher_c2s = crypto_utils.new_cipher(self.suite, self.key_c2s)
+        return cipher
+
+    @property
+    def cipher_s2c(self):
+        cipher = self._cipher_s2c
+        if cipher is None:
+            cipher = self._cipher_s2c = crypto_utils.new_cipher(self.suite, self.key_s2c)
+        return cipher
+
+
+class LogicalUser:
+    """Identidade lógica hospedada em uma ClientSession (multiplexação)."""
+
+    __slots__ = ('client_id', 'name', 'session')
+
+    is_logical = True
+    prekey_bundle = None  # E2E é por conexão
+
+    def __init__(self, client_id, name, session):
+        self.client_id = client_id
+        self.name = name
+        self.session = session
+
+    @property
+    def parent_id(self):
+        return self.session.client_id
+
+    def __repr__(self):
+        return f"LogicalUser(id={self.client_id}, name={self.name!r}, parent={self.parent_id})"
+
+
+class PrekeyBundle:
+    """Chave de identidade E2E de um cliente e o estoque de prekeys de uso único."""
+
+    __slots__ = ('identity_key', 'prekeys')
+
+    def __init__(self, identity_key):
+        self.identity_key = identity_key
+        self.prekeys = collections.deque()
+
+    def take(self):
+        """Entrega uma prekey (cada uma vai para um único remetente) ou None se acabaram."""
+        return self.prekeys.popleft() if self.prekeys else None
@@ -0,0 +1,45 @@
+import threading
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel: `slots` posições de `tick` segundos cada.
+    schedule() e o processamento de cada entrada vencida são O(1); timers com
+    atraso maior que uma volta completa carregam um contador de voltas restantes.
+    Cancelamento é preguiçoso: quem consome as chaves vencidas valida o estado.
+    """
+
+    def __init__(self, tick=1.0, slots=512):
+        self.tick = tick
+        self.slots = [dict() for _ in range(slots)]
+        self.position = 0
+        self._lock = threading.Lock()
+
+    def schedule(self, key, delay):
+        """Agenda `key` para vencer após `delay` segundos (arredondado para cima em ticks)."""
+        ticks = max(1, -(-int(delay * 1000) // int(self.tick * 1000)))
+        rounds, offset = divmod(ticks, len(self.slots))
+        if offset == 0:
+            rounds -= 1
+            offset = len(self.slots)
+        with self._lock:
+            slot = (self.position + offset) % len(self.slots)
+            self.slots[slot][key] = rounds
+
+    def advance(self):
+        """Avança um tick e retorna as chaves vencidas."""
+        with self._lock:
+            self.position = (self.position + 1) % len(self.slots)
+            bucket = self.slots[self.position]
+            expired = []
+            for key, rounds in list(bucket.items()):
+                if rounds == 0:
+                    expired.append(key)
+                    del bucket[key]
+                else:
+                    bucket[key] = rounds - 1
+        return expired
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(b) for b in self.slots)
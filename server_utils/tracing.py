@@ -0,0 +1,160 @@
+import collections
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+
+from server_utils.log import get_logger
+
+log = get_logger()
+
+# Estágios conhecidos do caminho de encaminhamento, na ordem em que ocorrem.
+# 'queue' (espera por um worker) e 'dispatch_wait' (espera pela vez no despacho em
+# ordem) só aparecem em frames decifrados pelo pool (server_utils/pipeline.py);
+# 'outbound_queue' é a espera na fila de saída do destino (server_utils/outbound.py).
+STAGES = ('recv', 'queue', 'decrypt', 'parse', 'dispatch_wait', 'lock_wait', 'serialize',
+          'outbound_queue', 'encrypt', 'send')
+
+
+class FrameTrace:
+    """
+    Marcações de tempo (time.monotonic_ns) de um frame ao longo do relay.
+    Cada mark() registra a duração desde a marcação anterior. Com `queued` o frame
+    entrou numa fila de saída e quem o escreve encerra o trace (Tracer.finish), depois
+    dos estágios 'outbound_queue', 'encrypt' e 'send'.
+    """
+
+    __slots__ = ('client_id', 'start_ns', 'last_ns', 'spans', 'queued')
+
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.start_ns = self.last_ns = time.monotonic_ns()
+        self.spans = []
+        self.queued = False
+
+    def mark(self, stage):
+        now = time.monotonic_ns()
+        self.spans.append((stage, now - self.last_ns))
+        self.last_ns = now
+
+    def to_dict(self):
+        return {
+            'client_id': self.client_id,
+            'start_ns': self.start_ns,
+            'total_ns': self.last_ns - self.start_ns,
+            'stages': self.spans,
+        }
+
+
+class Tracer:
+    """
+    Tracing opcional por frame. Quando desabilitado, start() retorna None e o
+    hot path paga apenas um `if trace:`.
+    Todos os frames rastreados alimentam histogramas por estágio; 1 a cada
+    `sample_rate` é guardado em um buffer circular que pode ser gravado em disco.
+    """
+
+    def __init__(self, registry, enabled=False, sample_rate=100, buffer_size=10000, trace_file='trace.jsonl'):
+        self.registry = registry
+        self.enabled = enabled
+        self.sample_rate = max(1, sample_rate)
+        self.trace_file = trace_file
+        self._samples = collections.deque(maxlen=buffer_size)
+        self._histograms = {}
+        self._count = 0
+
+    def start(self, client_id):
+        if not self.enabled:
+            return None
+        return FrameTrace(client_id)
+
+    def _histogram(self, stage):
+        hist = self._histograms.get(stage)
+        if hist is None:
+            hist = self.registry.histogram(f'chat_stage_{stage}_seconds', f'Duração do estágio {stage} por frame')
+            self._histograms[stage] = hist
+        return hist
+
+    def finish(self, trace):
+        for stage, ns in trace.spans:
+            self._histogram(stage).observe(ns / 1e9)
+
+        self._count += 1
+        if self._count % self.sample_rate == 0:
+            self._samples.append(trace)
+
+    def dump(self, path=None):
+        """Grava os traces amostrados (JSON lines) e esvazia o buffer."""
+        path = path or self.trace_file
+        samples = []
+        while self._samples:
+            samples.append(self._samples.popleft())
+        with open(path, 'a', encoding='utf-8') as f:
+            for trace in samples:
+                f.write(json.dumps(trace.to_dict()) + '\n')
+        log.info("trace_dumped", path=path, traces=len(samples))
+        return len(samples)
+
+
+class SamplingProfiler:
+    """
+    Profiler estatístico de todas as threads: amostra sys._current_frames()
+    a cada `interval` segundos durante `duration` e grava as pilhas no formato
+    "collapsed" (uma linha por pilha + contagem), compatível com flamegraph.pl/speedscope.
+    """
+
+    def __init__(self, interval=0.005, duration=10.0, output_dir='.'):
+        self.interval = interval
+        self.duration = duration
+        self.output_dir = output_dir
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return True
+
+    def _run(self):
+        me = threading.get_ident()
+        stacks = collections.Counter()
+        deadline = time.monotonic() + self.duration
+        samples = 0
+        log.info("profile_started", duration=self.duration, interval=self.interval)
+
+        while time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = [f"{fs.name} ({os.path.basename(fs.filename)}:{fs.lineno})"
+                         for fs in traceback.extract_stack(frame)]
+                stacks[';'.join(stack)] += 1
+            samples += 1
+            time.sleep(self.interval)
+
+        path = os.path.join(self.output_dir, f"profile-{int(time.time())}.collapsed")
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        log.info("profile_written", path=path, samples=samples)
+
+
+def install_signal_handlers(tracer, profiler):
+    """
+    SIGUSR1: abre uma janela de profiling estatístico.
+    SIGUSR2: grava os traces amostrados em disco.
+    Sem efeito em plataformas sem esses sinais (ex.: Windows).
+    """
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.start())
+    if hasattr(signal, 'SIGUSR2'):
+        # A escrita vai para uma thread para não executar I/O dentro do handler.
+        signal.signal(signal.SIGUSR2, lambda signum, frame: threading.Thread(target=tracer.dump, daemon=True).start())
@@ -0,0 +1,167 @@
+import asyncio
+import errno
+import itertools
+import os
+import queue
+import socket
+import stat
+import struct
+
+# Transportes de stream usados por Server e Client. Todos entregam sockets comuns
+# (SOCK_STREAM), então o framing, o handshake e a cifragem não mudam:
+#   - TcpTransport: padrão, AF_INET
+#   - UnixTransport: socket de domínio Unix, para serviços no mesmo host (sidecars)
+#   - SocketPairTransport: socketpair() em memória, para testes e benchmarks no mesmo processo
+#
+# `peer(sock, address)` devolve o endereço usado pelo servidor em logs e no controle de
+# admissão; o primeiro elemento é a chave dos limites "por IP".
+
+
+class TcpTransport:
+    supports_handoff = True
+
+    def __init__(self, host='localhost', port=5000):
+        self.host = host
+        self.port = port
+
+    def listen(self, backlog):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(backlog)
+        return sock
+
+    def connect(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect((self.host, self.port))
+        return sock
+
+    async def open_connection(self):
+        return await asyncio.open_connection(self.host, self.port)
+
+    def peer(self, sock, address):
+        return address
+
+    def __str__(self):
+        return f"tcp://{self.host}:{self.port}"
+
+
+class UnixTransport:
+    """
+    Socket de domínio Unix em `path`. Sem pilha TCP/IP: nada de checksum, Nagle ou
+    loopback; o acesso é controlado pelas permissões do arquivo (`mode`).
+    """
+
+    supports_handoff = True
+
+    def __init__(self, path, mode=0o660):
+        self.path = path
+        self.mode = mode
+
+    def listen(self, backlog):
+        # Arquivo de uma execução anterior; o socket herdado via handoff não passa por aqui
+        if os.path.lexists(self.path):
+            self._remove_stale()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # O arquivo já nasce com `mode`: um chmod depois do bind deixaria uma janela com
+        # as permissões do umask. O umask é do processo, mas o listen só roda na partida.
+        previous = os.umask(~self.mode & 0o777)
+        try:
+            sock.bind(self.path)
+        except OSError:
+            sock.close()
+            raise
+        finally:
+            os.umask(previous)
+        sock.listen(backlog)
+        return sock
+
+    def _remove_stale(self):
+        """Apaga o socket órfão em `path`; recusa se não for um socket ou se alguém escuta nele."""
+        if not stat.S_ISSOCK(os.lstat(self.path).st_mode):
+            raise FileExistsError(errno.EEXIST, "Caminho existe e não é um socket", self.path)
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.path)
+        except ConnectionRefusedError:
+            os.unlink(self.path)  # Ninguém escutando: sobra de uma execução que caiu
+            return
+        finally:
+            probe.close()
+        raise OSError(errno.EADDRINUSE, "Já há um servidor escutando neste socket", self.path)
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        return sock
+
+    async def open_connection(self):
+        return await asyncio.open_unix_connection(self.path)
+
+    def peer(self, sock, address):
+        # accept() não traz endereço útil; o UID do processo remoto faz o papel do IP
+        if hasattr(socket, 'SO_PEERCRED'):
+            pid, uid, _ = struct.unpack('3i', sock.getsockopt(
+                socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))
+            return (f'uid:{uid}', pid)
+        return ('unix', self.path)
+
+    def __str__(self):
+        return f"unix://{self.path}"
+
+
+class _PairListener:
+    """Imita o socket de escuta: accept() entrega as pontas criadas por connect()."""
+
+    def __init__(self, pending):
+        self._pending = pending
+        self._timeout = None
+        self._closed = False
+
+    def settimeout(self, timeout):
+        self._timeout = timeout
+
+    def accept(self):
+        if self._closed:
+            raise OSError("Listener fechado")
+        try:
+            return self._pending.get(timeout=self._timeout)
+        except queue.Empty:
+            raise socket.timeout("timed out") from None
+
+    def close(self):
+        self._closed = True
+
+
+class SocketPairTransport:
+    """Conexões em memória via socketpair(); servidor e clientes no mesmo processo."""
+
+    supports_handoff = False
+
+    def __init__(self):
+        self._pending = queue.Queue()
+        self._ids = itertools.count(1)
+
+    def listen(self, backlog):
+        return _PairListener(self._pending)
+
+    def connect(self):
+        client_end, server_end = socket.socketpair()
+        self._pending.put((server_end, next(self._ids)))
+        return client_end
+
+    async def open_connection(self):
+        return await asyncio.open_connection(sock=self.connect())
+
+    def peer(self, sock, address):
+        return ('socketpair', address)
+
+    def __str__(self):
+        return "socketpair"
+
+
+def from_address(host='localhost', port=5000, unix_path=None):
+    """Transporte para os argumentos de linha de comando (Unix se `unix_path` for dado)."""
+    if unix_path:
+        return UnixTransport(unix_path)
+    return TcpTransport(host, port)